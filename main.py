@@ -1,26 +1,241 @@
+import argparse
+import json
 import logging
 import os
-import subprocess
+import sys
+from datetime import datetime, timezone
+from functools import partial
+from itertools import chain
+from pathlib import Path
 import src.file_writer as fw
+import src.fhir_packager as packager
+import src.fhir_publisher as publisher
+import src.fsh_preflight as preflight
+import src.generation_diff as generation_diff
 import src.initialization as initialization
+import src.output_generations as generations
+import src.output_sinks as output_sinks
+import src.sushi_runner as sushi
+from src.build_scheduler import Build_scheduler
+from src.build_steps import Build_steps, get_checkpoint_data, release_xlsforms, should_run_stage
+from src.build_selection import Build_selection, read_xlsform_selection_settings
+from src.checkpoints import Checkpoints, Checkpoint_error, find_resumable_checkpoints, get_input_fingerprint
+from src.failure_report import Failure_report, load_failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from src.memory_monitor import Memory_monitor, measure_memory
+from src.sushi_telemetry import Sushi_run_report
+from src.models.Fsh_question_reference import read_question_codes, read_questionnaire_question_codes
 import src.xlsform_processor as xls
 import src.xlsform_to_fsh_converter as fsh
-from pathlib import Path
 from src.constants import (
     LPDS_HEALTHBOARD_ABBREVIATION_DICT,
     INPUT_FOLDER,
     OUTPUT_FOLDER,
     DSCN_SUBFOLDER,
-    LPDS_SUBFOLDER
+    LPDS_SUBFOLDER,
+    GENERATIONS_SUBFOLDER,
+    CHECKPOINT_STAGES,
+    OVERVIEW_FILE_NAME,
+    MEMORY_REPORT_FILE_NAME,
+    FAILURE_REPORT_FILE_NAME,
+    SUSHI_RUN_REPORT_FILE_NAME,
+    PUBLISH_STATE_FILE_NAME,
+    INPUT_PREFETCH_DEPTH,
+    INPUT_PREFETCH_MAX_BYTES,
+    PUBLISH_BATCH_SIZE,
+    PUBLISH_MAX_CONNECTIONS,
+    OUTPUT_SINKS,
+    OUTPUT_ARCHIVE_EXTENSIONS,
+    FHIR_ID_REGISTRY_FILE_NAME
 )
 
-# Derived folder paths
-dscn_folder = Path(OUTPUT_FOLDER) / DSCN_SUBFOLDER
-lpds_folder = Path(OUTPUT_FOLDER) / LPDS_SUBFOLDER
+parser = argparse.ArgumentParser(description='Converts XLSForms to FSH and FHIR resources.')
+parser.add_argument('--sushi-worker', action='store_true',
+                    help='Compile all projects with one long-lived SUSHI worker process instead of starting SUSHI per project. Falls back to the SUSHI command line tool if the worker fails.')
+parser.add_argument('--pipelined', action='store_true',
+                    help='Start SUSHI for a project as soon as its FSH files are written, while the forms of other projects are still being converted.')
+parser.add_argument('--skip-preflight', action='store_true',
+                    help='Do not check the FSH files for broken references, duplicate ids and unescaped quotes before running SUSHI.')
+parser.add_argument('--deterministic', action='store_true',
+                    help='Reproducible build: the QuestionReferenceCS ^version and the package timestamps are taken from --version-date or SOURCE_DATE_EPOCH, so identical inputs give byte-identical output.')
+parser.add_argument('--version-date', metavar='YYYYMMDD',
+                    help='Fixed ^version date of the QuestionReferenceCS instead of today.')
+parser.add_argument('--memory-report', action='store_true',
+                    help=f'Record peak and retained memory per stage and per form with tracemalloc and RSS sampling, and write it to {MEMORY_REPORT_FILE_NAME} in the output folder.')
+parser.add_argument('--memory-budget', type=int, metavar='MB',
+                    help='Memory budget in MB. If loading all forms at once would exceed it, forms are parsed, converted and written one at a time.')
+parser.add_argument('--prefetch-depth', type=int, default=INPUT_PREFETCH_DEPTH, metavar='N',
+                    help=f'Number of input forms read into memory in the background while the current one is parsed, for slow or network storage. 0 disables read-ahead (default {INPUT_PREFETCH_DEPTH}).')
+parser.add_argument('--prefetch-buffer', type=int, default=INPUT_PREFETCH_MAX_BYTES // 1024 // 1024, metavar='MB',
+                    help=f'Maximum size in MB of the forms read ahead (default {INPUT_PREFETCH_MAX_BYTES // 1024 // 1024}).')
+parser.add_argument('--retry-failed', action='store_true',
+                    help=f'Reprocess only the forms listed in the {FAILURE_REPORT_FILE_NAME} of the previous run, on top of the output of that run.')
+parser.add_argument('--lpds-question-reference', action='store_true',
+                    help='Also give every LPDS health board a QuestionReference CodeSystem below its canonical URL, and item codes from it to its questionnaires.')
+parser.add_argument('--compact-valuesets', type=int, metavar='MIN_CHOICES',
+                    help='Write the ValueSets of choice lists with at least MIN_CHOICES choices as an include of their whole CodeSystem instead of repeating every code. Off by default.')
+parser.add_argument('--disambiguate-ids', action='store_true',
+                    help='Give FHIR ids that collide within a project, e.g. after truncation to 64 characters, a deterministic suffix instead of failing the form.')
+parser.add_argument('--board', action='append', metavar='ABU,CTM',
+                    help='Only build the projects of these LPDS health boards. Aliases such as 7A6 and ABU select the same health board. The other projects are taken over from the current output.')
+parser.add_argument('--dscn-only', action='store_true',
+                    help='Only build the DSCN project. Combined with --board, DSCN and the given health boards are built.')
+parser.add_argument('--form', action='append', metavar='SHORT_NAME',
+                    help='Only build the forms with these tool_short_form short names, comma separated or repeated.')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue an interrupted or failed run from its last checkpoint: completed stages are skipped, and SUSHI only runs for projects it did not complete. Starts a fresh run if the inputs changed.')
+parser.add_argument('--from-stage', choices=CHECKPOINT_STAGES,
+                    help='Rerun an interrupted or failed run from this stage, using the checkpoints of the stages before it. From load is a fresh run.')
+parser.add_argument('--package', action='store_true',
+                    help='Package the FHIR resources of every compiled project as NDJSON files per resource type and as a FHIR NPM package.tgz.')
+parser.add_argument('--output-sink', choices=OUTPUT_SINKS, default='filesystem',
+                    help='Where the FSH files are written: loose files in the output generation (default), or the same DSCN/LPDS tree in a single zip or tar.gz file in the output folder. SUSHI only runs for filesystem output.')
+
+commands = parser.add_subparsers(dest='command', metavar='command', help='Run a command instead of the conversion.')
+publish_parser = commands.add_parser('publish', help='Upload the generated FHIR resources of the current output to a FHIR server.')
+publish_parser.add_argument('server', help='FHIR server base URL, e.g. http://localhost:8080/fhir')
+publish_parser.add_argument('--project', action='append', dest='projects', metavar='PROJECT',
+                            help='Only publish this project, e.g. DSCN or LPDS/ABU. Can be repeated. Defaults to all projects.')
+publish_parser.add_argument('--batch-size', type=int, default=PUBLISH_BATCH_SIZE, help=f'Resources per Bundle (default {PUBLISH_BATCH_SIZE}).')
+publish_parser.add_argument('--concurrency', type=int, default=PUBLISH_MAX_CONNECTIONS, help=f'Bundles sent in parallel (default {PUBLISH_MAX_CONNECTIONS}).')
+publish_parser.add_argument('--transaction', action='store_true', help='Send transaction instead of batch Bundles, so each Bundle is applied completely or not at all.')
+publish_parser.add_argument('--header', action='append', default=[], metavar='"NAME: VALUE"', help='Extra request header, e.g. "Authorization: Bearer <token>". Can be repeated.')
+publish_parser.add_argument('--force', action='store_true', help=f'Upload all resources, also the ones that did not change since the last upload recorded in {PUBLISH_STATE_FILE_NAME}.')
+diff_parser = commands.add_parser('diff', help='Compare two output trees per project: questions, codes, displays and ValueSet members.')
+diff_parser.add_argument('old', help='The old output tree: a folder, or the name of a generation in the output folder. Defaults to the previous generation.', nargs='?')
+diff_parser.add_argument('new', help='The new output tree: a folder, or the name of a generation in the output folder. Defaults to the current output.', nargs='?')
+diff_parser.add_argument('--json', action='store_true', help='Compare the FHIR resources generated by SUSHI instead of the FSH files.')
+diff_parser.add_argument('--compare-versions', action='store_true', help='Also compare versions and dates, which are ignored by default because they change on every run.')
+diff_parser.add_argument('--report', metavar='FILE', help='Also write the differences as JSON to this file.')
+args = parser.parse_args()
+if args.command is None and args.retry_failed and (args.board or args.dscn_only or args.form):
+    parser.error('--retry-failed cannot be combined with --board, --dscn-only or --form.')
+if args.command is None and args.retry_failed and (args.resume or args.from_stage):
+    parser.error('--retry-failed cannot be combined with --resume or --from-stage.')
+if args.command is None and args.version_date:
+    try:
+        datetime.strptime(args.version_date, '%Y%m%d')
+    except ValueError:
+        parser.error(f'--version-date {args.version_date} is not a date in YYYYMMDD format.')
+if args.command is None and args.deterministic and not args.version_date and 'SOURCE_DATE_EPOCH' not in os.environ:
+    parser.error('--deterministic needs a fixed date, pass --version-date or set SOURCE_DATE_EPOCH.')
+if args.command is None and args.output_sink != 'filesystem' and (args.pipelined or args.package or args.retry_failed or args.resume or args.from_stage
+                                                               or args.board or args.dscn_only or args.form):
+    parser.error(f'--output-sink {args.output_sink} cannot be combined with --pipelined, --package, --retry-failed, --resume, --from-stage, --board, --dscn-only or --form.')
+if args.command is None and args.compact_valuesets is not None and args.compact_valuesets < 1:
+    parser.error('--compact-valuesets must be at least 1.')
+if args.command == 'publish':
+    for header in args.header:
+        if ':' not in header or not header.split(':', 1)[0].strip():
+            publish_parser.error(f'--header {header} is not in "NAME: VALUE" format.')
+
+def get_version_date(args):
+    """Returns the fixed version date of a deterministic build, or None to use today."""
+    if args.version_date:
+        return datetime.strptime(args.version_date, '%Y%m%d').replace(tzinfo=timezone.utc)
+    if args.deterministic:
+        return datetime.fromtimestamp(int(os.environ['SOURCE_DATE_EPOCH']), tz=timezone.utc)
+    return None
+
+def get_checkpoint_options(args) -> dict:
+    """Returns the options that change the output, which are part of the fingerprint of the checkpoints."""
+    version_date = get_version_date(args)
+    return {
+        'retry_failed': args.retry_failed,
+        'board': split_option_values(args.board),
+        'dscn_only': args.dscn_only,
+        'form': split_option_values(args.form),
+        'disambiguate_ids': args.disambiguate_ids,
+        'lpds_question_reference': args.lpds_question_reference,
+        'compact_valuesets': args.compact_valuesets,
+        'output_sink': args.output_sink,
+        'version_date': version_date.isoformat() if version_date else None,
+    }
+
+def resolve_output_tree(name):
+    """Resolves a diff argument: an existing folder, 'current' or the name of a generation in the output folder."""
+    for candidate in (Path(name), Path(OUTPUT_FOLDER) / name, Path(OUTPUT_FOLDER) / GENERATIONS_SUBFOLDER / name):
+        if candidate.is_dir():
+            return candidate
+    raise FileNotFoundError(f'Output tree {name} not found.')
+
+def diff_output(args) -> int:
+    """Prints the differences between two output trees. Returns 1 if they differ, like diff."""
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s ; %(levelname)s; %(message)s')
+
+    new_tree = resolve_output_tree(args.new) if args.new else generations.get_current_generation(OUTPUT_FOLDER)
+    if args.old:
+        old_tree = resolve_output_tree(args.old)
+    else:
+        # The most recent completed generation before the new one
+        completed = generations.list_completed_generations(OUTPUT_FOLDER)
+        older = [generation for generation in completed if new_tree is None or generation.resolve() != new_tree.resolve()]
+        old_tree = older[0] if older else None
+    if old_tree is None or new_tree is None:
+        print('Need two output trees to compare, pass them as arguments.')
+        return 2
+
+    print(f'Comparing {old_tree} with {new_tree}')
+    ignored_properties = set() if args.compare_versions else generation_diff.VOLATILE_PROPERTIES
+    changes = generation_diff.diff_trees(old_tree, new_tree, 'json' if args.json else 'fsh', ignored_properties)
+    print(generation_diff.format_diff(changes))
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(changes, report_file, indent=2, ensure_ascii=False)
+    return 1 if changes else 0
+
+def publish_output(args) -> int:
+    """Uploads the generated resources of the current output to a FHIR server. Returns the exit code."""
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s ; %(levelname)s; %(message)s')
+
+    project_folders = publisher.find_project_folders(OUTPUT_FOLDER, args.projects)
+    if not project_folders:
+        print(f'No generated FHIR resources found in {OUTPUT_FOLDER}. Run the conversion first.')
+        return 1
+
+    headers = dict(header.split(':', 1) for header in args.header)
+    fhir_publisher = publisher.Fhir_publisher(args.server, args.batch_size, args.concurrency, 'transaction' if args.transaction else 'batch',
+                                              headers={name.strip(): value.strip() for name, value in headers.items()})
+    print(f'Publishing {len(project_folders)} projects to {args.server}')
+    totals = fhir_publisher.publish_projects(project_folders, os.path.join(OUTPUT_FOLDER, PUBLISH_STATE_FILE_NAME), args.force)
+    print(f"Done! {totals['uploaded']} resources uploaded, {totals['skipped']} unchanged, {totals['failed']} failed.")
+    return 1 if totals['failed'] else 0
+
+if args.command == 'publish':
+    sys.exit(publish_output(args))
+if args.command == 'diff':
+    sys.exit(diff_output(args))
+
+def split_option_values(values):
+    """Splits repeated, comma separated option values such as --board ABU,CTM --board BCU."""
+    return [value.strip() for option_value in values or [] for value in option_value.split(',') if value.strip()]
+
+def load_id_registries(id_registries: Fhir_id_registries, generation_folder, converted_forms) -> None:
+    """Registers the FHIR ids of the forms a run keeps from a seeded or interrupted generation, all but the `converted_forms`."""
+    if not id_registries.load(Path(generation_folder) / FHIR_ID_REGISTRY_FILE_NAME, converted_forms):
+        logging.warning(f'{generation_folder} has no FHIR id registry, the ids of the converted forms are only checked against each other.')
+
+def get_lpds_healthboard_abbreviations(xls_files) -> set:
+    """Returns the LPDS health boards of the forms, reading only their settings. Forms whose settings cannot be read are left out."""
+    boards = set()
+    for xls_file in xls_files:
+        try:
+            boards.add(read_xlsform_selection_settings(xls_file)[1])
+        except Exception as e:
+            logging.warning(f'Could not read the settings of {xls_file}: {str(e)}')
+    boards.discard(None)
+    return boards
 
 # Runtime variables
 processed_xlsforms = []
 processed_xlsforms_md_overview = []
+project_forms = {}
+cleared_project_folders = set()
+pipelined_folders = []
+pipelined_compiled_folders = []
+pipelined_sushi_failed_folders = []
+resumed_folders = []
 
 print('***************************************************')
 print('*                                                 *')
@@ -29,24 +244,248 @@ print('*                                                 *')
 print('***************************************************')
 
 print('Step 0 - Setup and validation')
-initialization.delete_output_folder_contents(OUTPUT_FOLDER)
 initialization.initiate_logging(OUTPUT_FOLDER)
 
-XLS_Forms = xls.read_xlsforms(INPUT_FOLDER, LPDS_HEALTHBOARD_ABBREVIATION_DICT)
+failure_report_path = os.path.join(OUTPUT_FOLDER, FAILURE_REPORT_FILE_NAME)
+previous_failure_report = None
+if args.retry_failed:
+    previous_failure_report = load_failure_report(failure_report_path)
+    if previous_failure_report is None or not previous_failure_report['failed_forms']:
+        print('The previous run has no failed forms, nothing to retry.')
+        sys.exit(0)
+    if not Path(previous_failure_report['generation']).is_dir():
+        logging.error(f"The output generation of the previous run {previous_failure_report['generation']} no longer exists. Run without --retry-failed.")
+        sys.exit(1)
+
+selection = None
+if args.board or args.dscn_only or args.form:
+    try:
+        selection = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, split_option_values(args.board), args.dscn_only, split_option_values(args.form))
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+xls_files = xls.list_xlsform_files(INPUT_FOLDER)
+input_fingerprint = get_input_fingerprint(xls_files + xls.list_external_choice_files(INPUT_FOLDER), get_checkpoint_options(args))
+run_checkpoints = None
+resume_stage = None
+checkpoint = None
+if args.resume or (args.from_stage and args.from_stage != CHECKPOINT_STAGES[0]):
+    try:
+        run_checkpoints = find_resumable_checkpoints(OUTPUT_FOLDER, input_fingerprint)
+        resume_stage = run_checkpoints.get_resume_stage(args.from_stage)
+        checkpoint = run_checkpoints.load_stage(CHECKPOINT_STAGES[CHECKPOINT_STAGES.index(resume_stage) - 1])
+    except Checkpoint_error as e:
+        if args.from_stage:
+            logging.error(f'{str(e)} Run without --from-stage.')
+            sys.exit(1)
+        logging.warning(f'{str(e)} Starting a fresh run.')
+        run_checkpoints, resume_stage = None, None
+
+# Write into a fresh generation, the current output stays untouched until all steps succeeded
+previous_generation = generations.get_current_generation(OUTPUT_FOLDER)
+if run_checkpoints is not None:
+    generation_folder = run_checkpoints.generation_folder
+    generations.lock_generation(generation_folder)
+    print(f'Resuming output generation {generation_folder.name} from the {resume_stage} stage')
+    logging.info(f'Resuming {generation_folder} from the {resume_stage} stage')
+else:
+    generation_folder = generations.create_generation(OUTPUT_FOLDER)
+    run_checkpoints = Checkpoints.create(generation_folder, input_fingerprint)
+dscn_folder = generation_folder / DSCN_SUBFOLDER
+lpds_folder = generation_folder / LPDS_SUBFOLDER
+failure_report = Failure_report(generation_folder)
+sushi_run_report = Sushi_run_report(os.path.join(OUTPUT_FOLDER, SUSHI_RUN_REPORT_FILE_NAME), generation_folder)
+id_registries = Fhir_id_registries(disambiguate=args.disambiguate_ids)
+
+previous_md_entries = None
+previous_question_codes_DSCN = None
+previous_question_codes_LPDS = None
+
+if checkpoint is not None:
+    # The generation was seeded and the previous entries and codes collected before the run was interrupted
+    failure_report.restore_state(checkpoint['failure_report'])
+    processed_xlsforms_md_overview = checkpoint['md_overview']
+    project_forms = checkpoint['project_forms']
+    cleared_project_folders = checkpoint['cleared_project_folders']
+    previous_question_codes_DSCN = checkpoint['previous_question_codes_DSCN']
+    previous_question_codes_LPDS = checkpoint['previous_question_codes_LPDS']
+    # The ids of the forms that are converted again are registered again
+    converted_forms = {form for forms in project_forms.values() for form in forms} if should_run_stage('convert', resume_stage) else ()
+    id_registries.restore_state(checkpoint['id_registries'], converted_forms)
+elif previous_failure_report is not None:
+    # Start from the output of the failed run and only reprocess its failed forms
+    failed_forms = set(previous_failure_report['failed_forms'])
+    generations.seed_generation(generation_folder, Path(previous_failure_report['generation']))
+    xls_files = [xls_file for xls_file in xls_files if xls_file in failed_forms]
+    print(f'Retrying {len(xls_files)} failed forms: {", ".join(xls_files)}')
+    load_id_registries(id_registries, generation_folder, xls_files)
+
+    previous_md_entries = []
+    for form, md_entry in previous_failure_report['processed_forms'].items():
+        if form not in failed_forms:
+            previous_md_entries.append(md_entry)
+            failure_report.add_processed_form(form, md_entry)
+
+    question_reference_file = dscn_folder / 'input' / 'fsh' / 'terminology' / 'QuestionReferenceCS.fsh'
+    if question_reference_file.exists():
+        previous_question_codes_DSCN = read_question_codes(question_reference_file)
+    if args.lpds_question_reference:
+        # The QuestionReference CodeSystems of the health boards of the failed forms are written again
+        previous_question_codes_LPDS = fsh.read_lpds_question_codes(generation_folder, get_lpds_healthboard_abbreviations(xls_files))
+
+if selection is not None and checkpoint is None:
+    # Start from the current output and only rebuild the selected projects or forms
+    xls_files = selection.filter_xlsform_files(xls_files)
+    print(f'Selected {len(xls_files)} forms: {", ".join(xls_files)}')
+
+    if previous_generation is None:
+        logging.warning('There is no current output to build on, the output will only contain the selected projects.')
+    else:
+        generations.seed_generation(generation_folder, previous_generation)
+        load_id_registries(id_registries, generation_folder, xls_files)
+
+        previous_report = load_failure_report(failure_report_path)
+        if previous_report is not None and Path(previous_report['generation']).resolve() == previous_generation.resolve():
+            previous_md_entries = []
+            for form, md_entry in previous_report['processed_forms'].items():
+                if not selection.includes_md_entry(md_entry):
+                    previous_md_entries.append(md_entry)
+                    failure_report.add_processed_form(form, md_entry)
+        else:
+            logging.warning('No failure report of the current output found, the overview will only list the selected forms.')
 
-print('Step 1 - Parse XLSForms')
-processed_xlsforms, processed_xlsforms_md_overview = xls.read_and_process_xlsform_files(XLS_Forms)
+        # Question codes of forms that are rebuilt are collected again from their XLSForms
+        question_reference_file = dscn_folder / 'input' / 'fsh' / 'terminology' / 'QuestionReferenceCS.fsh'
+        rebuilt_question_codes = {}
+        for fsh_file in selection.get_selected_fsh_files(generation_folder):
+            project_folder = fsh_file.parents[3]
+            cleared_project_folders.add(project_folder)
+            if fsh_file.parent == project_folder / 'input' / 'fsh' / 'questionnaires':
+                rebuilt_question_codes.setdefault(project_folder, set()).update(read_questionnaire_question_codes(fsh_file))
+            if fsh_file != question_reference_file:
+                fsh_file.unlink()
+        if selection.forms is not None and selection.includes_project(None) and question_reference_file.exists():
+            previous_question_codes_DSCN = [code for code in read_question_codes(question_reference_file) if code[0] not in rebuilt_question_codes.get(dscn_folder, set())]
+        if selection.forms is not None and args.lpds_question_reference:
+            # Without --form the QuestionReference CodeSystems of the selected health boards were removed with their other files
+            cleared_boards = [folder.name for folder in cleared_project_folders if folder.parent == lpds_folder]
+            previous_question_codes_LPDS = {board: [code for code in codes if code[0] not in rebuilt_question_codes.get(lpds_folder / board, set())]
+                                            for board, codes in fsh.read_lpds_question_codes(generation_folder, cleared_boards).items()}
 
-print('Step 2 - Convert to FSH lines')
-fsh_lines_list_DSCN, fsh_lines_list_LPDS  = fsh.convert_to_fsh(processed_xlsforms)
+memory_monitor = None
+if args.memory_report or args.memory_budget:
+    memory_monitor = Memory_monitor(trace=args.memory_report, budget_bytes=args.memory_budget * 1024 * 1024 if args.memory_budget else None)
 
-print('Step 3 - Writing to FSH files')
-fw.write_fsh_files(fsh_lines_list_DSCN, OUTPUT_FOLDER, LPDS_HEALTHBOARD_ABBREVIATION_DICT)
-fw.write_fsh_files(fsh_lines_list_LPDS, OUTPUT_FOLDER, LPDS_HEALTHBOARD_ABBREVIATION_DICT)
-fw.write_to_md_file(processed_xlsforms_md_overview, os.path.join(OUTPUT_FOLDER, 'Overview of processed XLSForms.md'))
+# A resumed run rewrites the files an interrupted stage may have written partially
+replace_existing = previous_failure_report is not None or selection is not None or resume_stage is not None
+version_date = get_version_date(args)
+output_sink = output_sinks.create_output_sink(args.output_sink, generation_folder,
+                                              Path(OUTPUT_FOLDER) / f'{generation_folder.name}{OUTPUT_ARCHIVE_EXTENSIONS.get(args.output_sink, "")}',
+                                              version_date.timestamp() if args.deterministic else None)
+include_question_reference = selection is None or selection.includes_project(None)
+build_steps = Build_steps(generation_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, failure_report, id_registries, memory_monitor, output_sink,
+                          previous_generation, replace_existing, version_date, args.lpds_question_reference, args.compact_valuesets)
+
+XLS_Forms = []
+remaining_xls_files = []
+if should_run_stage('write', resume_stage) and should_run_stage('load', resume_stage):
+    if memory_monitor is not None and memory_monitor.would_exceed_budget(xls_files):
+        logging.warning(f'Loading all {len(xls_files)} forms at once would exceed the memory budget of {args.memory_budget} MB. Processing forms one at a time.')
+        remaining_xls_files = xls_files
+    else:
+        XLS_Forms, remaining_xls_files = xls.read_xlsforms(INPUT_FOLDER, LPDS_HEALTHBOARD_ABBREVIATION_DICT, memory_monitor, failure_report, xls_files,
+                                                           args.prefetch_depth, args.prefetch_buffer * 1024 * 1024)
+        if remaining_xls_files:
+            logging.warning(f'Loading {remaining_xls_files[0]} would exceed the memory budget of {args.memory_budget} MB. Processing forms one at a time.')
+
+if not should_run_stage('write', resume_stage):
+    print('Steps 1 to 3 - Skipped, the FSH files were written before the run was interrupted')
+elif remaining_xls_files:
+    print('Steps 1 to 3 - Parse, convert and write XLSForms one at a time')
+    # The forms loaded before the budget was reached are processed first
+    remaining_xlsforms = xls.iterate_xlsforms(remaining_xls_files, LPDS_HEALTHBOARD_ABBREVIATION_DICT, memory_monitor, failure_report,
+                                              args.prefetch_depth, args.prefetch_buffer * 1024 * 1024)
+    processed_xlsforms_md_overview = build_steps.convert_and_write_one_at_a_time(
+        chain(release_xlsforms(XLS_Forms), remaining_xlsforms), project_forms, previous_md_entries, previous_question_codes_DSCN, include_question_reference,
+        previous_question_codes_LPDS)
+    id_registries.report_collisions(failure_report)
+else:
+    if should_run_stage('load', resume_stage):
+        print('Step 1 - Parse XLSForms')
+        processed_xlsforms, processed_xlsforms_md_overview = xls.read_and_process_xlsform_files(XLS_Forms, failure_report, previous_md_entries)
+        del XLS_Forms
+        for xlsForm in processed_xlsforms:
+            build_steps.record_project_form(project_forms, xlsForm)
+        run_checkpoints.save_stage('load', get_checkpoint_data(failure_report, id_registries, processed_xlsforms_md_overview, project_forms, cleared_project_folders,
+                                                               previous_question_codes_DSCN, previous_question_codes_LPDS,
+                                                               xlsform_paths=[xlsForm.input_path for xlsForm in processed_xlsforms]))
+    elif should_run_stage('convert', resume_stage):
+        # The checkpoint only lists the forms, the fingerprint guarantees their files did not change since
+        print('Step 1 - Reloading the XLSForms that were parsed before the run was interrupted')
+        processed_xlsforms = list(xls.iterate_xlsforms(checkpoint['xlsform_paths'], LPDS_HEALTHBOARD_ABBREVIATION_DICT, memory_monitor, failure_report,
+                                                       args.prefetch_depth, args.prefetch_buffer * 1024 * 1024))
+
+    if not should_run_stage('convert', resume_stage):
+        print('Step 2 - Skipped, the FSH lines are taken from the checkpoint')
+        print('Step 3 - Writing to FSH files')
+        with measure_memory(memory_monitor, 'write'):
+            build_steps.write_fsh_lines(checkpoint['fsh_lines_list_DSCN'], checkpoint['input_paths'])
+            build_steps.write_fsh_lines(checkpoint['fsh_lines_list_LPDS'], checkpoint['input_paths'])
+    elif memory_monitor is not None and memory_monitor.is_over_budget():
+        logging.warning(f'Memory use exceeds the budget of {args.memory_budget} MB after loading the forms. Converting and writing forms one at a time.')
+        print('Steps 2 and 3 - Convert and write XLSForms one at a time')
+        build_steps.convert_and_write_one_at_a_time(release_xlsforms(processed_xlsforms), {}, [], previous_question_codes_DSCN, include_question_reference,
+                                                    previous_question_codes_LPDS)
+        id_registries.report_collisions(failure_report)
+    elif args.pipelined:
+        print('Steps 2 to 4 - Convert, write and compile each project as soon as its forms are written')
+        scheduler = Build_scheduler(generation_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, failure_report, id_registries, memory_monitor,
+                                    replace_existing, use_sushi_worker=args.sushi_worker, run_preflight=not args.skip_preflight, version_date=version_date,
+                                    run_report=sushi_run_report, lpds_question_reference=args.lpds_question_reference, previous_output=previous_generation,
+                                    compact_valueset_threshold=args.compact_valuesets)
+        with measure_memory(memory_monitor, 'pipeline'):
+            pipelined_sushi_failed_folders = scheduler.run(processed_xlsforms, previous_question_codes_DSCN, include_question_reference, previous_question_codes_LPDS)
+        pipelined_folders = scheduler.completed_folders
+        pipelined_compiled_folders = scheduler.compiled_folders
+        id_registries.report_collisions(failure_report)
+    else:
+        print('Step 2 - Convert to FSH lines')
+        input_paths = {xlsForm.file_name: xlsForm.input_path for xlsForm in processed_xlsforms}
+        # Under a memory budget, the FSH lines are written as soon as memory use exceeds it
+        fsh_lines_list_DSCN, fsh_lines_list_LPDS  = fsh.convert_to_fsh(processed_xlsforms, memory_monitor, failure_report, previous_question_codes_DSCN,
+                                                                     id_registries, include_question_reference, version_date,
+                                                                     args.lpds_question_reference, previous_question_codes_LPDS, args.compact_valuesets,
+                                                                     partial(build_steps.flush_fsh_lines, input_paths=input_paths) if args.memory_budget else None)
+        id_registries.report_collisions(failure_report)
+        if not build_steps.flushed_fsh_lines:
+            # The checkpoint would miss the FSH lines that were already written, a resumed run converts them again
+            run_checkpoints.save_stage('convert', get_checkpoint_data(failure_report, id_registries, processed_xlsforms_md_overview, project_forms, cleared_project_folders,
+                                                                      previous_question_codes_DSCN, previous_question_codes_LPDS, fsh_lines_list_DSCN=fsh_lines_list_DSCN,
+                                                                      fsh_lines_list_LPDS=fsh_lines_list_LPDS, input_paths=input_paths))
+
+        print('Step 3 - Writing to FSH files')
+        with measure_memory(memory_monitor, 'write'):
+            build_steps.write_fsh_lines(fsh_lines_list_DSCN, input_paths)
+            build_steps.write_fsh_lines(fsh_lines_list_LPDS, input_paths)
+
+if should_run_stage('write', resume_stage):
+    fw.write_to_md_file(processed_xlsforms_md_overview, os.path.join(generation_folder, OVERVIEW_FILE_NAME), output_sink)
+    if output_sink.writes_to_filesystem:
+        id_registries.save(generation_folder / FHIR_ID_REGISTRY_FILE_NAME)
+    run_checkpoints.save_stage('write', get_checkpoint_data(failure_report, id_registries, processed_xlsforms_md_overview, project_forms, cleared_project_folders,
+                                                            previous_question_codes_DSCN, previous_question_codes_LPDS))
+    for folder in pipelined_compiled_folders:
+        if folder not in pipelined_sushi_failed_folders:
+            run_checkpoints.record_sushi_project(folder)
+output_sink.close()
 logging.info('Conversion to FSH done!')
 
-print('Step 4 - Convert FSH files to FHIR')
+if output_sink.writes_to_filesystem:
+    print('Step 4 - Convert FSH files to FHIR')
+else:
+    # There are no project folders on disk, so no project is compiled
+    print(f'Step 4 - Skipped, the FSH files were written to {output_sink.archive_path} and SUSHI only runs for filesystem output')
 logging.info('Converting FSH to FHIR using FSH SUSHI compiler...')
 folders_to_process = []
 
@@ -56,16 +495,66 @@ if dscn_folder.exists() and any(dscn_folder.glob('sushi-config.yaml')):
 
 # Add LPDS healthboard folders if they exist and contain a sushi-config.yaml file
 if lpds_folder.exists():
-    lpds_healthboard_folders = [f for f in lpds_folder.iterdir() if f.is_dir() and any(f.glob('sushi-config.yaml'))]
+    lpds_healthboard_folders = sorted(f for f in lpds_folder.iterdir() if f.is_dir() and any(f.glob('sushi-config.yaml')))
     folders_to_process.extend(lpds_healthboard_folders)
 
-for folder in folders_to_process:
-    try:
-        subprocess.run('sushi', check=True, shell=True, cwd=folder)
-        logging.info(f'SUSHI run successfully in {folder}')
-    except subprocess.CalledProcessError as e:
-        logging.error(f'Error running Sushi in {folder}: {str(e)}')
-        print(f'Command failed with error: {e.returncode} in {folder}')
+if previous_failure_report is not None:
+    # The other projects were already compiled in the previous run, DSCN is compiled again for its regenerated QuestionReferenceCS
+    folders_to_process = [folder for folder in folders_to_process if folder in project_forms or folder == dscn_folder]
+elif selection is not None and selection.forms is not None:
+    # Only the projects the selected forms were removed from or written to changed
+    folders_to_process = [folder for folder in folders_to_process if folder in project_forms or folder in cleared_project_folders]
+elif selection is not None:
+    # The other projects are unchanged from the current output
+    folders_to_process = [folder for folder in folders_to_process if selection.includes_project_folder(generation_folder, folder)]
+
+# Projects completed by the pipelined scheduler are final
+folders_to_process = [folder for folder in folders_to_process if folder not in pipelined_folders]
+if resume_stage is not None and args.from_stage != 'sushi':
+    # Projects SUSHI completed before the run was interrupted are skipped, unless their FSH files changed since
+    resumed_folders = [folder for folder in folders_to_process if run_checkpoints.is_sushi_project_done(folder)]
+    folders_to_process = [folder for folder in folders_to_process if folder not in resumed_folders]
+    if resumed_folders:
+        print(f'Skipping SUSHI for {len(resumed_folders)} projects compiled before the run was interrupted')
+if not args.skip_preflight:
+    folders_to_process = preflight.run_preflight(folders_to_process, failure_report, project_forms)
+with measure_memory(memory_monitor, 'sushi'):
+    sushi_failed_folders = pipelined_sushi_failed_folders + sushi.run_sushi(folders_to_process, args.sushi_worker, run_checkpoints.record_sushi_result, sushi_run_report)
+for folder in sushi_failed_folders:
+    failure_report.add_failure('sushi', None, f'SUSHI failed for {folder}, see the log file for details.', project=str(folder), forms=project_forms.get(folder, []))
+
+if args.package:
+    print('Step 4b - Package FHIR resources')
+    with measure_memory(memory_monitor, 'package'):
+        for folder in pipelined_compiled_folders + resumed_folders + folders_to_process:
+            if folder in sushi_failed_folders:
+                continue
+            try:
+                packager.package_project(folder, version_date.timestamp() if args.deterministic else None)
+            except Exception as e:
+                failure_report.add_failure('package', None, e, project=str(folder), forms=project_forms.get(folder, []))
+
+print('Step 5 - Publish output generation')
+failure_report.write(failure_report_path)
+failure_report.print_summary()
+generations.release_generation(generation_folder)
+if failure_report.has_failures():
+    # Keep the previous output current, the failed generation is left in place for inspection and --retry-failed
+    logging.error(f'Not activating {generation_folder} because of failures, see {failure_report_path}. The previous output remains current.')
+    print('Rerun with --resume to continue this run from its last checkpoint with unchanged inputs.')
+elif not output_sink.writes_to_filesystem:
+    # The generation folder only held the checkpoints, the previous output remains current
+    run_checkpoints.remove()
+    generations.prune_generations_in_background(OUTPUT_FOLDER)
+    print(f'The output was written to {output_sink.archive_path}.')
+else:
+    run_checkpoints.remove()
+    generations.reuse_unchanged_files(generation_folder, previous_generation)
+    generations.activate_generation(OUTPUT_FOLDER, generation_folder)
+    generations.prune_generations_in_background(OUTPUT_FOLDER)
+
+if memory_monitor is not None:
+    memory_monitor.write_report(os.path.join(OUTPUT_FOLDER, MEMORY_REPORT_FILE_NAME))
 
 print('Done! Thank you for using XLSForm to FHIR today.')
 logging.info('Done! Thank you for using XLSForm to FSH to FHIR today.')
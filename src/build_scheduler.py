@@ -0,0 +1,156 @@
+import logging, threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+from tqdm import tqdm
+import src.file_writer as fw
+import src.fsh_preflight as preflight
+import src.sushi_runner as sushi
+import src.xlsform_to_fsh_converter as fsh
+from src.failure_report import Failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from src.memory_monitor import Memory_monitor, measure_memory
+from src.sushi_telemetry import Sushi_run_report
+from src.models.XLS_Form import XLS_Form
+from src.constants import DSCN_SUBFOLDER, PIPELINE_MAX_SUSHI_PROCESSES
+
+class Build_scheduler:
+
+    def __init__(self, output_folder, lpds_healthboard_abbreviation_dict: dict, failure_report: Failure_report, id_registries: Fhir_id_registries,
+                 memory_monitor: Memory_monitor = None, replace_existing: bool = False, use_sushi_worker: bool = False,
+                 max_sushi_processes: int = PIPELINE_MAX_SUSHI_PROCESSES, run_preflight: bool = True, version_date: datetime = None,
+                 run_report: Sushi_run_report = None, lpds_question_reference: bool = False, previous_output=None,
+                 compact_valueset_threshold: int = None):
+        """
+        Converts and writes the forms project by project, and starts SUSHI for a project as soon as its FSH
+        files are final, while the forms of the next projects are still being converted.
+
+        A project depends only on its own forms. The DSCN project also depends on the QuestionReferenceCS,
+        which is written after the last DSCN form. DSCN is usually the largest project, so its forms are
+        converted first and its SUSHI run, the longest chain, starts as early as possible.
+
+        Conversion runs on the calling thread. SUSHI runs in up to `max_sushi_processes` parallel processes,
+        or in a single SUSHI worker process with `use_sushi_worker`. With `run_preflight`, the FSH files of a
+        project are checked before SUSHI is started, and projects with problems are not compiled. `version_date`
+        fixes the ^version of the QuestionReferenceCS for deterministic builds. The SUSHI runs are recorded in `run_report`.
+        With `lpds_question_reference`, an LPDS project also depends on the QuestionReferenceCS of its health board,
+        which is written after its last form. Unchanged external choice lists are reused from `previous_output`.
+        Lists with at least `compact_valueset_threshold` choices get ValueSets that include their whole CodeSystem.
+        """
+        self.output_folder = Path(output_folder)
+        self.lpds_healthboard_abbreviation_dict = lpds_healthboard_abbreviation_dict
+        self.failure_report = failure_report
+        self.id_registries = id_registries
+        self.memory_monitor = memory_monitor
+        self.replace_existing = replace_existing
+        self.use_sushi_worker = use_sushi_worker
+        self.max_sushi_processes = max_sushi_processes
+        self.run_preflight = run_preflight
+        self.version_date = version_date
+        self.run_report = run_report
+        self.lpds_question_reference = lpds_question_reference
+        self.previous_output = previous_output
+        self.compact_valueset_threshold = compact_valueset_threshold
+        self.completed_folders = []
+        self.compiled_folders = []
+        self._worker = None
+        self._worker_started = False
+        self._worker_lock = threading.Lock()
+
+    def run(self, xlsforms: List[XLS_Form], previous_question_codes_DSCN: list = None, include_question_reference: bool = True,
+            previous_question_codes_LPDS: dict = None) -> List[Path]:
+        """
+        Converts, writes and compiles the forms.
+
+        Args:
+            xlsforms (List[XLS_Form]): The processed forms.
+            previous_question_codes_DSCN (list, optional): Question codes of DSCN forms that are not converted in this run.
+            include_question_reference (bool): Whether to write the QuestionReferenceCS and compile DSCN.
+            previous_question_codes_LPDS (dict, optional): Question codes by health board of LPDS forms that are not converted
+                in this run, with `lpds_question_reference`. These health boards are always written and compiled.
+
+        Returns:
+            List[Path]: The project folders for which SUSHI failed. The projects whose FSH files were completed are in
+                `completed_folders`, the ones SUSHI ran for in `compiled_folders`.
+        """
+        dscn_folder = self.output_folder / DSCN_SUBFOLDER
+        forms_by_project = {}
+        for xlsForm in xlsforms:
+            forms_by_project.setdefault(fw.get_project_folder(self.output_folder, xlsForm.lpds_healthboard_abbreviation), []).append(xlsForm)
+        if include_question_reference:
+            forms_by_project.setdefault(dscn_folder, [])
+        question_codes_LPDS = {}
+        if self.lpds_question_reference:
+            question_codes_LPDS = {board: list(codes) for board, codes in (previous_question_codes_LPDS or {}).items()}
+            for xlsForm in xlsforms:
+                if xlsForm.lpds_healthboard_abbreviation:
+                    question_codes_LPDS.setdefault(xlsForm.lpds_healthboard_abbreviation, [])
+            for board in question_codes_LPDS:
+                forms_by_project.setdefault(fw.get_project_folder(self.output_folder, board), [])
+
+        projects = sorted(forms_by_project, key=lambda project: (project != dscn_folder, -len(forms_by_project[project]), str(project)))
+        question_codes_DSCN = list(previous_question_codes_DSCN or [])
+        sushi_runs = {}
+
+        max_workers = 1 if self.use_sushi_worker else self.max_sushi_processes
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sushi') as executor, \
+             tqdm(total=len(xlsforms), desc='Converting and writing forms', dynamic_ncols=True) as pbar:
+            for project in projects:
+                for xlsForm in forms_by_project[project]:
+                    question_codes = self._convert_and_write(xlsForm)
+                    if xlsForm.lpds_healthboard_abbreviation is None:
+                        question_codes_DSCN.extend(question_codes)
+                    elif self.lpds_question_reference:
+                        question_codes_LPDS[xlsForm.lpds_healthboard_abbreviation].extend(question_codes)
+                    pbar.update(1)
+
+                if project == dscn_folder and include_question_reference:
+                    fw.write_fsh_files([fsh.create_question_reference_codesystem_fsh_lines(question_codes_DSCN, self.version_date)], self.output_folder,
+                                       self.lpds_healthboard_abbreviation_dict, self.failure_report, replace_existing=self.replace_existing)
+                elif project != dscn_folder and project.name in question_codes_LPDS:
+                    fw.write_fsh_files([fsh.create_lpds_question_reference_codesystem_fsh_lines(project.name, question_codes_LPDS[project.name], self.version_date)],
+                                       self.output_folder, self.lpds_healthboard_abbreviation_dict, self.failure_report, replace_existing=self.replace_existing)
+
+                # The project's FSH files are final
+                if not (project / 'sushi-config.yaml').exists():
+                    continue
+                self.completed_folders.append(project)
+                if self.run_preflight and not preflight.run_preflight([project], self.failure_report, {project: [xlsForm.input_path for xlsForm in forms_by_project[project]]}):
+                    continue
+                logging.info(f'FSH files of {project} are complete, starting SUSHI')
+                sushi_runs[project] = executor.submit(self._compile, project)
+
+            failed_folders = [project for project, sushi_run in sushi_runs.items() if not sushi_run.result()]
+
+        if self._worker is not None:
+            self._worker.stop()
+
+        self.compiled_folders = list(sushi_runs)
+        return failed_folders
+
+    def _convert_and_write(self, xlsForm: XLS_Form) -> list:
+        """Converts and writes a single form. Returns its question codes, or an empty list if it failed."""
+        try:
+            fsh_lines, question_codes = fsh.convert_xlsform(xlsForm, self.memory_monitor, self.id_registries, self.lpds_question_reference,
+                                                         self.compact_valueset_threshold)
+        except Exception as e:
+            self.failure_report.add_failure('convert', xlsForm.input_path, e)
+            return []
+
+        with measure_memory(self.memory_monitor, 'write', xlsForm.file_name):
+            fw.write_fsh_files([fsh_lines], self.output_folder, self.lpds_healthboard_abbreviation_dict, self.failure_report,
+                               {xlsForm.file_name: xlsForm.input_path}, self.replace_existing, self.previous_output)
+        return question_codes
+
+    def _compile(self, project: Path) -> bool:
+        if not self.use_sushi_worker:
+            return sushi.run_sushi_project(project, run_report=self.run_report)[0]
+
+        # Only one SUSHI thread exists in worker mode, the lock guards the lazy start
+        with self._worker_lock:
+            if not self._worker_started:
+                self._worker = sushi.start_sushi_worker()
+                self._worker_started = True
+            succeeded, self._worker = sushi.run_sushi_project(project, self._worker, self.run_report)
+        return succeeded
@@ -0,0 +1,117 @@
+import logging, re
+from pathlib import Path
+from typing import List
+from src.form_readers import read_form_settings
+from src.constants import DSCN_SUBFOLDER, LPDS_SUBFOLDER
+
+class Build_selection:
+
+    def __init__(self, lpds_healthboard_abbreviation_dict: dict, boards: List[str] = None, dscn_only: bool = False, forms: List[str] = None):
+        """
+        The projects and forms selected for a selective build with --board, --dscn-only and --form.
+
+        Health boards are compared by their canonical URL, so aliases such as 7A6 and ABU select the
+        same health board. The project folders of all its aliases are rebuilt.
+
+        Args:
+            lpds_healthboard_abbreviation_dict (dict): Health board abbreviations and their canonical URLs.
+            boards (List[str], optional): The selected health board abbreviations.
+            dscn_only (bool): Select DSCN. Combined with boards, DSCN and these boards are selected.
+            forms (List[str], optional): The selected form short names. Without boards or dscn_only, forms of all projects can be selected.
+
+        Raises:
+            ValueError: If a health board abbreviation is unknown.
+        """
+        self.lpds_healthboard_abbreviation_dict = lpds_healthboard_abbreviation_dict
+        self.forms = {format_short_name(form) for form in forms} if forms else None
+        self.dscn = dscn_only or not boards
+        self.board_urls = None
+
+        if boards:
+            unknown = [board for board in boards if board not in lpds_healthboard_abbreviation_dict]
+            if unknown:
+                raise ValueError(f"Unknown health board abbreviations: {', '.join(unknown)}. Valid abbreviations are: {', '.join(lpds_healthboard_abbreviation_dict.keys())}.")
+            self.board_urls = {lpds_healthboard_abbreviation_dict[board] for board in boards}
+        elif dscn_only:
+            self.board_urls = set()
+
+    def includes_project(self, lpds_healthboard_abbreviation: str = None) -> bool:
+        """Returns whether the DSCN project (None) or the project of a health board is selected."""
+        if lpds_healthboard_abbreviation is None:
+            return self.dscn
+        if self.board_urls is None:
+            return True
+        return self.lpds_healthboard_abbreviation_dict.get(lpds_healthboard_abbreviation) in self.board_urls
+
+    def includes_form(self, short_name: str, lpds_healthboard_abbreviation: str = None) -> bool:
+        if not self.includes_project(lpds_healthboard_abbreviation):
+            return False
+        return self.forms is None or format_short_name(short_name) in self.forms
+
+    def includes_project_folder(self, generation_folder, project_folder) -> bool:
+        """Returns whether a DSCN or LPDS health board project folder belongs to the selection."""
+        relative_parts = Path(project_folder).relative_to(generation_folder).parts
+        if relative_parts == (DSCN_SUBFOLDER,):
+            return self.includes_project(None)
+        return relative_parts[0] == LPDS_SUBFOLDER and self.includes_project(relative_parts[-1])
+
+    def filter_xlsform_files(self, xls_files: List[str]) -> List[str]:
+        """
+        Returns the XLSForm files of the selected forms, reading only their settings sheet.
+        Files whose settings cannot be read are kept, so their errors are reported when they are loaded.
+        """
+        selected = []
+        for xls_file in xls_files:
+            try:
+                short_name, lpds_healthboard_abbreviation = read_xlsform_selection_settings(xls_file)
+            except Exception as e:
+                logging.warning(f'Could not read the settings of {xls_file} to select it: {str(e)}. Loading it anyway.')
+                selected.append(xls_file)
+                continue
+            if self.includes_form(short_name, lpds_healthboard_abbreviation):
+                selected.append(xls_file)
+        return selected
+
+    def includes_md_entry(self, md_entry: dict) -> bool:
+        """Returns whether a form in the overview of a previous run belongs to the selection."""
+        return self.includes_form(md_entry['short_name'], md_entry.get('lpds_healthboard_abbreviation'))
+
+    def get_selected_fsh_files(self, generation_folder) -> List[Path]:
+        """
+        Returns the FSH files of the selection in a generation seeded from the previous output. They are removed
+        before the selection is written, so forms that are no longer in the input folder disappear. Without --form,
+        these are all FSH files of the selected projects. With --form, only the files of the selected forms.
+        """
+        generation_folder = Path(generation_folder)
+        project_folders = [generation_folder / DSCN_SUBFOLDER] + sorted((generation_folder / LPDS_SUBFOLDER).glob('*'))
+
+        selected = []
+        for project_folder in project_folders:
+            if not (project_folder / 'input' / 'fsh').is_dir() or not self.includes_project_folder(generation_folder, project_folder):
+                continue
+            for fsh_file in sorted((project_folder / 'input' / 'fsh').rglob('*.fsh')):
+                if self.forms is None or any(re.fullmatch(re.escape(form) + r'-v[^-]+\.fsh', fsh_file.name) for form in self.forms):
+                    selected.append(fsh_file)
+        return selected
+
+def format_short_name(short_name: str) -> str:
+    """Formats a short name like XLS_Form does for tool_short_form."""
+    return str(short_name).strip().replace(" ", "-").replace("_", "-")
+
+def read_xlsform_selection_settings(xls_file: str) -> tuple:
+    """
+    Reads only the settings sheet of an XLSForm or another form definition.
+
+    Returns:
+        tuple: The short name and the LPDS health board abbreviation (None for DSCN forms).
+    """
+    df_settings = read_form_settings(xls_file)
+    short_name = df_settings['tool_short_form'].values[0]
+
+    lpds_healthboard_abbreviation = None
+    if 'lpds_healthboard_abbreviation' in df_settings:
+        value = df_settings['lpds_healthboard_abbreviation'].values[0]
+        if value is not None and str(value).strip() != '':
+            lpds_healthboard_abbreviation = str(value).strip()
+
+    return short_name, lpds_healthboard_abbreviation
@@ -0,0 +1,130 @@
+from datetime import datetime
+from typing import Iterable, List
+import src.file_writer as fw
+import src.xlsform_processor as xls
+import src.xlsform_to_fsh_converter as fsh
+from src.failure_report import Failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from src.memory_monitor import Memory_monitor, measure_memory
+from src.output_sinks import Output_sink
+from src.models.XLS_Form import XLS_Form
+from src.constants import CHECKPOINT_STAGES
+
+class Build_steps:
+
+    def __init__(self, output_folder, lpds_healthboard_abbreviation_dict: dict, failure_report: Failure_report, id_registries: Fhir_id_registries,
+                 memory_monitor: Memory_monitor = None, sink: Output_sink = None, previous_output=None, replace_existing: bool = False,
+                 version_date: datetime = None, lpds_question_reference: bool = False, compact_valueset_threshold: int = None):
+        """
+        The convert and write steps of a run, with the settings they share. The state that is carried across
+        steps and checkpoints, such as the forms per project and the question codes of earlier runs, is passed in.
+
+        Args:
+            output_folder: The output generation the FSH files are written to.
+            lpds_healthboard_abbreviation_dict (dict): Health board abbreviations and their canonical URLs.
+            failure_report (Failure_report): Collects the forms that fail.
+            id_registries (Fhir_id_registries): The FHIR ids per project, to detect collisions.
+            memory_monitor (Memory_monitor, optional): Measures memory per form.
+            sink (Output_sink, optional): Where the files are written. Defaults to the output generation on disk.
+            previous_output (optional): The previous output generation, unchanged external choice lists are reused from it.
+            replace_existing (bool): Rewrite the FSH files of forms that are already in the output generation.
+            version_date (datetime, optional): Fixed ^version date of the QuestionReferenceCS.
+            lpds_question_reference (bool): Also write a QuestionReference CodeSystem per LPDS health board.
+            compact_valueset_threshold (int, optional): Lists with at least this many choices get ValueSets that include their whole CodeSystem.
+        """
+        self.output_folder = output_folder
+        self.lpds_healthboard_abbreviation_dict = lpds_healthboard_abbreviation_dict
+        self.failure_report = failure_report
+        self.id_registries = id_registries
+        self.memory_monitor = memory_monitor
+        self.sink = sink
+        self.previous_output = previous_output
+        self.replace_existing = replace_existing
+        self.version_date = version_date
+        self.lpds_question_reference = lpds_question_reference
+        self.compact_valueset_threshold = compact_valueset_threshold
+        self.flushed_fsh_lines = 0
+
+    def record_project_form(self, project_forms: dict, xlsForm: XLS_Form) -> None:
+        """Remembers which forms belong to which SUSHI project folder, to report the forms of projects that fail in SUSHI."""
+        project_folder = fw.get_project_folder(self.output_folder, xlsForm.lpds_healthboard_abbreviation)
+        project_forms.setdefault(project_folder, []).append(xlsForm.input_path)
+
+    def write_fsh_lines(self, fsh_lines_list: list, input_paths: dict = None) -> None:
+        """Writes converted FSH lines to the project folders."""
+        fw.write_fsh_files(fsh_lines_list, self.output_folder, self.lpds_healthboard_abbreviation_dict, self.failure_report, input_paths,
+                           self.replace_existing, self.previous_output, self.sink)
+
+    def flush_fsh_lines(self, fsh_lines_list: list, input_paths: dict = None) -> None:
+        """Writes FSH lines that are released during the conversion because memory use exceeded the budget, see convert_to_fsh."""
+        with measure_memory(self.memory_monitor, 'write'):
+            self.write_fsh_lines(fsh_lines_list, input_paths)
+        self.flushed_fsh_lines += len(fsh_lines_list)
+
+    def convert_and_write_one_at_a_time(self, xlsforms: Iterable[XLS_Form], project_forms: dict, previous_md_entries: list = None,
+                                        previous_question_codes_DSCN: list = None, include_question_reference: bool = True,
+                                        previous_question_codes_LPDS: dict = None) -> str:
+        """
+        Parses, converts and writes the forms one at a time, so only a single form and its FSH lines are held in memory.
+        Only the question codes and the overview entries are collected across forms.
+
+        Args:
+            xlsforms (Iterable[XLS_Form]): The forms, e.g. a generator that reads them one by one.
+            project_forms (dict): The forms per project folder, the forms are added to it.
+            previous_md_entries (list, optional): Overview entries of forms that are not converted in this run.
+            previous_question_codes_DSCN (list, optional): Question codes of DSCN forms that are not converted in this run.
+            include_question_reference (bool): Whether to write the QuestionReferenceCS.
+            previous_question_codes_LPDS (dict, optional): Question codes by health board of LPDS forms that are not converted in this run.
+
+        Returns:
+            str: The overview of the processed forms.
+        """
+        md_entries = list(previous_md_entries or [])
+        question_codes_DSCN = list(previous_question_codes_DSCN or [])
+        question_codes_LPDS = {board: list(codes) for board, codes in (previous_question_codes_LPDS or {}).items()}
+
+        for xlsForm in xlsforms:
+            try:
+                md_entry = xls.create_md_entry(xlsForm)
+            except Exception as e:
+                self.failure_report.add_failure('load', xlsForm.input_path, e)
+                continue
+            md_entries.append(md_entry)
+            self.failure_report.add_processed_form(xlsForm.input_path, md_entry)
+            self.record_project_form(project_forms, xlsForm)
+
+            try:
+                fsh_lines, question_codes = fsh.convert_xlsform(xlsForm, self.memory_monitor, self.id_registries, self.lpds_question_reference,
+                                                                self.compact_valueset_threshold)
+            except Exception as e:
+                self.failure_report.add_failure('convert', xlsForm.input_path, e)
+                continue
+            if xlsForm.lpds_healthboard_abbreviation is None:
+                question_codes_DSCN.extend(question_codes)
+            elif self.lpds_question_reference:
+                question_codes_LPDS.setdefault(xlsForm.lpds_healthboard_abbreviation, []).extend(question_codes)
+
+            with measure_memory(self.memory_monitor, 'write', xlsForm.file_name):
+                self.write_fsh_lines([fsh_lines], {xlsForm.file_name: xlsForm.input_path})
+
+        if include_question_reference:
+            self.write_fsh_lines([fsh.create_question_reference_codesystem_fsh_lines(question_codes_DSCN, self.version_date)])
+        if self.lpds_question_reference:
+            self.write_fsh_lines(fsh.create_lpds_question_reference_codesystems_fsh_lines(question_codes_LPDS, self.version_date))
+        return xls.create_processed_xlsforms_md_overview(md_entries)
+
+def release_xlsforms(xlsforms: List[XLS_Form]):
+    """Yields the forms while removing them from the list, so each form can be freed once it has been written."""
+    while xlsforms:
+        yield xlsforms.pop(0)
+
+def get_checkpoint_data(failure_report: Failure_report, id_registries: Fhir_id_registries, md_overview, project_forms: dict, cleared_project_folders: set,
+                        previous_question_codes_DSCN: list, previous_question_codes_LPDS: dict, **stage_outputs) -> dict:
+    """Returns the state every stage checkpoint holds, together with the outputs of the stage."""
+    return dict(failure_report=failure_report.get_state(), id_registries=id_registries.get_state(), md_overview=md_overview, project_forms=project_forms,
+                cleared_project_folders=cleared_project_folders, previous_question_codes_DSCN=previous_question_codes_DSCN,
+                previous_question_codes_LPDS=previous_question_codes_LPDS, **stage_outputs)
+
+def should_run_stage(stage: str, resume_stage: str = None) -> bool:
+    """Returns whether a stage runs, or was completed before a resumed run was interrupted."""
+    return resume_stage is None or CHECKPOINT_STAGES.index(stage) >= CHECKPOINT_STAGES.index(resume_stage)
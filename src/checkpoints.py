@@ -0,0 +1,206 @@
+import hashlib, json, logging, os, pickle, shutil
+from pathlib import Path
+from typing import List
+from src.constants import (
+    CHECKPOINT_FOLDER,
+    CHECKPOINT_MANIFEST_FILE_NAME,
+    CHECKPOINT_STAGES,
+    GENERATIONS_SUBFOLDER,
+    GENERATION_COMPLETE_MARKER
+)
+
+# The code of the tool is part of the fingerprint, a checkpoint written by another version is never reused
+TOOL_FOLDER = Path(__file__).resolve().parent.parent
+TOOL_CODE_PATTERNS = ['main.py', 'src/**/*.py', 'src/**/*.js']
+
+class Checkpoint_error(Exception):
+    pass
+
+class Checkpoints:
+
+    def __init__(self, generation_folder, fingerprint: str):
+        """
+        The checkpoints of a run, stored in the `.checkpoints` folder of its output generation.
+
+        The load, convert and write stages each store their outputs, together with the failures recorded so far,
+        as a pickle. The outputs are kept small: the load stage lists the parsed forms by their input files instead
+        of storing their DataFrames, and a resumed run reads them again. SUSHI is checkpointed per project: a project is recorded with a digest of its FSH files once
+        SUSHI succeeded for it. The manifest holds the sha256 of every pickle and the fingerprint of the inputs
+        the run started from, so a checkpoint is only reused for the same inputs, options and tool version.
+
+        Args:
+            generation_folder: The output generation of the run.
+            fingerprint (str): The fingerprint of the inputs, see get_input_fingerprint.
+        """
+        self.generation_folder = Path(generation_folder)
+        self.folder = self.generation_folder / CHECKPOINT_FOLDER
+        self.manifest = {'fingerprint': fingerprint, 'stages': {}, 'sushi_projects': {}}
+
+    @classmethod
+    def create(cls, generation_folder, fingerprint: str) -> 'Checkpoints':
+        checkpoints = cls(generation_folder, fingerprint)
+        checkpoints.folder.mkdir(parents=True, exist_ok=True)
+        checkpoints._write_manifest()
+        return checkpoints
+
+    @classmethod
+    def open(cls, generation_folder) -> 'Checkpoints':
+        """Opens the checkpoints of a generation, or returns None if it has none or its manifest cannot be read."""
+        manifest_path = Path(generation_folder) / CHECKPOINT_FOLDER / CHECKPOINT_MANIFEST_FILE_NAME
+        if not manifest_path.exists():
+            return None
+        try:
+            with open(manifest_path, encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Cannot read the checkpoint manifest of {generation_folder}: {e}')
+            return None
+        if not isinstance(manifest, dict) or not {'fingerprint', 'stages', 'sushi_projects'} <= manifest.keys():
+            logging.warning(f'The checkpoint manifest of {generation_folder} is incomplete.')
+            return None
+        checkpoints = cls(generation_folder, manifest['fingerprint'])
+        checkpoints.manifest = manifest
+        return checkpoints
+
+    def get_completed_stages(self) -> List[str]:
+        return [stage for stage in CHECKPOINT_STAGES if stage in self.manifest['stages']]
+
+    def get_resume_stage(self, from_stage: str = None) -> str:
+        """
+        Returns the stage a resumed run starts at: `from_stage`, or the stage after the last completed stage.
+
+        Raises:
+            Checkpoint_error: If the checkpoint of the stage before it is missing.
+        """
+        if from_stage is None:
+            completed = [stage for stage in self.get_completed_stages() if stage != CHECKPOINT_STAGES[-1]]
+            if not completed:
+                raise Checkpoint_error(f'No stage of {self.generation_folder} was completed, there is nothing to resume.')
+            return CHECKPOINT_STAGES[CHECKPOINT_STAGES.index(completed[-1]) + 1]
+
+        previous_stage = CHECKPOINT_STAGES[CHECKPOINT_STAGES.index(from_stage) - 1]
+        if previous_stage not in self.manifest['stages']:
+            raise Checkpoint_error(f'{self.generation_folder} has no checkpoint of the {previous_stage} stage, cannot start from the {from_stage} stage.')
+        return from_stage
+
+    def save_stage(self, stage: str, data: dict) -> None:
+        """Stores the outputs of a completed stage. The checkpoints of the later stages are stale from then on."""
+        checkpoint_path = self.folder / f'{stage}.pickle'
+        temporary_path = checkpoint_path.with_suffix('.tmp')
+        with open(temporary_path, 'wb') as checkpoint_file:
+            pickle.dump(data, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, checkpoint_path)
+
+        for later_stage in CHECKPOINT_STAGES[CHECKPOINT_STAGES.index(stage) + 1:]:
+            self.manifest['stages'].pop(later_stage, None)
+        self.manifest['sushi_projects'] = {}
+        self.manifest['stages'][stage] = get_file_digest(checkpoint_path)
+        self._write_manifest()
+        logging.info(f'Saved the {stage} checkpoint of {self.generation_folder}')
+
+    def load_stage(self, stage: str) -> dict:
+        """
+        Loads the outputs of a completed stage.
+
+        Raises:
+            Checkpoint_error: If the checkpoint is missing or does not match the digest in the manifest.
+        """
+        checkpoint_path = self.folder / f'{stage}.pickle'
+        if stage not in self.manifest['stages'] or not checkpoint_path.exists():
+            raise Checkpoint_error(f'The {stage} checkpoint of {self.generation_folder} is missing.')
+        if get_file_digest(checkpoint_path) != self.manifest['stages'][stage]:
+            raise Checkpoint_error(f'The {stage} checkpoint of {self.generation_folder} is damaged.')
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            return pickle.load(checkpoint_file)
+
+    def record_sushi_project(self, project_folder) -> None:
+        """Records that SUSHI succeeded for a project, for the FSH files it currently has."""
+        self.manifest['sushi_projects'][self._get_project_key(project_folder)] = get_project_digest(project_folder)
+        self._write_manifest()
+
+    def record_sushi_result(self, project_folder, succeeded: bool) -> None:
+        """Records a project SUSHI succeeded for, as the `on_project_done` callback of the SUSHI runner."""
+        if succeeded:
+            self.record_sushi_project(project_folder)
+
+    def is_sushi_project_done(self, project_folder) -> bool:
+        """Returns whether SUSHI already succeeded for the project, and its FSH files did not change since."""
+        recorded_digest = self.manifest['sushi_projects'].get(self._get_project_key(project_folder))
+        return recorded_digest is not None and (Path(project_folder) / 'fsh-generated').is_dir() and recorded_digest == get_project_digest(project_folder)
+
+    def remove(self) -> None:
+        """Removes the checkpoints once the run completed, they are not published with the generation."""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _get_project_key(self, project_folder) -> str:
+        return Path(project_folder).relative_to(self.generation_folder).as_posix()
+
+    def _write_manifest(self) -> None:
+        manifest_path = self.folder / CHECKPOINT_MANIFEST_FILE_NAME
+        temporary_path = manifest_path.with_suffix('.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+        os.replace(temporary_path, manifest_path)
+
+def is_resumable(generation_folder) -> bool:
+    """Returns whether a generation is an incomplete run with at least one completed stage, i.e. a run --resume can continue."""
+    if (Path(generation_folder) / GENERATION_COMPLETE_MARKER).exists():
+        return False
+    checkpoints = Checkpoints.open(generation_folder)
+    return checkpoints is not None and bool(checkpoints.get_completed_stages())
+
+def find_resumable_checkpoints(output_folder: str, fingerprint: str) -> Checkpoints:
+    """
+    Returns the checkpoints of the most recent incomplete run, if it started from the same inputs. Runs that completed
+    later, e.g. with a different output sink, do not hide it.
+
+    Raises:
+        Checkpoint_error: If there is no incomplete run to resume, or its inputs changed since.
+    """
+    generations_folder = Path(output_folder) / GENERATIONS_SUBFOLDER
+    generations = []
+    if generations_folder.is_dir():
+        # Output moved aside by activate_generation is not a generation of a run
+        generations = sorted((f for f in generations_folder.iterdir() if f.is_dir() and not f.name.startswith('retired-')), key=lambda f: f.name, reverse=True)
+    resumable_generation = next((generation for generation in generations if is_resumable(generation)), None)
+    if resumable_generation is None:
+        raise Checkpoint_error('There is no interrupted run with checkpoints to resume.')
+
+    checkpoints = Checkpoints.open(resumable_generation)
+    if checkpoints.manifest['fingerprint'] != fingerprint:
+        raise Checkpoint_error(f'The input files, options or tool version changed since the checkpoints of {resumable_generation} were written.')
+    return checkpoints
+
+def get_input_fingerprint(xls_files: List[str], options: dict) -> str:
+    """
+    Returns a sha256 fingerprint of everything the output of a run depends on: the content of the input files,
+    the options that change the output and the code of the tool.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+    for xls_file in sorted(xls_files):
+        # A .csvform input is a folder of CSV files
+        input_files = sorted(f for f in Path(xls_file).rglob('*') if f.is_file()) if os.path.isdir(xls_file) else [Path(xls_file)]
+        for input_file in input_files:
+            digest.update(f'\0{input_file.as_posix()}\0{get_file_digest(input_file)}'.encode('utf-8'))
+    for pattern in TOOL_CODE_PATTERNS:
+        for code_file in sorted(TOOL_FOLDER.glob(pattern)):
+            digest.update(f'\0{code_file.relative_to(TOOL_FOLDER).as_posix()}\0{get_file_digest(code_file)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_project_digest(project_folder) -> str:
+    """Returns a sha256 digest of the SUSHI inputs of a project: its sushi-config.yaml and input folder."""
+    project_folder = Path(project_folder)
+    digest = hashlib.sha256()
+    input_files = [project_folder / 'sushi-config.yaml'] + sorted(f for f in (project_folder / 'input').rglob('*') if f.is_file())
+    for input_file in input_files:
+        if input_file.exists():
+            digest.update(f'\0{input_file.relative_to(project_folder).as_posix()}\0{get_file_digest(input_file)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_file_digest(file_path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
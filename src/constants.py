@@ -6,6 +6,72 @@ INPUT_FOLDER = 'input/'
 OUTPUT_FOLDER = 'output/'
 DSCN_SUBFOLDER = "DSCN"
 LPDS_SUBFOLDER = "LPDS"
+OVERVIEW_FILE_NAME = "Overview of processed XLSForms.md"
+
+# Output generations
+GENERATIONS_SUBFOLDER = "generations"
+CURRENT_GENERATION_LINK = "current"
+GENERATION_COMPLETE_MARKER = ".complete"
+GENERATION_LOCK_FILE = ".lock"  # held by the run writing the generation
+GENERATION_LOCK_MAX_AGE = 24 * 60 * 60  # seconds after which the lock of a run on another host is stale
+GENERATIONS_TO_KEEP = 2
+
+# Output sinks, the archives are written next to the generations
+OUTPUT_SINKS = ['filesystem', 'zip', 'tar']
+OUTPUT_ARCHIVE_EXTENSIONS = {'zip': '.zip', 'tar': '.tar.gz'}
+
+# Failure report
+FAILURE_REPORT_FILE_NAME = "failure_report.json"
+
+# Memory accounting
+MEMORY_REPORT_FILE_NAME = "memory_report.json"
+MEMORY_SAMPLING_INTERVAL = 0.05  # seconds between RSS samples
+# Ratio between the memory a loaded form takes and the size of its .xlsx file. The budget estimates only assume it until
+# the first forms of a run are loaded, from then on the ratio measured on them is used, see Memory_monitor.get_expansion_factor.
+# .xlsx files are zip compressed and every cell becomes a Python string in a DataFrame, small forms measure 40 to 60.
+XLSX_MEMORY_EXPANSION_FACTOR = 40
+
+# Checkpoints
+CHECKPOINT_FOLDER = ".checkpoints"
+CHECKPOINT_MANIFEST_FILE_NAME = "manifest.json"
+CHECKPOINT_STAGES = ['load', 'convert', 'write', 'sushi']
+
+# SUSHI run report
+SUSHI_RUN_REPORT_FILE_NAME = "sushi_run_report.jsonl"
+SUSHI_REPORT_MAX_MESSAGES = 50  # error and warning messages kept per project
+SUSHI_WORKER_TIMEOUT = 600  # seconds to wait for the SUSHI worker to start or to compile a project
+
+# Input prefetching
+INPUT_PREFETCH_DEPTH = 4  # forms read ahead while the current one is parsed
+INPUT_PREFETCH_MAX_BYTES = 256 * 1024 * 1024
+INPUT_PREFETCH_THREADS = 2
+
+# Pipelined builds
+PIPELINE_MAX_SUSHI_PROCESSES = 4
+
+# External choice lists (select_one_from_file, select_one_external)
+EXTERNAL_CHOICES_FILE_NAME = "itemsets.csv"
+EXTERNAL_CHOICES_HEADER_PREFIX = "// External choices: "
+
+# LPDS QuestionReference CodeSystems
+LPDS_QUESTION_REFERENCE_FILE_NAME = "LPDSQuestionReferenceCS.fsh"
+
+# FHIR packages
+FHIR_PACKAGE_FOLDER = "package"
+FHIR_PACKAGE_NAME_PREFIX = "nhs.wales.psom"
+
+# Publishing to a FHIR server
+PUBLISH_STATE_FILE_NAME = "publish_state.json"
+PUBLISH_BATCH_SIZE = 50
+PUBLISH_MAX_CONNECTIONS = 4
+PUBLISH_MAX_RETRIES = 5
+PUBLISH_RETRY_BACKOFF = 0.5  # seconds, doubled after every attempt
+PUBLISH_TIMEOUT = 60  # seconds
+
+# FHIR ids
+FHIR_ID_MAX_LENGTH = 64
+FHIR_ID_REGISTRY_FILE_NAME = ".fhir_ids.json"  # the ids of a generation, so runs that only rebuild some forms check against the others
+
 # FHIR Status
 FHIR_STATUS_DRAFT = "#draft"
 
@@ -15,7 +81,7 @@ DSCN_PREFIX = "DataStandardsWales"
 
 # URLs
 QUESTION_REFERENCE_CS_URL_DSCN = "https://fhir.nhs.wales/CodeSystem/QuestionReferenceCS"
-QUESTION_REFERENCE_CS_URL_LPDS = "https://fhir.nhs.wales/CodeSystem/LPDSQuestionReferenceCS" ## Currently not in use.
+QUESTION_REFERENCE_CS_URL_LPDS = "https://fhir.nhs.wales/CodeSystem/LPDSQuestionReferenceCS" ## For health boards without a canonical URL
 NHS_WALES_BASE_URL = "https://fhir.nhs.wales"
 
 # LPDS Health Board Abbreviation to URL Mapping
@@ -38,9 +104,17 @@ LPDS_HEALTHBOARD_ABBREVIATION_DICT = {
     "RQF": "https://fhir.vunhst.nhs.wales"
 }
 
+# Languages of label::<language> columns, e.g. label::Welsh. A code in brackets, e.g. label::Welsh (cy), takes precedence
+LANGUAGE_CODES = {
+    'english': 'en',
+    'welsh': 'cy',
+    'cymraeg': 'cy',
+}
+
 # Extension URLs
 ENTRY_FORMAT_EXTENSION_URL = "http://hl7.org/fhir/StructureDefinition/entryFormat"
 SECURITY_LABEL_EXTENSION_URL = "http://hl7.org/fhir/uv/security-label-ds4p/StructureDefinition/extension-inline-sec-label"
+TRANSLATION_EXTENSION_URL = "http://hl7.org/fhir/StructureDefinition/translation"
 SECURITY_LABEL_CODING_URL = "http://terminology.hl7.org/CodeSystem/v3-ActCode#PDS"
 
 # Publishers
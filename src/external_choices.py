@@ -0,0 +1,134 @@
+import csv, hashlib, logging, re
+from pathlib import Path
+import src.string_util as su
+import src.terminology_util as tu
+from src.output_sinks import Filesystem_sink, Output_sink
+from src.constants import EXTERNAL_CHOICES_FILE_NAME, EXTERNAL_CHOICES_HEADER_PREFIX
+
+# select_one_from_file <file>.csv, select_multiple_from_file <file>.csv and select_one_external <list_name>
+EXTERNAL_CHOICE_TYPE_PATTERN = re.compile(r'^select[_\s]*(?:one|multiple)[_\s]*(from[_\s]*file|external)\s+(\S+)$', re.IGNORECASE)
+LABEL_LANGUAGE_PATTERN = re.compile(r'^label::\s*(.*?)\s*$')
+
+def parse_external_choice_type(field_type) -> tuple:
+    """
+    Parses a survey type that takes its choices from a CSV file instead of the choices sheet.
+
+    `select_one_from_file medications.csv` takes all rows of medications.csv, next to the form. `select_one_external postcodes`
+    takes the rows of the postcodes list from itemsets.csv, the CSV file the external_choices sheet is exported to.
+
+    Returns:
+        tuple: The list name, the CSV file name and the list_name the rows are filtered on (None for the whole file),
+            or None for other types.
+
+    Raises:
+        ValueError: If a select_one_from_file file is not a CSV file.
+    """
+    match = EXTERNAL_CHOICE_TYPE_PATTERN.match(str(field_type).strip())
+    if not match:
+        return None
+    if match.group(1).lower().startswith('from'):
+        file_name = match.group(2)
+        if Path(file_name).suffix.lower() != '.csv':
+            raise ValueError(f"Choices of '{field_type}' must be in a CSV file.")
+        return Path(file_name).stem, file_name, None
+    return match.group(2), EXTERNAL_CHOICES_FILE_NAME, match.group(2)
+
+class External_choice_list:
+
+    def __init__(self, source_path, list_filter: str, file_name: str, cs_lines: list, vs_lines: list, parse_language_code):
+        """
+        A CodeSystem and ValueSet whose codes are streamed from a CSV file of external choices when the FSH files are
+        written, so lists with thousands of entries are never loaded into a DataFrame or held as FSH lines.
+
+        Only the header row of the CSV file is read here. The sha256 of the file, the list filter and the generated
+        header lines is written as the first line of the FSH file, so an unchanged list is reused from a previous
+        output instead of being streamed again, see write_to_folder.
+
+        Args:
+            source_path: The CSV file, with a name and a label or label::<language> columns, and a list_name column for itemsets.csv.
+            list_filter (str): The list_name of the rows to use, None for all rows.
+            file_name (str): The name of the FSH file.
+            cs_lines (list): The header lines of the CodeSystem, the codes follow them.
+            vs_lines (list): The lines of the ValueSet, which includes all codes of the CodeSystem.
+            parse_language_code (callable): Returns the language code of a label::<language> column, see XLS_Form.parse_language_code.
+
+        Raises:
+            ValueError: If the CSV file has no name column or no label column.
+        """
+        self.source_path = str(source_path)
+        self.list_filter = list_filter
+        self.file_name = file_name
+        self.cs_lines = cs_lines
+        self.vs_lines = vs_lines
+
+        with open(self.source_path, encoding='utf-8-sig', newline='') as source_file:
+            columns = [column.strip() for column in next(csv.reader(source_file), [])]
+        if 'name' not in columns or (list_filter is not None and 'list_name' not in columns):
+            raise ValueError(f"{self.source_path} has no {'name' if 'name' not in columns else 'list_name'} column.")
+
+        language_columns = []
+        for column in columns:
+            match = LABEL_LANGUAGE_PATTERN.match(column)
+            if match:
+                language = parse_language_code(match.group(1))
+                if language is not None:
+                    language_columns.append((column, language))
+        if 'label' not in columns and not language_columns:
+            raise ValueError(f'{self.source_path} has no label column.')
+        self.label_column = 'label' if 'label' in columns else language_columns[0][0]
+        self.translation_columns = [(column, language) for column, language in language_columns if column != self.label_column]
+
+        self.header = f'{EXTERNAL_CHOICES_HEADER_PREFIX}{Path(self.source_path).name}{f" ({list_filter})" if list_filter else ""}, sha256 {self._get_digest()}'
+
+    def iterate_lines(self):
+        """Yields the FSH lines of the CodeSystem and ValueSet, reading the CSV file one row at a time."""
+        yield self.header
+        yield from self.cs_lines
+        with open(self.source_path, encoding='utf-8-sig', newline='') as source_file:
+            for row in csv.DictReader(source_file):
+                row = {str(column).strip(): (value or '').strip() for column, value in row.items() if column is not None}
+                if not row.get('name') or (self.list_filter is not None and row.get('list_name') != self.list_filter):
+                    continue
+                yield f'* #{row["name"]} "{su.escape_quotes(row.get(self.label_column, ""))}"'
+                # Labels in other languages are designations of the code
+                yield from tu.get_designation_lines([(language, su.escape_quotes(row[column])) for column, language in self.translation_columns if row.get(column)])
+        yield ''
+        yield from self.vs_lines
+
+    def write_to_folder(self, folder, previous_folder=None, sink: Output_sink = None) -> bool:
+        """
+        Writes the FSH file to a terminology folder. A file that already exists with the same first line, e.g. in a
+        generation seeded from the previous output, is kept. Otherwise the file of `previous_folder` is reused if it
+        has the same first line, and else the codes are streamed from the CSV file. The file is written to `sink`,
+        by default the folder on disk.
+
+        Returns:
+            bool: Whether an existing file was kept or reused.
+        """
+        sink = sink if sink is not None else Filesystem_sink(folder)
+        fsh_path = Path(folder) / self.file_name
+        if sink.read_first_line(fsh_path) == self.header:
+            logging.info(f'{fsh_path} is unchanged, keeping it')
+            return True
+
+        # The previous output is always on disk
+        previous_path = Path(previous_folder) / self.file_name if previous_folder is not None else None
+        if previous_path is not None and Filesystem_sink(previous_folder).read_first_line(previous_path) == self.header:
+            sink.copy_from(previous_path, fsh_path)
+            logging.info(f'{self.file_name} is unchanged, reused it from {previous_folder}')
+            return True
+
+        with sink.open_for_writing(fsh_path, 'w') as fsh_file:
+            for line in self.iterate_lines():
+                fsh_file.write(line + '\n')
+        logging.info(f'Streamed {self.source_path} to {fsh_path}')
+        return False
+
+    def _get_digest(self) -> str:
+        digest = hashlib.sha256()
+        with open(self.source_path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        # The generated lines change with the list filter, the ids, the version and the other metadata of the form
+        digest.update('\0'.join([str(self.list_filter)] + self.cs_lines + self.vs_lines).encode('utf-8'))
+        return digest.hexdigest()
@@ -0,0 +1,91 @@
+import json, logging, os, traceback
+from datetime import datetime
+from typing import List
+
+class Failure_report:
+
+    def __init__(self, generation_folder):
+        """
+        Collects the failures of a run per form and stage (load, convert, write, preflight, sushi, package), so one
+        broken form does not abort the whole batch. The report is written as JSON at the end of
+        the run and is the input for --retry-failed.
+
+        Args:
+            generation_folder: The output generation the run writes into.
+        """
+        self.generation_folder = str(generation_folder)
+        self.failures = []
+        self.processed_forms = {}
+
+    def add_failure(self, stage: str, form: str, error: Exception, project: str = None, forms: List[str] = None) -> None:
+        """
+        Records a failure. Call from inside the except block, so the traceback is included.
+
+        Args:
+            stage (str): The stage that failed: load, convert, write, preflight, sushi or package.
+            form (str): The input path of the failed form, None for project level failures.
+            error (Exception): The error.
+            project (str, optional): The project folder the failure belongs to.
+            forms (List[str], optional): For project level failures, the input paths of the forms in the project.
+        """
+        self.failures.append({
+            'stage': stage,
+            'form': form,
+            'project': project,
+            'forms': forms if forms is not None else ([form] if form else []),
+            'error': str(error),
+            'traceback': traceback.format_exc() if isinstance(error, BaseException) else None,
+        })
+        self.processed_forms.pop(form, None)
+        for failed_form in forms or []:
+            self.processed_forms.pop(failed_form, None)
+
+        logging.error(f'{stage} failed for {form or project}: {str(error)}')
+
+    def add_processed_form(self, form: str, md_entry: dict) -> None:
+        """Records the overview entry of a form, so a retry can list it in the overview without reprocessing it."""
+        if form not in self.get_failed_forms():
+            self.processed_forms[form] = md_entry
+
+    def get_state(self) -> dict:
+        """Returns the failures and processed forms recorded so far, to store them in a checkpoint."""
+        return {'failures': self.failures, 'processed_forms': self.processed_forms}
+
+    def restore_state(self, state: dict) -> None:
+        """Continues from the failures and processed forms stored in a checkpoint."""
+        self.failures = list(state['failures'])
+        self.processed_forms = dict(state['processed_forms'])
+
+    def has_failures(self) -> bool:
+        return len(self.failures) > 0
+
+    def get_failed_forms(self) -> set:
+        return {form for failure in self.failures for form in failure['forms']}
+
+    def write(self, report_path: str) -> None:
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'generation': self.generation_folder,
+            'failed_forms': sorted(self.get_failed_forms()),
+            'failures': self.failures,
+            'processed_forms': self.processed_forms,
+        }
+        with open(report_path, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    def print_summary(self) -> None:
+        if not self.has_failures():
+            print('All forms and projects processed without failures.')
+            return
+
+        print(f'{len(self.failures)} failures in {len(self.get_failed_forms())} forms:')
+        for failure in self.failures:
+            print(f"- [{failure['stage']}] {failure['form'] or failure['project']}: {failure['error']}")
+        print('Rerun with --retry-failed to reprocess only the failed forms.')
+
+def load_failure_report(report_path: str) -> dict:
+    """Loads the failure report of the previous run, or returns None if there is none."""
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, encoding='utf-8') as report_file:
+        return json.load(report_file)
@@ -0,0 +1,179 @@
+import hashlib, json, logging
+from pathlib import Path
+from typing import Collection, List
+from src.output_sinks import open_for_writing
+from src.constants import DSCN_SUBFOLDER, FHIR_ID_MAX_LENGTH
+
+class Fhir_id_collision_error(ValueError):
+    pass
+
+class Fhir_id_registry:
+
+    def __init__(self, project: str, disambiguate: bool = False):
+        """
+        Registry of the FHIR ids generated for a single SUSHI project (DSCN or an LPDS health board).
+
+        Ids are memoized per source, e.g. a form's short name and list name, and every id is mapped
+        back to the source that produced it. Two different sources producing the same id, typically
+        after truncation to 64 characters, are detected in O(1) per insert.
+
+        Args:
+            project (str): The project the ids belong to, used in reports.
+            disambiguate (bool): Give colliding ids a deterministic suffix derived from their source
+                instead of only reporting them.
+        """
+        self.project = project
+        self.disambiguate = disambiguate
+        self.collisions = []
+        self._ids_by_source = {}
+        self._forms_by_source = {}
+        self._sources_by_id = {}
+
+    def register(self, resource_type: str, source: tuple, fhir_id: str, form: str = None) -> str:
+        """
+        Registers the id generated for a source and returns the id to use.
+
+        Args:
+            resource_type (str): The resource type, ids only have to be unique per type.
+            source (tuple): What the id was generated from, e.g. (form, short_name, list_name, lpds_healthboard_abbreviation).
+            fhir_id (str): The generated, FHIR compliant id.
+            form (str, optional): The form the source belongs to, used in reports.
+
+        Returns:
+            str: The registered id. This is the generated id, unless it collides and disambiguation is enabled.
+        """
+        source_key = (resource_type, source)
+        if source_key in self._ids_by_source:
+            return self._ids_by_source[source_key]
+
+        id_key = (resource_type, fhir_id)
+        if id_key in self._sources_by_id:
+            first_source, first_form = self._sources_by_id[id_key]
+            self.collisions.append({
+                'project': self.project,
+                'resource_type': resource_type,
+                'id': fhir_id,
+                'first_source': first_source,
+                'first_form': first_form,
+                'second_source': source,
+                'second_form': form,
+            })
+            if self.disambiguate:
+                fhir_id = self._disambiguate(resource_type, source, fhir_id)
+                id_key = (resource_type, fhir_id)
+
+        self._ids_by_source[source_key] = fhir_id
+        self._forms_by_source[source_key] = form
+        # A colliding id stays mapped to its first source
+        self._sources_by_id.setdefault(id_key, (source, form))
+        return fhir_id
+
+    def get_form_collisions(self, form: str) -> List[dict]:
+        """Returns the collisions in which the form produced the second id."""
+        return [collision for collision in self.collisions if collision['second_form'] == form]
+
+    def remove_form(self, form: str) -> None:
+        """Removes the ids of a form that is not written, e.g. because it failed, so they do not collide with other forms."""
+        for source_key in [source_key for source_key, source_form in self._forms_by_source.items() if source_form == form]:
+            resource_type, source = source_key
+            id_key = (resource_type, self._ids_by_source.pop(source_key))
+            del self._forms_by_source[source_key]
+            if self._sources_by_id.get(id_key) == (source, form):
+                del self._sources_by_id[id_key]
+
+    def get_state(self) -> List[list]:
+        """Returns the registered ids as JSON serializable [resource_type, source, id, form] entries."""
+        return [[resource_type, list(source), fhir_id, self._forms_by_source[(resource_type, source)]]
+                for (resource_type, source), fhir_id in self._ids_by_source.items()]
+
+    def restore_state(self, entries: List[list], exclude_forms: Collection[str] = ()) -> None:
+        """Registers the ids of get_state as they are, except the ids of `exclude_forms`, which are converted again."""
+        for resource_type, source, fhir_id, form in entries:
+            if form not in exclude_forms:
+                source_key = (resource_type, tuple(source))
+                self._ids_by_source[source_key] = fhir_id
+                self._forms_by_source[source_key] = form
+                self._sources_by_id.setdefault((resource_type, fhir_id), (tuple(source), form))
+
+    def _disambiguate(self, resource_type: str, source: tuple, fhir_id: str) -> str:
+        # The suffix only depends on the source, so the same inputs always produce the same id
+        digest = hashlib.sha1(repr((resource_type, source)).encode('utf-8')).hexdigest()
+        for length in range(8, len(digest) + 1):
+            suffix = '-' + digest[:length]
+            candidate = fhir_id[:FHIR_ID_MAX_LENGTH - len(suffix)] + suffix
+            if (resource_type, candidate) not in self._sources_by_id:
+                logging.warning(f'{self.project}: {resource_type} id {fhir_id} of {source} is already used, using {candidate} instead.')
+                return candidate
+        raise ValueError(f'{self.project}: could not find a unique {resource_type} id for {source}.')
+
+class Fhir_id_registries:
+
+    def __init__(self, disambiguate: bool = False):
+        """One Fhir_id_registry per SUSHI project, created on first use."""
+        self.disambiguate = disambiguate
+        self.registries = {}
+
+    def for_project(self, lpds_healthboard_abbreviation: str = None) -> Fhir_id_registry:
+        project = f'LPDS/{lpds_healthboard_abbreviation}' if lpds_healthboard_abbreviation else DSCN_SUBFOLDER
+        if project not in self.registries:
+            self.registries[project] = Fhir_id_registry(project, self.disambiguate)
+        return self.registries[project]
+
+    def get_collisions(self) -> list:
+        return [collision for registry in self.registries.values() for collision in registry.collisions]
+
+    def check_form(self, form: str, lpds_healthboard_abbreviation: str = None) -> None:
+        """
+        Raises Fhir_id_collision_error if a converted form produced ids that are already used in its project, unless they
+        were disambiguated. The ids of the form are removed again, the form must not be written since SUSHI would reject them.
+        """
+        if self.disambiguate:
+            return
+        registry = self.for_project(lpds_healthboard_abbreviation)
+        collisions = registry.get_form_collisions(form)
+        if collisions:
+            registry.remove_form(form)
+            raise Fhir_id_collision_error(' '.join(format_collision(collision) for collision in collisions) + ' Use --disambiguate-ids to make them unique.')
+
+    def report_collisions(self, failure_report=None) -> None:
+        """
+        Logs the id collisions that were disambiguated. The other collisions were recorded as conversion
+        failures of the second form by check_form, before its FSH files were written.
+        """
+        if self.disambiguate:
+            for collision in self.get_collisions():
+                logging.warning(format_collision(collision))
+
+    def get_state(self) -> dict:
+        """Returns the registered ids of all projects, for checkpoints and the output generation."""
+        return {project: registry.get_state() for project, registry in sorted(self.registries.items())}
+
+    def restore_state(self, state: dict, exclude_forms: Collection[str] = ()) -> None:
+        """Registers the ids of get_state, except the ids of `exclude_forms`, the forms that are converted again."""
+        exclude_forms = set(exclude_forms)
+        for project, entries in state.items():
+            if project not in self.registries:
+                self.registries[project] = Fhir_id_registry(project, self.disambiguate)
+            self.registries[project].restore_state(entries, exclude_forms)
+
+    def save(self, file_path) -> None:
+        """Writes the ids of all projects to the output generation, see load."""
+        # A seeded generation shares the file with its source until it is detached
+        with open_for_writing(file_path, 'w') as registry_file:
+            json.dump(self.get_state(), registry_file, indent=1)
+
+    def load(self, file_path, exclude_forms: Collection[str] = ()) -> bool:
+        """
+        Registers the ids of the forms of an output generation whose FSH files are kept, for runs that only convert some
+        of the forms, such as --retry-failed, --form and --board. The ids of `exclude_forms`, the forms that are converted
+        again, are left out. Returns False if the generation has no ids, e.g. because it was written before they were saved.
+        """
+        if not Path(file_path).is_file():
+            return False
+        with open(file_path, encoding='utf-8') as registry_file:
+            self.restore_state(json.load(registry_file), exclude_forms)
+        return True
+
+def format_collision(collision: dict) -> str:
+    return (f"{collision['project']}: {collision['resource_type']} id '{collision['id']}' is generated for both "
+            f"{collision['first_source']} ({collision['first_form']}) and {collision['second_source']} ({collision['second_form']}).")
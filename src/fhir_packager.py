@@ -0,0 +1,97 @@
+import gzip, io, json, logging, shutil, tarfile, time
+from pathlib import Path
+from src.constants import (
+    DSCN_SUBFOLDER,
+    LPDS_SUBFOLDER,
+    FHIR_PACKAGE_NAME_PREFIX,
+    FHIR_PACKAGE_FOLDER,
+    NHS_WALES_PUBLISHER
+)
+from src.file_writer import read_sushi_config
+
+def get_package_name(project_folder) -> str:
+    """Returns the FHIR package name of a project, e.g. nhs.wales.psom.dscn or nhs.wales.psom.lpds.abu."""
+    project_folder = Path(project_folder)
+    if project_folder.parent.name == LPDS_SUBFOLDER:
+        return f'{FHIR_PACKAGE_NAME_PREFIX}.{LPDS_SUBFOLDER}.{project_folder.name}'.lower()
+    return f'{FHIR_PACKAGE_NAME_PREFIX}.{DSCN_SUBFOLDER}'.lower()
+
+def package_project(project_folder, mtime: float = None) -> Path:
+    """
+    Packages the SUSHI output of a project in `<project>/package/`:
+    - `ndjson/<ResourceType>.ndjson` with one resource per line, for bulk loading.
+    - `package.tgz` in FHIR NPM package layout, with `package/package.json` and `package/.index.json`.
+
+    Resources are streamed one at a time from `fsh-generated/resources` into both outputs, so memory use
+    does not grow with the number of resources.
+
+    Args:
+        project_folder: The SUSHI project folder.
+        mtime (float, optional): Modification time stored in the tarball. Defaults to the current time.
+
+    Returns:
+        Path: The package folder.
+    """
+    project_folder = Path(project_folder)
+    resources_folder = project_folder / 'fsh-generated' / 'resources'
+    package_folder = project_folder / FHIR_PACKAGE_FOLDER
+    ndjson_folder = package_folder / 'ndjson'
+
+    # Files may be hardlinks into a previous output generation, so never rewrite them in place
+    shutil.rmtree(package_folder, ignore_errors=True)
+    ndjson_folder.mkdir(parents=True)
+
+    config = read_sushi_config(project_folder)
+    mtime = time.time() if mtime is None else mtime
+    package_json = {
+        'name': get_package_name(project_folder),
+        'version': config.get('version', '0.1.0'),
+        'canonical': config.get('canonical'),
+        'url': config.get('canonical'),
+        'fhirVersions': [config.get('fhirVersion', '4.0.1')],
+        'dependencies': {'hl7.fhir.r4.core': config.get('fhirVersion', '4.0.1')},
+        'author': NHS_WALES_PUBLISHER,
+    }
+
+    index_files = []
+    ndjson_files = {}
+    try:
+        with open(package_folder / 'package.tgz', 'wb') as tgz_file, \
+             gzip.GzipFile(filename='', mode='wb', fileobj=tgz_file, mtime=int(mtime)) as gzip_file, \
+             tarfile.open(fileobj=gzip_file, mode='w', format=tarfile.PAX_FORMAT) as tar:
+
+            _add_to_tar(tar, 'package/package.json', json.dumps(package_json, indent=2).encode('utf-8'), mtime)
+
+            for resource_file in sorted(resources_folder.glob('*.json')):
+                content = resource_file.read_bytes()
+                resource = json.loads(content)
+                resource_type = resource.get('resourceType', 'Unknown')
+
+                if resource_type not in ndjson_files:
+                    ndjson_files[resource_type] = open(ndjson_folder / f'{resource_type}.ndjson', 'w', encoding='utf-8', newline='\n')
+                ndjson_files[resource_type].write(json.dumps(resource, separators=(',', ':'), ensure_ascii=False) + '\n')
+
+                _add_to_tar(tar, f'package/{resource_file.name}', content, mtime)
+                index_files.append({key: value for key, value in {
+                    'filename': resource_file.name,
+                    'resourceType': resource_type,
+                    'id': resource.get('id'),
+                    'url': resource.get('url'),
+                    'version': resource.get('version'),
+                }.items() if value is not None})
+
+            index = {'index-version': 1, 'files': index_files}
+            _add_to_tar(tar, 'package/.index.json', json.dumps(index, indent=2).encode('utf-8'), mtime)
+    finally:
+        for ndjson_file in ndjson_files.values():
+            ndjson_file.close()
+
+    logging.info(f'Packaged {len(index_files)} resources of {project_folder} into {package_folder}')
+    return package_folder
+
+def _add_to_tar(tar: tarfile.TarFile, name: str, content: bytes, mtime: float) -> None:
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(content)
+    tar_info.mtime = int(mtime)
+    tar_info.mode = 0o644
+    tar.addfile(tar_info, io.BytesIO(content))
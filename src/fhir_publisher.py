@@ -0,0 +1,282 @@
+import hashlib, http.client, json, logging, os, queue, random, threading, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import List
+from urllib.parse import urlsplit
+from src.constants import (
+    DSCN_SUBFOLDER,
+    LPDS_SUBFOLDER,
+    PUBLISH_BATCH_SIZE,
+    PUBLISH_MAX_CONNECTIONS,
+    PUBLISH_MAX_RETRIES,
+    PUBLISH_RETRY_BACKOFF,
+    PUBLISH_TIMEOUT
+)
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class Fhir_publish_error(Exception):
+    """Raised when a Bundle could not be sent to the FHIR server, also after retrying."""
+
+class Connection_pool:
+
+    def __init__(self, base_url: str, max_connections: int = PUBLISH_MAX_CONNECTIONS, timeout: float = PUBLISH_TIMEOUT):
+        """
+        A pool of keep-alive HTTP(S) connections to a single FHIR server.
+
+        A connection is only used by one thread at a time. Connections are created lazily, up to
+        `max_connections`, and are reused for subsequent requests.
+        """
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported FHIR server URL {base_url}, expected http or https.')
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        """
+        Sends a request over a pooled connection.
+
+        Returns:
+            tuple: The status, the response headers and the response body.
+
+        Raises:
+            OSError, http.client.HTTPException: If the connection failed. The connection is then discarded.
+        """
+        with self._slots:
+            connection = self._acquire()
+            try:
+                connection.request(method, self.path + path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            self._idle.put(connection)
+            return response.status, dict(response.getheaders()), content
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(connection)
+            return connection
+
+class Fhir_publisher:
+
+    def __init__(self, base_url: str, batch_size: int = PUBLISH_BATCH_SIZE, max_connections: int = PUBLISH_MAX_CONNECTIONS,
+                 bundle_type: str = 'batch', max_retries: int = PUBLISH_MAX_RETRIES, headers: dict = None):
+        """
+        Uploads the generated FHIR resources of projects to a FHIR server as batch or transaction Bundles.
+
+        Every resource is sent as a PUT to `<resourceType>/<id>`, so existing resources are updated and new
+        ones created. The content hash of every uploaded resource is remembered in a state file, and
+        resources whose hash did not change since the last upload to the same server are skipped.
+
+        Args:
+            base_url (str): The FHIR server base URL, e.g. http://localhost:8080/fhir.
+            batch_size (int): The maximum number of resources per Bundle.
+            max_connections (int): The maximum number of Bundles sent concurrently, one connection each.
+            bundle_type (str): 'batch' or 'transaction'.
+            max_retries (int): How often a Bundle is retried after a connection error or a 408, 429 or 5xx response.
+            headers (dict, optional): Extra request headers, e.g. Authorization.
+        """
+        if bundle_type not in ('batch', 'transaction'):
+            raise ValueError(f'Unsupported Bundle type {bundle_type}, expected batch or transaction.')
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+        self.bundle_type = bundle_type
+        self.max_retries = max_retries
+        self.headers = {'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json', **(headers or {})}
+        self.pool = Connection_pool(self.base_url, max_connections)
+
+    def publish_projects(self, project_folders: List[Path], state_path: str, force: bool = False) -> dict:
+        """
+        Publishes the resources in `fsh-generated/resources` of each project folder.
+
+        Args:
+            project_folders (List[Path]): The SUSHI project folders.
+            state_path (str): The state file with the content hashes of earlier uploads.
+            force (bool): Upload all resources, also when their content hash did not change.
+
+        Returns:
+            dict: Counts of 'uploaded', 'skipped' and 'failed' resources.
+        """
+        state = load_publish_state(state_path)
+        server_state = state.setdefault(self.base_url, {})
+        totals = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+
+        try:
+            for project_folder in project_folders:
+                counts = self.publish_project(project_folder, server_state, force)
+                print(f"{project_folder}: {counts['uploaded']} uploaded, {counts['skipped']} unchanged, {counts['failed']} failed")
+                for key in totals:
+                    totals[key] += counts[key]
+                # Save after every project, so an interrupted run does not upload finished projects again
+                write_publish_state(state_path, state)
+        finally:
+            self.pool.close()
+
+        return totals
+
+    def publish_project(self, project_folder: Path, server_state: dict, force: bool = False) -> dict:
+        counts = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+        pending = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix='fhir-publish') as executor:
+            for bundle_entries in self._iterate_changed_resources(project_folder, server_state, force, counts):
+                # Bound the number of Bundles held in memory
+                if len(pending) >= self.max_connections * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done, server_state, counts)
+                pending.add(executor.submit(self._send_bundle, bundle_entries))
+
+            done, _ = wait(pending)
+            self._collect(done, server_state, counts)
+
+        return counts
+
+    def _iterate_changed_resources(self, project_folder: Path, server_state: dict, force: bool, counts: dict):
+        bundle_entries = []
+        for resource_file in sorted((Path(project_folder) / 'fsh-generated' / 'resources').glob('*.json')):
+            with open(resource_file, encoding='utf-8') as f:
+                resource = json.load(f)
+            reference = f"{resource['resourceType']}/{resource['id']}"
+            content_hash = get_content_hash(resource)
+
+            if not force and server_state.get(reference) == content_hash:
+                counts['skipped'] += 1
+                continue
+
+            bundle_entries.append((reference, content_hash, resource))
+            if len(bundle_entries) == self.batch_size:
+                yield bundle_entries
+                bundle_entries = []
+
+        if bundle_entries:
+            yield bundle_entries
+
+    def _collect(self, futures, server_state: dict, counts: dict) -> None:
+        for future in futures:
+            for reference, content_hash, succeeded in future.result():
+                if succeeded:
+                    server_state[reference] = content_hash
+                    counts['uploaded'] += 1
+                else:
+                    server_state.pop(reference, None)
+                    counts['failed'] += 1
+
+    def _send_bundle(self, bundle_entries: list) -> list:
+        """Sends one Bundle and returns (reference, content hash, succeeded) per entry."""
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': self.bundle_type,
+            'entry': [{
+                'fullUrl': f'{self.base_url}/{reference}',
+                'resource': resource,
+                'request': {'method': 'PUT', 'url': reference}
+            } for reference, _, resource in bundle_entries]
+        }
+        body = json.dumps(bundle, separators=(',', ':')).encode('utf-8')
+
+        try:
+            status, content = self._post_with_retries(body)
+        except Fhir_publish_error as e:
+            logging.error(str(e))
+            return [(reference, content_hash, False) for reference, content_hash, _ in bundle_entries]
+
+        if not 200 <= status < 300:
+            logging.error(f'FHIR server rejected a {self.bundle_type} Bundle of {len(bundle_entries)} resources with HTTP {status}: {content[:500]!r}')
+            return [(reference, content_hash, False) for reference, content_hash, _ in bundle_entries]
+
+        try:
+            response_bundle = json.loads(content) if content else {}
+        except ValueError:
+            response_bundle = None
+        if not isinstance(response_bundle, dict) or not isinstance(response_bundle.get('entry', []), list):
+            # Without a response Bundle it is unknown which resources were stored, they are sent again next time
+            logging.error(f'FHIR server answered a {self.bundle_type} Bundle of {len(bundle_entries)} resources with HTTP {status}, but not with a Bundle: {content[:500]!r}')
+            return [(reference, content_hash, False) for reference, content_hash, _ in bundle_entries]
+
+        response_entries = response_bundle.get('entry', [])
+        results = []
+        for index, (reference, content_hash, _) in enumerate(bundle_entries):
+            response_entry = response_entries[index] if index < len(response_entries) and isinstance(response_entries[index], dict) else {}
+            entry_status = str(response_entry.get('response', {}).get('status', ''))
+            succeeded = entry_status[:1] == '2'
+            if not succeeded:
+                logging.error(f'FHIR server did not accept {reference}: {entry_status or "no response entry"}')
+            results.append((reference, content_hash, succeeded))
+        return results
+
+    def _post_with_retries(self, body: bytes):
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                status, headers, content = self.pool.request('POST', '', body, self.headers)
+                if status not in RETRYABLE_STATUSES:
+                    return status, content
+                retry_after = headers.get('Retry-After')
+                reason = f'HTTP {status}'
+            except (OSError, http.client.HTTPException) as e:
+                reason = str(e) or type(e).__name__
+
+            if attempt == self.max_retries:
+                raise Fhir_publish_error(f'Sending a Bundle to {self.base_url} failed after {attempt + 1} attempts: {reason}')
+
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else PUBLISH_RETRY_BACKOFF * 2 ** attempt
+            delay += random.uniform(0, PUBLISH_RETRY_BACKOFF)
+            logging.warning(f'Sending a Bundle to {self.base_url} failed ({reason}), retrying in {delay:.1f} seconds.')
+            time.sleep(delay)
+
+def get_content_hash(resource: dict) -> str:
+    """Returns a hash of the resource content that does not depend on key order or formatting."""
+    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def load_publish_state(state_path: str) -> dict:
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_publish_state(state_path: str, state: dict) -> None:
+    temporary_path = f'{state_path}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, state_path)
+
+def find_project_folders(output_folder: str, projects: List[str] = None) -> List[Path]:
+    """
+    Returns the project folders of the current output that have generated resources.
+
+    Args:
+        output_folder (str): The output folder.
+        projects (List[str], optional): Only these projects, e.g. DSCN or LPDS/ABU.
+    """
+    output_path = Path(output_folder)
+    candidates = [output_path / DSCN_SUBFOLDER]
+    if (output_path / LPDS_SUBFOLDER).is_dir():
+        candidates += sorted(folder for folder in (output_path / LPDS_SUBFOLDER).iterdir() if folder.is_dir())
+
+    folders = [folder for folder in candidates if (folder / 'fsh-generated' / 'resources').is_dir()]
+    if projects:
+        folders = [folder for folder in folders if folder.relative_to(output_path).as_posix() in projects]
+    return folders
@@ -1,59 +1,122 @@
 from pathlib import Path
 from tqdm import tqdm
-import logging
+import logging, re, traceback
+from src.output_sinks import Filesystem_sink, Output_sink
 from src.constants import NHS_WALES_BASE_URL, LPDS_SUBFOLDER, DSCN_SUBFOLDER
 
-def write_fsh_files(fsh_lines_list, output_folder, lpds_healthboard_abbreviation_dict):
+def get_project_folder(output_folder, lpds_healthboard_abbreviation: str) -> Path:
+    """Returns the SUSHI project folder (holding sushi-config.yaml) for DSCN or an LPDS health board."""
+    if lpds_healthboard_abbreviation:
+        return Path(output_folder) / LPDS_SUBFOLDER / lpds_healthboard_abbreviation
+    return Path(output_folder) / DSCN_SUBFOLDER
+
+def read_sushi_config(project_folder) -> dict:
+    """Reads the flat "key: value" sushi-config.yaml files written by write_fsh_files."""
+    config = {}
+    with open(Path(project_folder) / 'sushi-config.yaml', encoding='utf-8') as config_file:
+        for line in config_file:
+            match = re.match(r'^\s*([A-Za-z]+)\s*:\s*(.*?)\s*$', line)
+            if match:
+                config[match.group(1)] = match.group(2)
+    return config
+
+def write_fsh_files(fsh_lines_list, output_folder, lpds_healthboard_abbreviation_dict, failure_report=None, input_paths: dict = None, replace_existing: bool = False,
+                    previous_output=None, sink: Output_sink = None):
+    """
+    Writes the FSH lines of each form to the DSCN or LPDS project folders and creates their sushi-config.yaml files.
+
+    Args:
+        fsh_lines_list (list): FSH lines entries as returned by convert_to_fsh.
+        output_folder: The output (generation) folder.
+        lpds_healthboard_abbreviation_dict (dict): Health board abbreviations and their canonical URLs.
+        failure_report (Failure_report, optional): Records forms that fail to be written, instead of aborting.
+        input_paths (dict, optional): Input path per form file name, used to identify forms in the failure report.
+        replace_existing (bool): Replace files that exist from before this call instead of appending to them,
+            e.g. when the output folder was seeded from a previous generation.
+        previous_output (optional): The previous output generation. External choice lists that did not change are
+            reused from it instead of being streamed from their CSV file again.
+        sink (Output_sink, optional): Where the files are written, see output_sinks. Defaults to the output folder on disk.
+    """
+    written_files = set() if replace_existing else None
+    sink = sink if sink is not None else Filesystem_sink(output_folder)
+
     with tqdm(total=len(fsh_lines_list), desc="Writing FSH to files", dynamic_ncols=True) as pbar:
         # Track if the DSCN sushi-config.yaml file has been created
         dscn_sushi_created = False
 
-        for file_name, questionnaire_fsh_lines, questionnaire_terminology_fsh_lines, short_name, version, lpds_healthboard_abbreviation, question_reference_codesystem_fsh_lines in fsh_lines_list:
+        for file_name, questionnaire_fsh_lines, questionnaire_terminology_fsh_lines, short_name, version, lpds_healthboard_abbreviation, question_reference_codesystem_fsh_lines, external_choice_lists in fsh_lines_list:
             logging.info(f'Saving {file_name}...')
-
-            # Determine the base folder
-            if lpds_healthboard_abbreviation:
-                # LPDS folder structure
-                if lpds_healthboard_abbreviation == 'LPDS':
-                    base_folder = Path(output_folder) / LPDS_SUBFOLDER
-                else:
-                    base_folder = Path(output_folder) / LPDS_SUBFOLDER / lpds_healthboard_abbreviation / "input" / "fsh"
-                canonical_url = lpds_healthboard_abbreviation_dict.get(lpds_healthboard_abbreviation, NHS_WALES_BASE_URL)
-            else:
-                # DSCN folder structure
-                base_folder = Path(output_folder) / DSCN_SUBFOLDER / "input" / "fsh"
-                canonical_url = NHS_WALES_BASE_URL
-
-            # Define questionnaire and terminology folders
-            questionnaire_folder = base_folder / "questionnaires"
-            terminology_folder = base_folder / "terminology"
-
-            # Create folders if they don't exist
-            if lpds_healthboard_abbreviation != 'LPDS':
-                questionnaire_folder.mkdir(parents=True, exist_ok=True)
-            terminology_folder.mkdir(parents=True, exist_ok=True)
-
-            # Write files
-            write_to_file(questionnaire_fsh_lines, questionnaire_folder, short_name, version)
-            write_to_file(questionnaire_terminology_fsh_lines, terminology_folder, short_name, version)
-            write_to_file(question_reference_codesystem_fsh_lines, terminology_folder, short_name, version)
-
-            # Create sushi-config.yaml file for LPDS healthboard or DSCN if not yet created
-            if lpds_healthboard_abbreviation or not dscn_sushi_created:
-                sushi_config_path = base_folder.parent.parent / "sushi-config.yaml"
-                sushi_config_content = f"canonical: {canonical_url}\nfhirVersion: 4.0.1\nversion: 0.1.0\nFSHOnly: true"
-                with sushi_config_path.open('w', encoding='utf-8') as sushi_file:
-                    sushi_file.write(sushi_config_content)
-
-                if not lpds_healthboard_abbreviation:
-                    dscn_sushi_created = True
+            try:
+                dscn_sushi_created = write_form_fsh_files(
+                    output_folder, lpds_healthboard_abbreviation_dict, questionnaire_fsh_lines, questionnaire_terminology_fsh_lines,
+                    short_name, version, lpds_healthboard_abbreviation, question_reference_codesystem_fsh_lines, dscn_sushi_created, written_files,
+                    external_choice_lists, previous_output, sink)
+            except Exception as e:
+                logging.error(f'Error saving {file_name}: {str(e)}')
+                logging.error(traceback.format_exc())
+                if failure_report is None:
+                    raise
+                input_path = (input_paths or {}).get(file_name, file_name) if file_name else None
+                failure_report.add_failure('write', input_path, e, project=str(get_project_folder(output_folder, lpds_healthboard_abbreviation)))
+                pbar.update(1)
+                continue
 
             pbar.update(1)
             logging.info(f'Saved {file_name}...')
 
-def write_to_file(lines: list, folder: Path, file_name: str, version: str) -> None:
+def write_form_fsh_files(output_folder, lpds_healthboard_abbreviation_dict, questionnaire_fsh_lines, questionnaire_terminology_fsh_lines,
+                         short_name, version, lpds_healthboard_abbreviation, question_reference_codesystem_fsh_lines,
+                         dscn_sushi_created: bool, written_files: set = None, external_choice_lists: list = None, previous_output=None,
+                         sink: Output_sink = None) -> bool:
+    """Writes the FSH files of a single form. Returns whether the DSCN sushi-config.yaml file has been created."""
+    sink = sink if sink is not None else Filesystem_sink(output_folder)
+
+    # Determine the base folder
+    if lpds_healthboard_abbreviation:
+        # LPDS folder structure
+        if lpds_healthboard_abbreviation == 'LPDS':
+            base_folder = Path(output_folder) / LPDS_SUBFOLDER
+        else:
+            base_folder = Path(output_folder) / LPDS_SUBFOLDER / lpds_healthboard_abbreviation / "input" / "fsh"
+        canonical_url = lpds_healthboard_abbreviation_dict.get(lpds_healthboard_abbreviation, NHS_WALES_BASE_URL)
+    else:
+        # DSCN folder structure
+        base_folder = Path(output_folder) / DSCN_SUBFOLDER / "input" / "fsh"
+        canonical_url = NHS_WALES_BASE_URL
+
+    # Define questionnaire and terminology folders
+    questionnaire_folder = base_folder / "questionnaires"
+    terminology_folder = base_folder / "terminology"
+
+    # Create folders if they don't exist
+    if lpds_healthboard_abbreviation != 'LPDS':
+        sink.make_folder(questionnaire_folder)
+    sink.make_folder(terminology_folder)
+
+    # Write files
+    write_to_file(questionnaire_fsh_lines, questionnaire_folder, short_name, version, written_files, sink)
+    write_to_file(questionnaire_terminology_fsh_lines, terminology_folder, short_name, version, written_files, sink)
+    write_to_file(question_reference_codesystem_fsh_lines, terminology_folder, short_name, version, written_files, sink)
+    for external_choice_list in external_choice_lists or []:
+        previous_terminology_folder = Path(previous_output) / terminology_folder.relative_to(output_folder) if previous_output is not None else None
+        external_choice_list.write_to_folder(terminology_folder, previous_terminology_folder, sink)
+
+    # Create sushi-config.yaml file for LPDS healthboard or DSCN if not yet created
+    if lpds_healthboard_abbreviation or not dscn_sushi_created:
+        sushi_config_path = base_folder.parent.parent / "sushi-config.yaml"
+        sushi_config_content = f"canonical: {canonical_url}\nfhirVersion: 4.0.1\nversion: 0.1.0\nFSHOnly: true"
+        with sink.open_for_writing(sushi_config_path, 'w') as sushi_file:
+            sushi_file.write(sushi_config_content)
+
+        if not lpds_healthboard_abbreviation:
+            dscn_sushi_created = True
+
+    return dscn_sushi_created
+
+def write_to_file(lines: list, folder: Path, file_name: str, version: str, written_files: set = None, sink: Output_sink = None) -> None:
     if lines == []:
         return
+    sink = sink if sink is not None else Filesystem_sink(folder)
     
     # Remove version from QuestionReference files (both DSCN and LPDS variants)
     if file_name in ["QuestionReferenceCS", "LPDSQuestionReferenceCS"]:
@@ -63,11 +126,18 @@ def write_to_file(lines: list, folder: Path, file_name: str, version: str) -> No
     else:
         filepath = folder / f"{file_name}-v{version}.fsh"
     
-    mode = 'a' if filepath.exists() else 'w'
-    with filepath.open(mode, encoding='utf-8') as f:
+    if written_files is not None:
+        # Replace files from before this write instead of appending to them
+        if filepath not in written_files and sink.exists(filepath):
+            sink.remove(filepath)
+        written_files.add(filepath)
+
+    mode = 'a' if sink.exists(filepath) else 'w'
+    with sink.open_for_writing(filepath, mode) as f:
         f.write('\n'.join(lines))
         f.write('\n') 
 
-def write_to_md_file(md_lines: str, md_file_path: str) -> None:
-    with open(md_file_path, 'w') as md_file:
+def write_to_md_file(md_lines: str, md_file_path: str, sink: Output_sink = None) -> None:
+    sink = sink if sink is not None else Filesystem_sink(Path(md_file_path).parent)
+    with sink.open_for_writing(md_file_path, 'w') as md_file:
         md_file.write(md_lines)
\ No newline at end of file
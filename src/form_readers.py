@@ -0,0 +1,94 @@
+import io, json
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+import pandas as pd
+
+FORM_SHEETS = ['settings', 'survey', 'choices']
+
+def read_xlsx_form(input_path: str, content: bytes = None) -> Dict[str, pd.DataFrame]:
+    """Reads all sheets of an XLSForm workbook, from its content if it was already read into memory."""
+    return pd.read_excel(io.BytesIO(content) if content is not None else input_path, sheet_name=None, keep_default_na=False)
+
+def read_json_form(input_path: str, content: bytes = None) -> Dict[str, pd.DataFrame]:
+    """
+    Reads a form definition from a JSON file with a list of rows per sheet:
+
+        {"settings": [{"form_title": "...", "version": 1, ...}],
+         "survey": [{"type": "text", "name": "...", "label": "..."}, ...],
+         "choices": [{"list_name": "...", "name": "...", "label": "..."}, ...]}
+
+    The settings may also be a single object. Missing cells and nulls become empty strings, like empty cells in a workbook.
+    """
+    if content is not None:
+        form = json.loads(content.decode('utf-8'))
+    else:
+        with open(input_path, encoding='utf-8') as json_file:
+            form = json.load(json_file)
+    if not isinstance(form, dict):
+        raise ValueError(f'{input_path} does not contain a JSON object with settings, survey and choices.')
+
+    sheets = {}
+    for sheet_name, rows in form.items():
+        if isinstance(rows, dict):
+            rows = [rows]
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError(f'{input_path}: {sheet_name} must be a list of rows.')
+        sheets[sheet_name] = _rows_to_dataframe(rows)
+    return sheets
+
+def read_csv_form(input_path: str, content: Dict[str, bytes] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Reads a form definition from a `.csvform` folder with a settings.csv, survey.csv and choices.csv file,
+    or from the content of these files by file name if they were already read into memory.
+    """
+    sheets = {}
+    for sheet_name in FORM_SHEETS:
+        csv_file = Path(input_path) / f'{sheet_name}.csv'
+        if content is not None and csv_file.name in content:
+            sheets[sheet_name] = pd.read_csv(io.BytesIO(content[csv_file.name]), keep_default_na=False, encoding='utf-8-sig')
+        elif content is None and csv_file.exists():
+            sheets[sheet_name] = pd.read_csv(csv_file, keep_default_na=False, encoding='utf-8-sig')
+    return sheets
+
+# Readers by file extension, a `.csvform` input is a folder
+FORM_READERS: Dict[str, Callable[..., Dict[str, pd.DataFrame]]] = {
+    '.xlsx': read_xlsx_form,
+    '.json': read_json_form,
+    '.csvform': read_csv_form,
+}
+
+def get_form_reader(input_path: str) -> Callable[..., Dict[str, pd.DataFrame]]:
+    """
+    Returns the reader for a form definition, selected by its file extension.
+
+    Raises:
+        ValueError: If there is no reader for the extension.
+    """
+    extension = Path(input_path).suffix.lower()
+    if extension not in FORM_READERS:
+        raise ValueError(f'No reader for {input_path}. Supported form definitions are: {", ".join(FORM_READERS)}.')
+    return FORM_READERS[extension]
+
+def read_form(input_path: str, content: Union[bytes, Dict[str, bytes]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Reads the settings, survey and choices sheets of a form definition with the reader for its extension.
+    `content` is the form read into memory beforehand, see input_prefetcher.read_input.
+    """
+    sheets = get_form_reader(input_path)(input_path, content)
+    missing = [sheet_name for sheet_name in FORM_SHEETS if sheet_name not in sheets]
+    if missing:
+        raise ValueError(f'{input_path} has no {", ".join(missing)} sheet.')
+    return sheets
+
+def read_form_settings(input_path: str) -> pd.DataFrame:
+    """Reads only the settings sheet of a form definition, e.g. to select forms without loading them."""
+    reader = get_form_reader(input_path)
+    if reader is read_xlsx_form:
+        return pd.read_excel(input_path, sheet_name='settings', keep_default_na=False)
+    if reader is read_csv_form:
+        return pd.read_csv(Path(input_path) / 'settings.csv', keep_default_na=False, encoding='utf-8-sig')
+    return reader(input_path)['settings']
+
+def _rows_to_dataframe(rows: List[dict]) -> pd.DataFrame:
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    return pd.DataFrame([{column: '' if row.get(column) is None else row[column] for column in columns} for row in rows], columns=columns)
@@ -0,0 +1,216 @@
+import logging, re
+from pathlib import Path
+from typing import Dict, List
+from src.file_writer import read_sushi_config
+from src.models.Fsh_question_reference import is_question_reference_code
+
+DEFINITION_PATTERN = re.compile(r'^(CodeSystem|ValueSet|Instance):\s*(\S+)\s*$')
+URL_PATTERN = re.compile(r'^\* \^url = "(.*)"$')
+NAME_PATTERN = re.compile(r'^\* \^name = "(.*)"$')
+CODE_PATTERN = re.compile(r'^\s*\* #(\S+)')
+MEMBER_PATTERN = re.compile(r'^\* ([^\s^]\S*)#(\S+)')
+INCLUDE_SYSTEM_PATTERN = re.compile(r'^\* include codes from system (\S+)\s*$')
+ANSWER_VALUE_SET_PATTERN = re.compile(r'^\s*\* answerValueSet = Canonical\(([^)]*)\)')
+ITEM_CODE_PATTERN = re.compile(r'^\s*\* code = (\S+)#(\S+)')
+
+def check_project(project_folder) -> List[dict]:
+    """
+    Checks the FSH files of a SUSHI project for problems that would make SUSHI fail, without running SUSHI.
+
+    All CodeSystems, ValueSets and Instances of the project are indexed first, then every line is checked for:
+    - duplicate CodeSystem, ValueSet or Instance ids and duplicate codes in a CodeSystem,
+    - `answerValueSet = Canonical(...)` references to ValueSets that are not defined in the project,
+    - item codes of project CodeSystems, such as the QuestionReferenceCS, that are not in the CodeSystem. Codes the
+      QuestionReference CodeSystems leave out by design, see is_question_reference_code, are not checked,
+    - ValueSet members with codes that are not in their project CodeSystem,
+    - ValueSets that include all codes of a CodeSystem that is not defined in the project,
+    - unescaped quotes in strings. Strings can span lines, e.g. a label with a newline.
+    References to CodeSystems and ValueSets outside the project, e.g. HL7 terminology, are not checked.
+
+    Args:
+        project_folder: The SUSHI project folder.
+
+    Returns:
+        List[dict]: The problems, each with the file, the line number and a message.
+    """
+    project_folder = Path(project_folder)
+    config_path = project_folder / 'sushi-config.yaml'
+    canonical = read_sushi_config(project_folder).get('canonical', '') if config_path.exists() else ''
+    fsh_files = sorted((project_folder / 'input' / 'fsh').rglob('*.fsh'))
+
+    issues = []
+    code_systems, value_sets = _index_definitions(fsh_files, canonical, issues)
+
+    for fsh_file in fsh_files:
+        current_type = None
+        # The line a string started on that is not closed yet
+        open_string = None
+        with open(fsh_file, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.rstrip('\n')
+
+                if open_string is not None:
+                    # The line continues the string
+                    still_open, valid = _scan_quotes(line, True)
+                    if not valid:
+                        issues.append(_issue(fsh_file, line_number, f'Unescaped quote in: {line.strip()}'))
+                    open_string = open_string if still_open and valid else None
+                    continue
+
+                match = DEFINITION_PATTERN.match(line)
+                if match:
+                    current_type = match.group(1)
+                    continue
+
+                if line.strip() and not line.lstrip().startswith('"""'):
+                    still_open, valid = _scan_quotes(line, False)
+                    if not valid:
+                        issues.append(_issue(fsh_file, line_number, f'Unescaped or unterminated quote in: {line.strip()}'))
+                        continue
+                    if still_open:
+                        open_string = (line_number, line.strip())
+                        continue
+
+                match = ANSWER_VALUE_SET_PATTERN.match(line)
+                if match and match.group(1) not in value_sets and '://' not in match.group(1):
+                    issues.append(_issue(fsh_file, line_number, f'answerValueSet references ValueSet {match.group(1)}, which is not defined in the project.'))
+                    continue
+
+                match = ITEM_CODE_PATTERN.match(line) if current_type == 'Instance' else None
+                if match and match.group(1) in code_systems and match.group(2) not in code_systems[match.group(1)] and is_question_reference_code(match.group(2)):
+                    issues.append(_issue(fsh_file, line_number, f'Code {match.group(2)} is not defined in CodeSystem {match.group(1)}.'))
+                    continue
+
+                match = INCLUDE_SYSTEM_PATTERN.match(line) if current_type == 'ValueSet' else None
+                if match:
+                    if match.group(1) not in code_systems and '://' not in match.group(1):
+                        issues.append(_issue(fsh_file, line_number, f'ValueSet includes CodeSystem {match.group(1)}, which is not defined in the project.'))
+                    continue
+
+                match = MEMBER_PATTERN.match(line) if current_type == 'ValueSet' else None
+                if match:
+                    system, code = match.group(1), match.group(2).split(' ')[0]
+                    if system in code_systems:
+                        if code not in code_systems[system]:
+                            issues.append(_issue(fsh_file, line_number, f'Code {code} is not defined in CodeSystem {system}.'))
+                    elif '://' not in system:
+                        issues.append(_issue(fsh_file, line_number, f'ValueSet member references CodeSystem {system}, which is not defined in the project.'))
+
+        if open_string is not None:
+            issues.append(_issue(fsh_file, open_string[0], f'Unterminated quote in: {open_string[1]}'))
+
+    return issues
+
+def _scan_quotes(line: str, in_string: bool):
+    """
+    Scans the quotes of a line. A string starts at the beginning of a token and ends before whitespace or the end
+    of the line, quotes inside it are escaped with a backslash.
+
+    Args:
+        in_string (bool): Whether the line starts inside a string of an earlier line.
+
+    Returns:
+        tuple: Whether a string is still open at the end of the line, and whether the quotes of the line are valid.
+    """
+    position = 0
+    while position < len(line):
+        character = line[position]
+        if in_string and character == '\\':
+            position += 2
+            continue
+        if character == '"':
+            if in_string and position + 1 < len(line) and not line[position + 1].isspace():
+                return in_string, False
+            if not in_string and position > 0 and not line[position - 1].isspace():
+                return in_string, False
+            in_string = not in_string
+        position += 1
+    return in_string, True
+
+def _index_definitions(fsh_files: List[Path], canonical: str, issues: list):
+    """
+    Indexes the definitions of a project.
+
+    Returns:
+        tuple: The codes of every CodeSystem by id, name and url, and the ValueSets by id, name and url.
+    """
+    definitions = {}
+    code_systems = {}
+    value_sets = set()
+
+    for fsh_file in fsh_files:
+        current = None
+        with open(fsh_file, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.rstrip('\n')
+
+                match = DEFINITION_PATTERN.match(line)
+                if match:
+                    definition_type, definition_id = match.groups()
+                    if (definition_type, definition_id) in definitions:
+                        first_file, first_line = definitions[(definition_type, definition_id)]
+                        issues.append(_issue(fsh_file, line_number, f'Duplicate {definition_type} id {definition_id}, first defined in {first_file}:{first_line}.'))
+                    definitions.setdefault((definition_type, definition_id), (fsh_file, line_number))
+
+                    current = {'type': definition_type, 'id': definition_id, 'keys': {definition_id}, 'codes': set()}
+                    if definition_type == 'CodeSystem':
+                        current['keys'].add(f'{canonical}/CodeSystem/{definition_id}')
+                        for key in current['keys']:
+                            code_systems.setdefault(key, current['codes'])
+                    elif definition_type == 'ValueSet':
+                        current['keys'].add(f'{canonical}/ValueSet/{definition_id}')
+                    _add_value_set_keys(current, value_sets)
+                    continue
+
+                if current is None:
+                    continue
+
+                match = URL_PATTERN.match(line) or NAME_PATTERN.match(line)
+                if match:
+                    current['keys'].add(match.group(1))
+                    if current['type'] == 'CodeSystem':
+                        code_systems.setdefault(match.group(1), current['codes'])
+                    _add_value_set_keys(current, value_sets)
+                    continue
+
+                match = CODE_PATTERN.match(line)
+                if match and current['type'] == 'CodeSystem':
+                    if match.group(1) in current['codes']:
+                        issues.append(_issue(fsh_file, line_number, f'Duplicate code {match.group(1)} in CodeSystem {current["id"]}.'))
+                    current['codes'].add(match.group(1))
+
+    return code_systems, value_sets
+
+def _add_value_set_keys(current: dict, value_sets: set) -> None:
+    if current['type'] == 'ValueSet':
+        value_sets.update(current['keys'])
+
+def _issue(fsh_file: Path, line_number: int, message: str) -> dict:
+    return {'file': str(fsh_file), 'line': line_number, 'message': message}
+
+def format_issue(issue: dict) -> str:
+    return f"{issue['file']}:{issue['line']}: {issue['message']}"
+
+def run_preflight(project_folders: List[Path], failure_report=None, project_forms: Dict[Path, List[str]] = None) -> List[Path]:
+    """
+    Checks the FSH files of every project folder before SUSHI runs. Projects with problems are logged
+    with file and line number and recorded in the failure report as failed in the 'preflight' stage.
+
+    Returns:
+        List[Path]: The project folders without problems, for which SUSHI can run.
+    """
+    passed_folders = []
+    for project_folder in project_folders:
+        issues = check_project(project_folder)
+        if not issues:
+            passed_folders.append(project_folder)
+            continue
+
+        for issue in issues:
+            logging.error(f'Pre-flight check: {format_issue(issue)}')
+        message = f'{len(issues)} problems found in the FSH files, SUSHI was not run:\n' + '\n'.join(format_issue(issue) for issue in issues)
+        if failure_report is not None:
+            failure_report.add_failure('preflight', None, message, project=str(project_folder), forms=(project_forms or {}).get(project_folder, []))
+        else:
+            print(message)
+    return passed_folders
@@ -0,0 +1,283 @@
+import json, logging, re
+from pathlib import Path
+from typing import Dict, List
+from src.constants import DSCN_SUBFOLDER, LPDS_SUBFOLDER
+
+# Fields that change on every run without a change in content
+VOLATILE_PROPERTIES = {'version', '^version', 'date', '^date'}
+
+RESOURCE_PATTERN = re.compile(r'^(CodeSystem|ValueSet|Instance):\s*(\S+)')
+INSTANCE_OF_PATTERN = re.compile(r'^InstanceOf:\s*(\S+)')
+HEADER_PATTERN = re.compile(r'^(Id|Title|Description|Usage):\s*(.*)$')
+RULE_PATTERN = re.compile(r'^(\s*)\* (.*)$')
+ASSIGNMENT_PATTERN = re.compile(r'^(\S+)\s*=\s*(.*)$')
+CODE_PATTERN = re.compile(r'^#(\S+)(?:\s+(".*"))?$')
+MEMBER_PATTERN = re.compile(r'^(\S+#\S+)(?:\s+(".*"))?$')
+INDEX_PATTERN = re.compile(r'\[[^\]]*\]')
+INCLUDE_SYSTEM_PREFIX = 'include codes from system '
+
+def find_projects(tree) -> Dict[str, Path]:
+    """Returns the DSCN and LPDS health board project folders of an output tree, by project name (DSCN, LPDS/ABU, ...)."""
+    tree = Path(tree)
+    projects = {}
+    if (tree / DSCN_SUBFOLDER).is_dir():
+        projects[DSCN_SUBFOLDER] = tree / DSCN_SUBFOLDER
+    if (tree / LPDS_SUBFOLDER).is_dir():
+        for folder in sorted((tree / LPDS_SUBFOLDER).iterdir()):
+            if folder.is_dir():
+                projects[f'{LPDS_SUBFOLDER}/{folder.name}'] = folder
+    return projects
+
+def index_fsh_project(project_folder) -> Dict[tuple, dict]:
+    """
+    Indexes the FSH files of a project in a single pass over every line.
+
+    Returns:
+        dict: Per (resource type, id) a dict of element key to value. Element keys are
+            ('property', name), ('question', linkId), ('code', code) or ('member', system#code).
+    """
+    resources = {}
+    for fsh_file in sorted((Path(project_folder) / 'input' / 'fsh').rglob('*.fsh')):
+        with open(fsh_file, encoding='utf-8') as f:
+            _index_fsh_lines(f, resources)
+    _expand_included_code_systems(resources, {resource_id: elements for (resource_type, resource_id), elements in resources.items() if resource_type == 'CodeSystem'})
+    return resources
+
+def _index_fsh_lines(lines, resources: dict) -> None:
+    elements = None
+    resource_key = None
+    item_stack = []  # (indent, element key) of the enclosing Questionnaire items
+    last_element = None
+
+    for line in lines:
+        line = line.rstrip('\n')
+        match = RESOURCE_PATTERN.match(line)
+        if match:
+            resource_type = 'Questionnaire' if match.group(1) == 'Instance' else match.group(1)
+            resource_key = (resource_type, match.group(2))
+            elements = resources.setdefault(resource_key, {})
+            item_stack, last_element = [], None
+            continue
+        if elements is None:
+            continue
+
+        match = INSTANCE_OF_PATTERN.match(line)
+        if match:
+            # Instances of other profiles are indexed under their own type
+            if match.group(1) != resource_key[0]:
+                resources[(match.group(1), resource_key[1])] = resources.pop(resource_key)
+                resource_key = (match.group(1), resource_key[1])
+            continue
+
+        match = HEADER_PATTERN.match(line)
+        if match:
+            elements[('property', match.group(1))] = match.group(2)
+            continue
+
+        match = RULE_PATTERN.match(line)
+        if not match:
+            continue
+        indent, rule = len(match.group(1)), match.group(2)
+
+        while item_stack and item_stack[-1][0] >= indent:
+            item_stack.pop()
+
+        if rule == 'item[+]':
+            item_stack.append((indent, None))
+            continue
+
+        if item_stack:
+            assignment = ASSIGNMENT_PATTERN.match(rule)
+            if not assignment:
+                continue
+            name, value = INDEX_PATTERN.sub('', assignment.group(1)), assignment.group(2)
+            item_indent, item_key = item_stack[-1]
+            if name == 'linkId':
+                item_key = ('question', value.strip('"'))
+                item_stack[-1] = (item_indent, item_key)
+                elements.setdefault(item_key, {})
+            elif item_key is not None:
+                _add_value(elements[item_key], name, value)
+            continue
+
+        if indent > 0:
+            # Nested rules, e.g. designations of a code, belong to the element above
+            if last_element is not None:
+                _add_value(elements.setdefault(last_element, {}), 'detail', rule)
+            continue
+
+        match = CODE_PATTERN.match(rule)
+        if match and resource_key[0] == 'CodeSystem':
+            last_element = ('code', match.group(1))
+            elements[last_element] = {'display': match.group(2) or ''}
+            continue
+
+        match = MEMBER_PATTERN.match(rule)
+        if match and resource_key[0] == 'ValueSet':
+            last_element = ('member', match.group(1))
+            elements[last_element] = {'display': match.group(2) or ''}
+            continue
+
+        if rule.startswith('include ') or rule.startswith('exclude '):
+            last_element = ('member', rule)
+            elements[last_element] = {}
+            continue
+
+        assignment = ASSIGNMENT_PATTERN.match(rule)
+        if assignment:
+            last_element = ('property', assignment.group(1))
+            elements[last_element] = assignment.group(2)
+
+def _expand_included_code_systems(resources: dict, code_systems: dict) -> None:
+    """
+    Replaces the `include codes from system` members of ValueSets by a member per code of the CodeSystem, if it is
+    defined in the project, so a ValueSet that includes a whole CodeSystem equals one that enumerates its codes.
+
+    Args:
+        resources (dict): The indexed resources, see index_fsh_project.
+        code_systems (dict): The elements of the CodeSystems of the project, by the system the ValueSets refer to them with.
+    """
+    for (resource_type, _), elements in resources.items():
+        if resource_type != 'ValueSet':
+            continue
+        included_systems = [key[1][len(INCLUDE_SYSTEM_PREFIX):] for key in elements if key[0] == 'member' and key[1].startswith(INCLUDE_SYSTEM_PREFIX)]
+        for system in included_systems:
+            if system not in code_systems:
+                continue
+            del elements[('member', f'{INCLUDE_SYSTEM_PREFIX}{system}')]
+            for (element_type, code), concept in code_systems[system].items():
+                if element_type == 'code':
+                    elements[('member', f'{system}#{code}')] = {'display': concept.get('display', '')}
+
+def _add_value(element: dict, name: str, value: str) -> None:
+    # Repeated elements, such as extensions or answer options, are compared as a whole
+    element[name] = f'{element[name]}; {value}' if name in element else value
+
+def index_json_project(project_folder) -> Dict[tuple, dict]:
+    """Indexes the FHIR resources SUSHI generated for a project, with the same element keys as index_fsh_project."""
+    resources = {}
+    code_systems = {}
+    for resource_file in sorted((Path(project_folder) / 'fsh-generated' / 'resources').glob('*.json')):
+        with open(resource_file, encoding='utf-8') as f:
+            resource = json.load(f)
+
+        elements = {}
+        for name, value in resource.items():
+            if name in ('resourceType', 'id', 'item', 'concept', 'compose', 'text', 'meta'):
+                continue
+            elements[('property', name)] = _to_text(value)
+
+        _index_json_items(resource.get('item', []), elements)
+
+        for concept in resource.get('concept', []):
+            elements[('code', concept['code'])] = {name: _to_text(value) for name, value in concept.items() if name != 'code'}
+
+        for rule in ('include', 'exclude'):
+            for component in resource.get('compose', {}).get(rule, []):
+                system = component.get('system', '')
+                if not component.get('concept'):
+                    elements[('member', f'{rule} codes from system {system}')] = {name: _to_text(value) for name, value in component.items() if name != 'system'}
+                for concept in component.get('concept', []):
+                    elements[('member', f"{system}#{concept['code']}")] = {name: _to_text(value) for name, value in concept.items() if name != 'code'}
+
+        resources[(resource['resourceType'], resource['id'])] = elements
+        if resource['resourceType'] == 'CodeSystem' and 'url' in resource:
+            code_systems[resource['url']] = elements
+    _expand_included_code_systems(resources, code_systems)
+    return resources
+
+def _index_json_items(items: list, elements: dict) -> None:
+    for item in items:
+        elements[('question', item['linkId'])] = {name: _to_text(value) for name, value in item.items() if name not in ('linkId', 'item')}
+        _index_json_items(item.get('item', []), elements)
+
+def _to_text(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+def diff_resources(old_resources: dict, new_resources: dict, ignored_properties=VOLATILE_PROPERTIES) -> List[dict]:
+    """
+    Compares two resource indexes, ignoring the given properties.
+
+    Returns:
+        List[dict]: The changes, each with the resource type and id, the change ('added', 'removed' or
+            'changed'), the element kind and key (None for whole resources) and the old and new values.
+    """
+    changes = []
+    for resource_key in sorted(old_resources.keys() | new_resources.keys()):
+        resource_type, resource_id = resource_key
+        if resource_key not in new_resources:
+            changes.append(_change(resource_type, resource_id, 'removed'))
+            continue
+        if resource_key not in old_resources:
+            changes.append(_change(resource_type, resource_id, 'added'))
+            continue
+
+        old_elements, new_elements = old_resources[resource_key], new_resources[resource_key]
+        for element_key in sorted(old_elements.keys() | new_elements.keys()):
+            if element_key[0] == 'property' and element_key[1] in ignored_properties:
+                continue
+            old_value, new_value = old_elements.get(element_key), new_elements.get(element_key)
+            if old_value == new_value:
+                continue
+            change = 'added' if element_key not in old_elements else 'removed' if element_key not in new_elements else 'changed'
+            changes.append(_change(resource_type, resource_id, change, element_key, old_value, new_value))
+    return changes
+
+def _change(resource_type, resource_id, change, element_key=None, old_value=None, new_value=None) -> dict:
+    return {
+        'resource_type': resource_type,
+        'id': resource_id,
+        'change': change,
+        'element': element_key[0] if element_key else None,
+        'key': element_key[1] if element_key else None,
+        'old': old_value,
+        'new': new_value,
+    }
+
+def diff_trees(old_tree, new_tree, source: str = 'fsh', ignored_properties=VOLATILE_PROPERTIES) -> Dict[str, List[dict]]:
+    """
+    Compares two output trees, e.g. two output generations, per DSCN or LPDS health board project.
+
+    Args:
+        old_tree: The old output folder or generation folder.
+        new_tree: The new output folder or generation folder.
+        source (str): 'fsh' to compare the FSH files, 'json' to compare the FHIR resources generated by SUSHI.
+        ignored_properties: Resource properties that are not compared, by default the run dependent versions and dates.
+
+    Returns:
+        dict: The changes per project. Projects without changes are left out.
+    """
+    index_project = index_json_project if source == 'json' else index_fsh_project
+    old_projects, new_projects = find_projects(old_tree), find_projects(new_tree)
+
+    changes = {}
+    for project in sorted(old_projects.keys() | new_projects.keys()):
+        old_resources = index_project(old_projects[project]) if project in old_projects else {}
+        new_resources = index_project(new_projects[project]) if project in new_projects else {}
+        project_changes = diff_resources(old_resources, new_resources, ignored_properties)
+        if project_changes:
+            changes[project] = project_changes
+        logging.info(f'Compared {len(old_resources)} and {len(new_resources)} resources of {project}: {len(project_changes)} changes')
+    return changes
+
+def format_diff(changes: Dict[str, List[dict]]) -> str:
+    """Formats the changes of diff_trees as a readable report."""
+    if not changes:
+        return 'No differences.'
+
+    lines = []
+    for project, project_changes in changes.items():
+        lines.append(f'{project}: {len(project_changes)} changes')
+        for change in project_changes:
+            resource = f"{change['resource_type']}/{change['id']}"
+            if change['element'] is None:
+                lines.append(f"  {change['change']} {resource}")
+                continue
+            lines.append(f"  {change['change']} {change['element']} {change['key']} in {resource}")
+            if change['change'] == 'changed' and isinstance(change['old'], dict):
+                for name in sorted(change['old'].keys() | change['new'].keys()):
+                    if change['old'].get(name) != change['new'].get(name):
+                        lines.append(f"      {name}: {change['old'].get(name)} -> {change['new'].get(name)}")
+            elif change['change'] == 'changed':
+                lines.append(f"      {change['old']} -> {change['new']}")
+    return '\n'.join(lines)
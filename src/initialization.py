@@ -1,5 +1,4 @@
-import logging, os, glob, shutil
-import logging
+import logging, os
 from openpyxl import load_workbook
 
 def initiate_logging(output_folder):
@@ -44,25 +43,3 @@ def initiate_logging(output_folder):
 
     # Test message
     logger.info('Logging initiated')
-
-def delete_output_folder_contents(output_folder):
-    """ 
-    Deletes the contents of the entire output folder specified by the given path.
-
-    :param output_folder_path: The path to the output folder whose contents will be deleted.
-
-    This function iterates through all files and subdirectories in the specified folder and deletes them.
-    If the folder does not exist, a warning message will be printed.
-    """
-    if os.path.exists(output_folder):
-        files = glob.glob(output_folder + '*')
-        for f in files:
-            if os.path.isfile(f):
-                os.remove(f)
-            elif os.path.isdir(f):
-                shutil.rmtree(f)
-        print(f"Deleted the contents of the output folder: {output_folder}")
-        logging.info(f"Deleted the contents of the output folder: {output_folder}")
-    else:
-        print(f"Output folder {output_folder} not found!")
-        logging.warning(f"Output folder {output_folder} not found!")
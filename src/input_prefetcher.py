@@ -0,0 +1,92 @@
+import logging, os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+from src.constants import INPUT_PREFETCH_DEPTH, INPUT_PREFETCH_MAX_BYTES, INPUT_PREFETCH_THREADS
+
+def read_input(input_path: str) -> Union[bytes, dict]:
+    """
+    Reads a form definition fully into memory: the bytes of a file, or for a `.csvform` folder
+    a dict with the bytes of every file in it by file name.
+    """
+    if os.path.isdir(input_path):
+        return {f.name: f.read_bytes() for f in sorted(Path(input_path).iterdir()) if f.is_file()}
+    with open(input_path, 'rb') as input_file:
+        return input_file.read()
+
+def get_input_size(input_path: str) -> int:
+    try:
+        if os.path.isdir(input_path):
+            return sum(f.stat().st_size for f in Path(input_path).iterdir() if f.is_file())
+        return os.path.getsize(input_path)
+    except OSError:
+        return 0
+
+class Input_prefetcher:
+
+    def __init__(self, input_paths: List[str], depth: int = INPUT_PREFETCH_DEPTH, max_bytes: int = INPUT_PREFETCH_MAX_BYTES,
+                 threads: int = INPUT_PREFETCH_THREADS, memory_monitor=None):
+        """
+        Reads the next form definitions into memory in background threads while the current one is parsed, so
+        parsing does not wait for slow or network storage. Iterating yields each input path with its content,
+        in the order of `input_paths`.
+
+        At most `depth` forms are read ahead, and their total size stays below `max_bytes`, except that the
+        next form is always read even if it is larger. The form being parsed is not counted. Files are read
+        into buffers rather than memory-mapped, the workbooks are parsed from memory either way. With the memory
+        budget of a `memory_monitor`, forms are only read ahead while the buffered bytes fit in what is left of it.
+
+        Args:
+            input_paths (List[str]): The form definitions, in the order they are parsed.
+            depth (int): The number of forms read ahead, 0 disables prefetching.
+            max_bytes (int): The maximum size of the forms read ahead.
+            threads (int): The number of reading threads.
+            memory_monitor (Memory_monitor, optional): Its memory budget also bounds the forms read ahead.
+        """
+        self.input_paths = list(input_paths)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.memory_monitor = memory_monitor
+
+    def __len__(self) -> int:
+        return len(self.input_paths)
+
+    def __iter__(self) -> Iterator[Tuple[str, Union[bytes, dict]]]:
+        """
+        Yields (input path, content) tuples. The content is None if prefetching is disabled or the read failed,
+        the form is then read from its path, so read errors are reported when the form is loaded.
+        """
+        if self.depth <= 0:
+            for input_path in self.input_paths:
+                yield input_path, None
+            return
+
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='prefetch') as executor:
+            pending = deque()
+            buffered_bytes = 0
+            next_index = 0
+
+            while next_index < len(self.input_paths) or pending:
+                # Read ahead as far as the depth and the buffer size allow
+                while next_index < len(self.input_paths) and len(pending) < self.depth:
+                    size = get_input_size(self.input_paths[next_index])
+                    if pending and (buffered_bytes + size > self.max_bytes or not self._fits_budget(buffered_bytes + size)):
+                        break
+                    pending.append((self.input_paths[next_index], size, executor.submit(read_input, self.input_paths[next_index])))
+                    buffered_bytes += size
+                    next_index += 1
+
+                input_path, size, future = pending.popleft()
+                buffered_bytes -= size
+                try:
+                    content = future.result()
+                except OSError as e:
+                    logging.warning(f'Could not prefetch {input_path}: {str(e)}')
+                    content = None
+                yield input_path, content
+
+    def _fits_budget(self, buffered_bytes: int) -> bool:
+        headroom = self.memory_monitor.get_budget_headroom() if self.memory_monitor is not None else None
+        return headroom is None or buffered_bytes <= headroom
@@ -0,0 +1,230 @@
+import json, logging, os, statistics, sys, threading, tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import List
+import pandas as pd
+from src.constants import XLSX_MEMORY_EXPANSION_FACTOR, MEMORY_SAMPLING_INTERVAL
+
+def get_rss_bytes() -> int:
+    """Returns the resident set size of this process in bytes, or None if it cannot be determined."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+def get_lines_size(lines: list) -> int:
+    """Returns the approximate size in bytes of a list of FSH lines, including the strings."""
+    if not isinstance(lines, list):
+        return 0
+    return sys.getsizeof(lines) + sum(sys.getsizeof(line) for line in lines)
+
+def get_fsh_lines_list_size(fsh_lines_list: list) -> int:
+    """Returns the approximate size in bytes of an aggregated FSH lines list as returned by convert_to_fsh."""
+    return sys.getsizeof(fsh_lines_list) + sum(get_lines_size(part) for entry in fsh_lines_list for part in entry)
+
+def get_dataframe_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum()) if isinstance(df, pd.DataFrame) else 0
+
+class Memory_monitor:
+
+    def __init__(self, trace: bool = False, budget_bytes: int = None):
+        """
+        Records memory use per stage and per form, and checks the memory budget.
+
+        Args:
+            trace (bool): Record Python allocations with tracemalloc. This slows the run down noticeably,
+                so it is only enabled for memory reports.
+            budget_bytes (int, optional): The memory budget for the whole process in bytes.
+        """
+        self.trace = trace
+        self.budget_bytes = budget_bytes
+        self.stages = []
+        self.forms = {}
+        self.aggregates = {}
+        self.peak_rss = get_rss_bytes() or 0
+        self.expansion_factors = []
+        self._open_traced_peaks = []
+        self._sampler = _Rss_sampler()
+
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def measure(self, stage: str, form: str = None):
+        """
+        Measures the traced and resident memory of the code run inside the context.
+        Contexts can be nested, e.g. per form inside a stage. The RSS of all open contexts is sampled by a
+        single background thread of the monitor.
+        """
+        traced_before = tracemalloc.get_traced_memory()[0] if self.trace else 0
+        self._reset_traced_peak()
+        traced_peak = [traced_before]
+        self._open_traced_peaks.append(traced_peak)
+        rss_before = self._sampler.sample()
+        rss_peak = [rss_before]
+
+        self._sampler.add(rss_peak)
+        try:
+            yield
+        finally:
+            self._sampler.remove(rss_peak)
+            self._reset_traced_peak()
+            self._open_traced_peaks.pop()
+
+            entry = {'stage': stage, 'form': form, 'rss_before': rss_before, 'rss_after': self._sampler.rss, 'rss_peak': rss_peak[0]}
+            if self.trace:
+                entry['traced_retained'] = tracemalloc.get_traced_memory()[0] - traced_before
+                entry['traced_peak'] = traced_peak[0] - traced_before
+            self.stages.append(entry)
+            self.peak_rss = max(self.peak_rss, rss_peak[0] or 0)
+
+    def _reset_traced_peak(self) -> None:
+        # Hand the peak so far to every open context before resetting it for the next one
+        if not self.trace:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_peak in self._open_traced_peaks:
+            open_peak[0] = max(open_peak[0], peak)
+        tracemalloc.reset_peak()
+
+    def record_form(self, xlsForm, input_size: int = None) -> None:
+        """
+        Records how much memory the raw and the stripped sheets of a loaded form take. With the `input_size` of the form
+        definition, the ratio between the memory used for loading the form and its size is measured for the budget estimates.
+        """
+        raw_sheets = getattr(xlsForm, 'xls_form', {})
+        form_entry = self.forms.setdefault(xlsForm.file_name, {})
+        form_entry.update({
+            'raw_sheets': sum(get_dataframe_size(df) for df in raw_sheets.values()) if isinstance(raw_sheets, dict) else 0,
+            'settings': get_dataframe_size(getattr(xlsForm, 'df_settings', None)),
+            'survey': get_dataframe_size(getattr(xlsForm, 'df_survey', None)),
+            'choices': get_dataframe_size(getattr(xlsForm, 'df_choices', None)),
+        })
+
+        if input_size:
+            # What stays in memory: the DataFrames, or the RSS the load retained if that is more, e.g. for the workbook objects
+            load_entry = next((entry for entry in reversed(self.stages) if entry['stage'] == 'load' and entry['form'] == xlsForm.file_name), None)
+            rss_growth = load_entry['rss_after'] - load_entry['rss_before'] if load_entry and None not in (load_entry['rss_before'], load_entry['rss_after']) else 0
+            loaded_size = max(sum(form_entry[sheets] for sheets in ('raw_sheets', 'settings', 'survey', 'choices')), rss_growth)
+            form_entry['input_size'] = input_size
+            self.expansion_factors.append(loaded_size / input_size)
+
+    def record_fsh_lines(self, file_name: str, fsh_entry: tuple) -> None:
+        """Records how much memory the FSH lines generated for a form take."""
+        self.forms.setdefault(file_name, {})['fsh_lines'] = sum(get_lines_size(part) for part in fsh_entry)
+
+    def record_aggregate(self, name: str, size: int) -> None:
+        self.aggregates[name] = size
+
+    def get_expansion_factor(self) -> float:
+        """
+        Returns the ratio between the memory a loaded form takes and the size of its file. It is the median of the forms
+        loaded so far, which leaves out one-off growth such as the imports of the first form, and XLSX_MEMORY_EXPANSION_FACTOR
+        before any form has been loaded.
+        """
+        return statistics.median(self.expansion_factors) if self.expansion_factors else XLSX_MEMORY_EXPANSION_FACTOR
+
+    def get_rss(self) -> int:
+        """Returns the current RSS in bytes, which is also recorded as a sample of all open contexts."""
+        return self._sampler.sample()
+
+    def would_exceed_budget(self, xls_files: List[str], extra_bytes: int = 0) -> bool:
+        """
+        Estimates whether loading all given files at once, on top of the current RSS and `extra_bytes`,
+        would exceed the memory budget.
+        """
+        if self.budget_bytes is None:
+            return False
+        input_size = sum(os.path.getsize(f) for f in xls_files if os.path.isfile(f))
+        estimate = (self.get_rss() or 0) + extra_bytes + int(input_size * self.get_expansion_factor())
+        logging.info(f'Estimated memory use for loading {len(xls_files)} forms: {_format_bytes(estimate)}, budget: {_format_bytes(self.budget_bytes)}')
+        return estimate > self.budget_bytes
+
+    def is_over_budget(self) -> bool:
+        if self.budget_bytes is None:
+            return False
+        rss = self.get_rss()
+        return rss is not None and rss > self.budget_bytes
+
+    def get_budget_headroom(self) -> int:
+        """Returns how many bytes the process can still grow within the budget, or None without a budget."""
+        if self.budget_bytes is None:
+            return None
+        return self.budget_bytes - (self.get_rss() or 0)
+
+    def write_report(self, report_path: str) -> None:
+        report = {
+            'budget_bytes': self.budget_bytes,
+            'expansion_factor': self.get_expansion_factor(),
+            'peak_rss_bytes': self.peak_rss,
+            'stages': self.stages,
+            'forms': self.forms,
+            'aggregates': self.aggregates,
+        }
+        with open(report_path, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+        logging.info(f'Peak RSS {_format_bytes(self.peak_rss)}, memory report written to {report_path}')
+        for stage in [s for s in self.stages if s['form'] is None]:
+            retained = f", retained {_format_bytes(stage['traced_retained'])}, traced peak {_format_bytes(stage['traced_peak'])}" if self.trace else ''
+            logging.info(f"Memory for stage {stage['stage']}: RSS peak {_format_bytes(stage['rss_peak'])}{retained}")
+
+def measure_memory(memory_monitor: Memory_monitor, stage: str, form: str = None):
+    """Returns the measuring context of the monitor, or a no-op context if there is no monitor."""
+    if memory_monitor is None:
+        return nullcontext()
+    return memory_monitor.measure(stage, form)
+
+class _Rss_sampler:
+
+    def __init__(self):
+        """
+        Samples the RSS in one background thread to catch peaks between the start and the end of the open
+        measuring contexts. The thread only runs while a context is open.
+        """
+        self.rss = get_rss_bytes()
+        self._peaks = []
+        self._lock = threading.Lock()
+        self._stop_event = None
+
+    def add(self, peak: list) -> None:
+        """Starts updating the peak, a one-element list, with every sample."""
+        with self._lock:
+            self._peaks.append(peak)
+            if self._stop_event is None and self.rss is not None:
+                self._stop_event = threading.Event()
+                threading.Thread(target=self._run, args=(self._stop_event,), name='rss-sampler', daemon=True).start()
+
+    def remove(self, peak: list) -> None:
+        """Takes a last sample for the peak and stops updating it."""
+        self.sample()
+        with self._lock:
+            # Peaks are compared by identity, nested contexts can have equal peaks
+            self._peaks = [open_peak for open_peak in self._peaks if open_peak is not peak]
+            if not self._peaks and self._stop_event is not None:
+                self._stop_event.set()
+                self._stop_event = None
+
+    def sample(self) -> int:
+        rss = get_rss_bytes()
+        if rss is not None:
+            self.rss = rss
+            with self._lock:
+                for peak in self._peaks:
+                    peak[0] = max(peak[0] or 0, rss)
+        return rss
+
+    def _run(self, stop_event: threading.Event) -> None:
+        while not stop_event.wait(MEMORY_SAMPLING_INTERVAL):
+            self.sample()
+
+def _format_bytes(size: int) -> str:
+    if size is None:
+        return 'unknown'
+    return f'{size / (1024 * 1024):.1f} MB'
@@ -1,10 +1,13 @@
+import re
 import pandas as pd
 import src.string_util as su
+import src.terminology_util as tu
 from datetime import datetime
 from src.models.XLS_Form import XLS_Form
 from src.constants import (
     QUESTION_REFERENCE_CS_URL_DSCN,
     QUESTION_REFERENCE_CS_URL_LPDS,
+    LPDS_HEALTHBOARD_ABBREVIATION_DICT,
     NHS_WALES_PUBLISHER,
     COPYRIGHT_QUESTION_REFERENCE_DSCN,
     FHIR_STATUS_DRAFT
@@ -37,8 +40,7 @@ class Fsh_question_reference:
                 and row["name"] != ''
                 and field_type not in {'note', 'begin_group', 'end_group'}
             ):
-                label = row["label"] if pd.notna(row["label"]) and row["label"] != '' else ''
-                code_tuple = (row["name"], su.escape_quotes(label))
+                code_tuple = get_question_code(self.data, row)
                 if code_tuple not in self.question_codes:
                     self.question_codes.append(code_tuple)
 
@@ -46,19 +48,96 @@ class Fsh_question_reference:
         """Return the list of question codes from this form."""
         return self.question_codes
 
+def get_question_code(data: XLS_Form, row: pd.Series) -> tuple:
+    """
+    Returns the question code of a survey row: its name and escaped label, and if the label has translations,
+    the (language code, escaped label) translations as third element. Translations become designations.
+    """
+    label = row["label"] if pd.notna(row["label"]) and row["label"] != '' else ''
+    code_tuple = (row["name"], su.escape_quotes(label))
+    translations = tuple((language, su.escape_quotes(translation)) for language, translation in data.get_label_translations(row))
+    if translations:
+        code_tuple += (translations,)
+    return code_tuple
+
+def is_question_reference_code(code: str) -> bool:
+    """Returns whether a question code is added to the QuestionReference CodeSystems, which leave out codes that end with "_group" or contain "group"."""
+    return not (code.endswith('_group') or 'group' in code.lower())
+
+def get_question_reference_cs_url(lpds_healthboard_abbreviation: str = None) -> str:
+    """
+    Returns the url of the QuestionReference CodeSystem of DSCN, or of the CodeSystem of an LPDS health board
+    below its canonical URL. Health boards without a canonical URL use QUESTION_REFERENCE_CS_URL_LPDS.
+    """
+    if not lpds_healthboard_abbreviation:
+        return QUESTION_REFERENCE_CS_URL_DSCN
+    canonical_url = LPDS_HEALTHBOARD_ABBREVIATION_DICT.get(lpds_healthboard_abbreviation)
+    if canonical_url is None:
+        return QUESTION_REFERENCE_CS_URL_LPDS
+    return f'{canonical_url}/CodeSystem/LPDSQuestionReferenceCS'
+
+def read_question_codes(fsh_file_path) -> list:
+    """
+    Reads the question codes back from a generated QuestionReference CodeSystem FSH file.
+
+    Args:
+        fsh_file_path: Path of the FSH file.
+
+    Returns:
+        list: (code, display) tuples in the order of the file, the displays are still escaped. Codes with designations
+            have their (language code, label) translations as third element.
+    """
+    code_pattern = re.compile(r'^\* #(\S+) "(.*)"$')
+    designation_language_pattern = re.compile(r'^  \* \^designation\[[+0]\]\.language = #(\S+)$')
+    designation_value_pattern = re.compile(r'^  \* \^designation\[=\]\.value = "(.*)"$')
+    question_codes = []
+    translations = []
+    with open(fsh_file_path, encoding='utf-8') as fsh_file:
+        for line in fsh_file:
+            line = line.rstrip('\n')
+            match = code_pattern.match(line)
+            if match:
+                question_codes.append((match.group(1), match.group(2)))
+                translations = []
+                continue
+            match = designation_language_pattern.match(line)
+            if match and question_codes:
+                translations.append([match.group(1), None])
+                continue
+            match = designation_value_pattern.match(line)
+            if match and translations:
+                translations[-1][1] = match.group(1)
+                question_codes[-1] = question_codes[-1][:2] + (tuple(tuple(translation) for translation in translations),)
+    return question_codes
+
+def read_questionnaire_question_codes(fsh_file_path) -> set:
+    """Reads the question reference codes used by the items of a generated Questionnaire FSH file."""
+    code_pattern = re.compile(r'^\s*\* code = \S+#(\S+)$')
+    question_codes = set()
+    with open(fsh_file_path, encoding='utf-8') as fsh_file:
+        for line in fsh_file:
+            match = code_pattern.match(line.rstrip('\n'))
+            if match:
+                question_codes.add(match.group(1))
+    return question_codes
+
 class Fsh_question_reference_codesystem:
 
-    def __init__(self, all_question_codes: list, is_lpds: bool = False):
+    def __init__(self, all_question_codes: list, is_lpds: bool = False, version_date: datetime = None, url: str = None):
         """
         FSH representation of consolidated question reference CodeSystem.
 
         Args:
             all_question_codes (list): List of all unique question codes from multiple XLS forms.
             is_lpds (bool): Whether this is for LPDS or DSCN forms.
+            version_date (datetime, optional): The date used as ^version. Defaults to today, pass a fixed date for reproducible output.
+            url (str, optional): The ^url of an LPDS CodeSystem, see get_question_reference_cs_url. Defaults to QUESTION_REFERENCE_CS_URL_LPDS.
         """
 
         self.all_question_codes = all_question_codes
         self.is_lpds = is_lpds
+        self.version_date = version_date
+        self.url = url
         self.lines = []
 
         self._generate_question_reference_codesystem()
@@ -69,7 +148,7 @@ class Fsh_question_reference_codesystem:
         if self.is_lpds:
             cs_name = "LPDSQuestionReferenceCS"
             cs_id = "LPDSQuestionReferenceCS"
-            cs_url = QUESTION_REFERENCE_CS_URL_LPDS
+            cs_url = self.url or QUESTION_REFERENCE_CS_URL_LPDS
             title = "LPDS Question Reference CodeSystem"
             description = "Question Reference codes for the questions in LPDS PROM Questionnaires."
             publisher = NHS_WALES_PUBLISHER
@@ -86,8 +165,8 @@ class Fsh_question_reference_codesystem:
             copyright = COPYRIGHT_QUESTION_REFERENCE_DSCN
             copyright_line = [f'* ^copyright = "{copyright}"']
 
-        # Generate current date in YYYYMMDD format
-        current_date = datetime.now().strftime("%Y%m%d")
+        # Generate the version date in YYYYMMDD format
+        current_date = (self.version_date or datetime.now()).strftime("%Y%m%d")
 
         # Build the header
         header_lines = [
@@ -114,13 +193,17 @@ class Fsh_question_reference_codesystem:
         self.lines.extend(header_lines)
 
         # Add all unique codes (deduplicate by code only, keep first occurrence's display text)
-        # Skip group entries that end with "_group" or contain "group"
+        # Skip group entries, see is_question_reference_code
         seen_codes = set()
-        for code, display in self.all_question_codes:
-            if not (code.endswith('_group') or 'group' in code.lower()):
+        for question_code in self.all_question_codes:
+            code, display = question_code[0], question_code[1]
+            if is_question_reference_code(code):
                 if code not in seen_codes:
                     code_line = f'* #{code} "{display}"'
                     self.lines.append(code_line)
+                    # Translations of the question label, see Fsh_question_reference
+                    if len(question_code) > 2:
+                        self.lines.extend(tu.get_designation_lines(question_code[2]))
                     seen_codes.add(code)
 
         self.lines.append('')
\ No newline at end of file
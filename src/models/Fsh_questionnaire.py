@@ -3,26 +3,39 @@ from src.models.XLS_Form import XLS_Form
 import src.string_util as su
 import pandas as pd
 import src.terminology_util as tu
+from src.external_choices import parse_external_choice_type
+from src.models.Fsh_question_reference import get_question_code, get_question_reference_cs_url
 from src.constants import (
-    QUESTION_REFERENCE_CS_URL_DSCN,
     NHS_WALES_PUBLISHER,
     COPYRIGHT_QUESTIONNAIRE,
     ENTRY_FORMAT_EXTENSION_URL,
     SECURITY_LABEL_EXTENSION_URL,
+    TRANSLATION_EXTENSION_URL,
     FHIR_STATUS_DRAFT
 )
 
 class Fsh_questionnaire:
 
-    def __init__(self, data: XLS_Form):
+    def __init__(self, data: XLS_Form, id_registry=None, lpds_question_reference: bool = False):
         """
         FSH representation of a questionnaire. Transforms a XLSForm into a FSH questionnaire.
 
+        The items of DSCN questionnaires have an item.code from the QuestionReference CodeSystem. With
+        `lpds_question_reference`, the items of LPDS questionnaires have an item.code from the QuestionReference
+        CodeSystem of their health board, and the codes are collected in `question_codes` while the items are converted.
+
         Args:
             data (XlsFormData): The data from an XLSForm.
+            id_registry (Fhir_id_registry, optional): The id registry of the project the form belongs to.
+            lpds_question_reference (bool): Whether LPDS questionnaires have item codes.
         """
         
         self.data = data
+        self.id_registry = id_registry
+        self.question_codes = []
+        self.question_reference_url = None
+        if not data.lpds_healthboard_abbreviation or lpds_question_reference:
+            self.question_reference_url = get_question_reference_cs_url(data.lpds_healthboard_abbreviation)
 
         # Check if 'sensitive' column exists in the survey sheet and warn if missing
         if 'sensitive' not in data.df_survey.columns:
@@ -61,6 +74,9 @@ class Fsh_questionnaire:
             copyright = COPYRIGHT_QUESTIONNAIRE
             publisher = NHS_WALES_PUBLISHER
 
+        if id_registry is not None:
+            instance_id = id_registry.register('Questionnaire', (data.input_path, data.short_name, data.lpds_healthboard_abbreviation), instance_id, data.input_path)
+
         self.lines = [
             f'Instance: {instance_id}',
             'InstanceOf: Questionnaire',
@@ -72,8 +88,11 @@ class Fsh_questionnaire:
             f'* publisher = "{publisher}"',
             f'* description = "PSOM Questionnaire: {data.title}."',
             f'* copyright = "{copyright}"',
-            '',
             ]
+        # The labels are in the default language, their translations are extensions of the item texts
+        if data.default_language and data.label_translation_columns:
+            self.lines.append(f'* language = #{data.default_language}')
+        self.lines.append('')
         
         self.indent_level = 0
         for _, row in data.df_survey.iterrows():
@@ -138,6 +157,7 @@ class Fsh_questionnaire:
             logging.warning(warning_msg)
         else:
             self.lines.append(f'{self.indent}  * text = "{su.escape_quotes(row["label"])}"')
+            self._add_text_translations(row)
         
         self.lines.append(f'{self.indent}  * type = #group')
         self.indent_level += 1
@@ -154,10 +174,13 @@ class Fsh_questionnaire:
             self.lines.append(f'{self.indent}  * extension[=].valueString = "{row["format"]}"')
         
         self.lines.append(f'{self.indent}  * linkId = "{row["name"]}"')
-        # Only add item.code for DSCN questionnaires, not for LPDS
+        # Only add item.code for DSCN questionnaires, and for LPDS if their health board has a QuestionReference CodeSystem
         # Also exclude display items (notes) as they are not actual questions
-        if not self.data.lpds_healthboard_abbreviation and type != 'display':
-            self.lines.append(f'{self.indent}  * code = {QUESTION_REFERENCE_CS_URL_DSCN}#{row["name"]}')
+        if self.question_reference_url and type != 'display':
+            self.lines.append(f'{self.indent}  * code = {self.question_reference_url}#{row["name"]}')
+            question_code = get_question_code(self.data, row)
+            if question_code not in self.question_codes:
+                self.question_codes.append(question_code)
         
         # Check if label is empty and warn, omit text field if empty
         label_value = row["label"]
@@ -166,6 +189,7 @@ class Fsh_questionnaire:
             logging.warning(warning_msg)
         else:
             self.lines.append(f'{self.indent}  * text = "{su.escape_quotes(row["label"])}"')
+            self._add_text_translations(row)
         
         self.lines.append(f'{self.indent}  * type = #{type}')
         
@@ -173,19 +197,31 @@ class Fsh_questionnaire:
             self.lines.append(f'{self.indent}  * repeats = true')
 
         if answerValueset:
-            # Handle both select_one and select_multiple patterns
-            if self.select_one_pattern.match(row["type"]):
+            # Handle both select_one and select_multiple patterns, the list of select_one_from_file is named after its CSV file
+            external_choice_type = parse_external_choice_type(row["type"])
+            if external_choice_type is not None:
+                ValueSetName = external_choice_type[0]
+            elif self.select_one_pattern.match(row["type"]):
                 ValueSetName = self.select_one_pattern.sub('', row["type"])
             elif self.select_multiple_pattern.match(row["type"]):
                 ValueSetName = self.select_multiple_pattern.sub('', row["type"])
             else:
                 ValueSetName = row["type"]  # fallback
             
-            ValueSetId = tu.generate_vs_or_cs_id(self.data.short_name, ValueSetName, 'VS', self.data.lpds_healthboard_abbreviation)
+            ValueSetId = tu.generate_vs_or_cs_id(self.data.short_name, ValueSetName, 'VS', self.data.lpds_healthboard_abbreviation, self.id_registry, self.data.input_path)
             self.lines.append(f'{self.indent}  * answerValueSet = Canonical({ValueSetId})')
 
         self.lines.append('')
 
+    def _add_text_translations(self, row: pd.Series):
+        """Add a translation extension to the item text for every label::<language> column."""
+        for language, label in self.data.get_label_translations(row):
+            self.lines.append(f'{self.indent}  * text.extension[+].url = "{TRANSLATION_EXTENSION_URL}"')
+            self.lines.append(f'{self.indent}  * text.extension[=].extension[+].url = "lang"')
+            self.lines.append(f'{self.indent}  * text.extension[=].extension[=].valueCode = #{language}')
+            self.lines.append(f'{self.indent}  * text.extension[=].extension[+].url = "content"')
+            self.lines.append(f'{self.indent}  * text.extension[=].extension[=].valueString = "{su.escape_quotes(label)}"')
+
     def _classify_field_type(self, field_type: str) -> str:
         """
         Classify XLSForm field types using robust pattern matching.
@@ -1,5 +1,6 @@
 import src.string_util as su
 import src.terminology_util as tu
+from src.external_choices import External_choice_list
 from src.models.XLS_Form import XLS_Form
 from src.constants import (
     COPYRIGHT_CS_LPDS,
@@ -12,27 +13,74 @@ from src.constants import (
 
 class Fsh_terminology:
 
-    def __init__(self, data: XLS_Form):
+    def __init__(self, data: XLS_Form, id_registry=None, compact_valueset_threshold: int = None):
         """
         FSH representation of terminology systems. Transforms an XLSForm into FSH CodeSystems and FSH ValueSets.
 
+        The codes of select_one_from_file and select_one_external lists are not read here. These lists are in
+        `external_choice_lists` and their codes are streamed from the CSV file when the FSH files are written.
+
+        The ValueSet of a list holds all codes of its CodeSystem. Lists with at least `compact_valueset_threshold` codes
+        get a ValueSet that includes the codes of the CodeSystem instead of enumerating them a second time.
+
         Args:
             data (XlsFormData): The data from an XLSForm.
+            id_registry (Fhir_id_registry, optional): The id registry of the project the form belongs to.
+            compact_valueset_threshold (int, optional): The number of codes from which ValueSets include the whole CodeSystem.
+                Defaults to None, ValueSets always enumerate their codes.
         """
 
         self.data = data
         self.lines = []
+        self.external_choice_lists = []
+        list_sizes = data.df_choices['list_name'].value_counts()
 
         for list_name in data.df_choices['list_name'].unique():
             proper_list_name = su.convert_to_camel_case(list_name)
                 
-            cs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'CS', data.lpds_healthboard_abbreviation)
-            vs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'VS', data.lpds_healthboard_abbreviation)
+            cs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'CS', data.lpds_healthboard_abbreviation, id_registry, data.input_path)
+            vs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'VS', data.lpds_healthboard_abbreviation, id_registry, data.input_path)
 
             self.fill_cs_or_vs(cs_id, list_name, proper_list_name, "")
-            self.fill_cs_or_vs(vs_id, list_name, proper_list_name, cs_id)
+            self.fill_cs_or_vs(vs_id, list_name, proper_list_name, cs_id,
+                               compact_valueset_threshold is not None and list_sizes[list_name] >= compact_valueset_threshold)
+
+        for list_name, source_path, list_filter in data.external_choices:
+            proper_list_name = su.convert_to_camel_case(list_name)
+
+            cs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'CS', data.lpds_healthboard_abbreviation, id_registry, data.input_path)
+            vs_id = tu.generate_vs_or_cs_id(data.short_name, list_name, 'VS', data.lpds_healthboard_abbreviation, id_registry, data.input_path)
+
+            # The ValueSet includes the whole CodeSystem instead of listing thousands of codes again
+            cs_lines = self.get_cs_or_vs_header_lines(cs_id, proper_list_name, "")
+            vs_lines = self.get_cs_or_vs_header_lines(vs_id, proper_list_name, cs_id) + [f'* include codes from system {cs_id}', '']
+            self.external_choice_lists.append(External_choice_list(
+                source_path, list_filter, f'{data.short_name}-v{data.version}.{proper_list_name}.fsh', cs_lines, vs_lines,
+                lambda language: data.parse_language_code(language, data.file_name)))
     
-    def fill_cs_or_vs(self, id: str, list_name:str, proper_list_name: str, cs_id: str) -> None:
+    def fill_cs_or_vs(self, id: str, list_name:str, proper_list_name: str, cs_id: str, include_whole_codesystem: bool = False) -> None:
+        vs_or_cs_lines = self.get_cs_or_vs_header_lines(id, proper_list_name, cs_id)
+
+        if cs_id != "" and include_whole_codesystem:
+            # The ValueSet covers the whole CodeSystem, so its codes are not repeated
+            vs_or_cs_lines.append(f'* include codes from system {cs_id}')
+            self.lines.extend(vs_or_cs_lines)
+            self.lines.append('')
+            return
+
+        for _, row in self.data.df_choices[self.data.df_choices['list_name'] == list_name].iterrows():
+            code = f'* {cs_id}#{row["name"]} "{su.escape_quotes(row["label"])}"'
+            vs_or_cs_lines.append(code)
+
+            # Labels in other languages are designations of the code
+            if cs_id == "":
+                vs_or_cs_lines.extend(tu.get_designation_lines([(language, su.escape_quotes(label)) for language, label in self.data.get_label_translations(row)]))
+
+        self.lines.extend(vs_or_cs_lines)
+        self.lines.append('')
+
+    def get_cs_or_vs_header_lines(self, id: str, proper_list_name: str, cs_id: str) -> list:
+        """Returns the lines of a CodeSystem, or of a ValueSet of the CodeSystem `cs_id`, up to its codes."""
 
         if cs_id != "":
             name_addition = "VS"
@@ -75,15 +123,9 @@ class Fsh_terminology:
             vs_or_cs_lines.append('* ^caseSensitive = true')
             
         vs_or_cs_lines.append('')
-
-        for _, row in self.data.df_choices[self.data.df_choices['list_name'] == list_name].iterrows():
-            code = f'* {cs_id}#{row["name"]} "{su.escape_quotes(row["label"])}"'
-            vs_or_cs_lines.append(code)
-
-        self.lines.extend(vs_or_cs_lines)
-        self.lines.append('')
+        return vs_or_cs_lines
 
     
 
 
-    
\ No newline at end of file
+    
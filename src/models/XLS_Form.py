@@ -1,22 +1,30 @@
 import pandas as pd
-import logging
+import logging, os, re
 import src.string_util as su
 import numpy as np
+from pathlib import Path
+from src.external_choices import parse_external_choice_type
+from src.constants import LANGUAGE_CODES
+
+LABEL_LANGUAGE_PATTERN = re.compile(r'^label::\s*(.*?)\s*$')
+LANGUAGE_CODE_PATTERN = re.compile(r'^(.*?)\s*\(([A-Za-z]{2,3}(?:-[A-Za-z0-9]+)*)\)$')
 
 class XLS_Form:
-    def __init__(self, input_path: str, file_name: str, lpds_healthboard_abbreviation_dict: dict):
+    def __init__(self, input_path: str, file_name: str, lpds_healthboard_abbreviation_dict: dict, sheets: dict = None):
         """
         Represents an XLSForm. Reads the XLSForm and processes it into a XlsFormData object.
 
         Args:
             data (XlsFormData): The data from an XLSForm.
+            sheets (dict, optional): The settings, survey and choices DataFrames read by a form reader (see form_readers).
+                Without them, the input path is read as an .xlsx workbook.
         """
         
         #set inpiut path
         self.input_path = input_path
         self.file_name = file_name
         self.lpds_healthboard_abbreviation_dict = lpds_healthboard_abbreviation_dict
-        self.xls_form = self.xls_to_dataframe(input_path)
+        self.xls_form = sheets if sheets is not None else self.xls_to_dataframe(input_path)
 
         # settings
         self.df_settings = self.xls_form['settings'].apply(lambda col: col.map(lambda x: x.strip() if isinstance(x, str) else x))
@@ -40,6 +48,8 @@ class XLS_Form:
             self.set_and_parse_title(self.df_settings, self.file_name)
             self.set_and_parse_form_id(self.df_settings, self.file_name)
             self.set_and_parse_lpds_healthboard_abbreviation(self.df_settings, self.file_name, self.lpds_healthboard_abbreviation_dict)
+            self.set_and_parse_label_languages(self.df_settings, self.file_name)
+            self.set_and_parse_external_choices(self.df_survey, self.file_name)
 
         except (ValueError, TypeError) as e:
             logging.exception(f'Error processing {self.file_name}: {str(e)}')
@@ -137,6 +147,75 @@ class XLS_Form:
 
         self.lpds_healthboard_abbreviation = lpds_healthboard_abbreviation
     
+    def set_and_parse_label_languages(self, df_settings: pd.DataFrame, file_name: str):
+        """
+        Finds the label::<language> columns of the survey and choices sheets, e.g. label::English (en) and label::Welsh (cy).
+
+        The plain label column is in the default_language of the settings. Without a plain label column, the column of
+        the default language, or else the first language column, is used as label. The other language columns are
+        translations of the label, emitted as translation extensions and designations.
+        """
+        self.default_language = None
+        if 'default_language' in df_settings.columns and str(df_settings['default_language'].values[0]).strip() not in ('', 'default'):
+            self.default_language = self.parse_language_code(str(df_settings['default_language'].values[0]), file_name)
+
+        self.label_translation_columns = []
+        for df in (self.df_survey, self.df_choices):
+            language_columns = []
+            for column in df.columns:
+                match = LABEL_LANGUAGE_PATTERN.match(str(column))
+                if match:
+                    language = self.parse_language_code(match.group(1), file_name)
+                    if language is not None:
+                        language_columns.append((column, language))
+
+            if language_columns and 'label' not in df.columns:
+                label_column, language = next(((column, language) for column, language in language_columns if language == self.default_language), language_columns[0])
+                df['label'] = df[label_column]
+                if self.default_language is None:
+                    self.default_language = language
+
+            for column, language in language_columns:
+                if language != self.default_language and (column, language) not in self.label_translation_columns:
+                    self.label_translation_columns.append((column, language))
+
+    def parse_language_code(self, language: str, file_name: str):
+        """Returns the language code of an XLSForm language such as 'Welsh (cy)', 'Welsh' or 'cy', or None if it is unknown."""
+        match = LANGUAGE_CODE_PATTERN.match(language.strip())
+        if match:
+            return match.group(2)
+        if language.strip().lower() in LANGUAGE_CODES:
+            return LANGUAGE_CODES[language.strip().lower()]
+        if re.fullmatch(r'[a-z]{2,3}(?:-[A-Za-z0-9]+)*', language.strip()):
+            return language.strip()
+        logging.warning(f"{file_name}: language '{language}' has no language code, add it in brackets, e.g. 'Welsh (cy)'. Its labels are ignored.")
+        return None
+
+    def set_and_parse_external_choices(self, df_survey: pd.DataFrame, file_name: str):
+        """
+        Finds the select_one_from_file and select_one_external questions, whose choices are in a CSV file next to the
+        form instead of in the choices sheet. For a `.csvform` folder, the CSV files are in the folder.
+        """
+        base_folder = Path(self.input_path) if os.path.isdir(self.input_path) else Path(self.input_path).parent
+        self.external_choices = []
+        for field_type in df_survey['type'] if 'type' in df_survey.columns else []:
+            external_choice_type = parse_external_choice_type(field_type)
+            if external_choice_type is None:
+                continue
+            list_name, source_file_name, list_filter = external_choice_type
+            if list_name in [external_choice[0] for external_choice in self.external_choices]:
+                continue
+            source_path = base_folder / source_file_name
+            if not source_path.is_file():
+                logging.error(f"{file_name}: the choices of '{field_type}' are not found, {source_path} is missing.")
+                raise ValueError(f"The choices of '{field_type}' are not found, {source_path} is missing.")
+            self.external_choices.append((list_name, str(source_path), list_filter))
+
+    def get_label_translations(self, row: pd.Series) -> list:
+        """Returns the (language code, label) translations of a survey or choices row, leaving out empty labels."""
+        return [(language, str(row[column]).strip()) for column, language in self.label_translation_columns
+                if column in row and not pd.isna(row[column]) and str(row[column]).strip() != '']
+
     def __str__(self):
         return f"Name: {self.name}\nData: {self.data}"
     
@@ -0,0 +1,287 @@
+import json, logging, os, shutil, socket, sys, threading, time, filecmp
+from datetime import datetime
+from pathlib import Path
+from src.constants import (
+    DSCN_SUBFOLDER,
+    LPDS_SUBFOLDER,
+    OVERVIEW_FILE_NAME,
+    GENERATIONS_SUBFOLDER,
+    CURRENT_GENERATION_LINK,
+    GENERATION_COMPLETE_MARKER,
+    GENERATION_LOCK_FILE,
+    GENERATION_LOCK_MAX_AGE,
+    GENERATIONS_TO_KEEP
+)
+from src.checkpoints import is_resumable
+
+# Entries in the output folder that point into the current generation
+GENERATION_ENTRIES = [DSCN_SUBFOLDER, LPDS_SUBFOLDER, OVERVIEW_FILE_NAME]
+
+def create_generation(output_folder: str) -> Path:
+    """
+    Creates a fresh, empty generation folder below the output folder.
+
+    Every run writes its FSH files and SUSHI output into its own generation folder, so the
+    output of the previous run stays available to consumers until the new one is activated.
+    The generation is locked by this run until release_generation, see lock_generation.
+
+    Args:
+        output_folder (str): The output folder.
+
+    Returns:
+        Path: The newly created generation folder.
+    """
+    generations_folder = Path(output_folder) / GENERATIONS_SUBFOLDER
+    generations_folder.mkdir(parents=True, exist_ok=True)
+
+    generation_name = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    generation_folder = generations_folder / generation_name
+    generation_folder.mkdir()
+    lock_generation(generation_folder)
+
+    logging.info(f'Created output generation {generation_folder}')
+    return generation_folder
+
+def lock_generation(generation_folder: Path) -> None:
+    """
+    Marks a generation as being written by this process, so concurrent runs do not prune it while it is incomplete.
+    The lock holds the host name and process id of the run.
+    """
+    with open(Path(generation_folder) / GENERATION_LOCK_FILE, 'w', encoding='utf-8') as lock_file:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, lock_file)
+
+def release_generation(generation_folder: Path) -> None:
+    """Removes the lock of this run from a generation once the run has finished writing it."""
+    lock_path = Path(generation_folder) / GENERATION_LOCK_FILE
+    if lock_path.exists():
+        lock_path.unlink()
+
+def is_generation_locked(generation_folder: Path) -> bool:
+    """
+    Returns whether a run is still writing the generation. A lock of a process on this host that no longer
+    exists is stale. The lock of a run on another host, e.g. on shared network storage, is stale after
+    GENERATION_LOCK_MAX_AGE seconds.
+    """
+    lock_path = Path(generation_folder) / GENERATION_LOCK_FILE
+    try:
+        with open(lock_path, encoding='utf-8') as lock_file:
+            lock = json.load(lock_file)
+        lock_age = time.time() - lock_path.stat().st_mtime
+    except (OSError, ValueError):
+        return False
+
+    # os.kill terminates the process on Windows, so the age is used there
+    if lock.get('host') == socket.gethostname() and sys.platform != 'win32':
+        try:
+            os.kill(int(lock['pid']), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists, but belongs to another user
+            return True
+        except (ValueError, KeyError):
+            pass
+        else:
+            return True
+    return lock_age < GENERATION_LOCK_MAX_AGE
+
+def get_current_generation(output_folder: str) -> Path:
+    """
+    Returns the folder holding the currently published output, or None if there is none.
+
+    This is the generation the `current` link points to. Output folders created before
+    generations were introduced (or by the rename fallback) hold the projects directly,
+    in which case the output folder itself is returned.
+    """
+    output_path = Path(output_folder)
+    current_link = output_path / CURRENT_GENERATION_LINK
+
+    if current_link.is_symlink():
+        current = current_link.resolve()
+        return current if current.is_dir() else None
+
+    if any((output_path / entry).exists() and not (output_path / entry).is_symlink() for entry in GENERATION_ENTRIES):
+        return output_path
+
+    return None
+
+def list_completed_generations(output_folder: str) -> list:
+    """Returns the completed generations in the output folder, most recent first."""
+    generations_folder = Path(output_folder) / GENERATIONS_SUBFOLDER
+    if not generations_folder.is_dir():
+        return []
+    generations = [f for f in generations_folder.iterdir() if f.is_dir() and (f / GENERATION_COMPLETE_MARKER).exists()]
+    return sorted(generations, key=lambda f: f.name, reverse=True)
+
+def seed_generation(generation_folder: Path, source_generation: Path) -> None:
+    """
+    Fills a new generation with hardlinks to all files of an existing generation, so a run that only
+    reprocesses part of the forms still produces a complete output. Files that are rewritten are
+    detached from the source generation first (see output_sinks.open_for_writing).
+    """
+    for root, _, files in os.walk(source_generation):
+        target_folder = generation_folder / Path(root).relative_to(source_generation)
+        target_folder.mkdir(parents=True, exist_ok=True)
+        for file_name in files:
+            if file_name in (GENERATION_COMPLETE_MARKER, GENERATION_LOCK_FILE):
+                continue
+            try:
+                os.link(Path(root) / file_name, target_folder / file_name)
+            except OSError:
+                shutil.copy2(Path(root) / file_name, target_folder / file_name)
+
+    logging.info(f'Seeded {generation_folder} from {source_generation}')
+
+def reuse_unchanged_files(generation_folder: Path, previous_generation: Path) -> int:
+    """
+    Replaces files in the new generation that are identical to the previous generation by hardlinks.
+
+    Unchanged FSH files and SUSHI output then share their storage with the previous generation.
+    Generations are never modified after they have been activated, so sharing is safe.
+
+    Args:
+        generation_folder (Path): The generation that has just been written.
+        previous_generation (Path): The currently published generation.
+
+    Returns:
+        int: The number of files that are now hardlinks to the previous generation.
+    """
+    if previous_generation is None or not previous_generation.is_dir():
+        return 0
+
+    reused = 0
+    for root, _, files in os.walk(generation_folder):
+        for file_name in files:
+            new_file = Path(root) / file_name
+            old_file = previous_generation / new_file.relative_to(generation_folder)
+
+            if not old_file.is_file() or old_file.is_symlink():
+                continue
+            if os.path.samefile(new_file, old_file) or not filecmp.cmp(new_file, old_file, shallow=False):
+                continue
+
+            temporary_link = new_file.with_name(f'.{file_name}.link')
+            try:
+                os.link(old_file, temporary_link)
+                os.replace(temporary_link, new_file)
+            except OSError as e:
+                logging.warning(f'Could not hardlink {new_file} to the previous generation: {str(e)}. Keeping copies.')
+                if temporary_link.exists():
+                    temporary_link.unlink()
+                return reused
+            reused += 1
+
+    logging.info(f'Reused {reused} unchanged files from {previous_generation}')
+    return reused
+
+def activate_generation(output_folder: str, generation_folder: Path) -> None:
+    """
+    Makes the given generation the current output.
+
+    The `current` symlink in the output folder is swapped with a single atomic rename, and the
+    DSCN/LPDS folders and the overview file in the output folder are relative symlinks through
+    `current`. Consumers therefore either see the complete previous output or the complete new one.
+
+    If the file system does not support symlinks, the generation's entries are renamed into the
+    output folder one by one instead.
+    """
+    output_path = Path(output_folder)
+    (generation_folder / GENERATION_COMPLETE_MARKER).touch()
+
+    try:
+        _switch_current_link(output_path, generation_folder)
+        _link_generation_entries(output_path)
+    except (OSError, NotImplementedError) as e:
+        logging.warning(f'Could not activate {generation_folder} through symlinks: {str(e)}. Moving its contents into place instead.')
+        _move_generation_into_place(output_path, generation_folder)
+
+    print(f'Activated output generation {generation_folder.name}')
+    logging.info(f'Activated output generation {generation_folder}')
+
+def prune_generations_in_background(output_folder: str, keep: int = GENERATIONS_TO_KEEP) -> threading.Thread:
+    """
+    Deletes old generations in a background thread so the slow rmtree does not hold up the run.
+
+    The thread is not a daemon, so the interpreter waits for the pruning to finish before exiting.
+
+    Returns:
+        threading.Thread: The started pruning thread.
+    """
+    thread = threading.Thread(target=prune_generations, args=(output_folder, keep), name='prune-generations')
+    thread.start()
+    return thread
+
+def prune_generations(output_folder: str, keep: int = GENERATIONS_TO_KEEP) -> None:
+    """
+    Deletes all generations except the current one and the most recent completed ones,
+    up to `keep` generations in total. Incomplete generations from crashed or failed runs are deleted as well,
+    but not the ones a concurrent run is still writing, see is_generation_locked, and not the most recent one
+    with checkpoints, which --resume continues.
+    """
+    generations_folder = Path(output_folder) / GENERATIONS_SUBFOLDER
+    if not generations_folder.is_dir():
+        return
+
+    current = get_current_generation(output_folder)
+    generations = sorted((f for f in generations_folder.iterdir() if f.is_dir()), key=lambda f: f.name, reverse=True)
+
+    kept = 1 if current is not None else 0
+    kept_resumable = False
+    for generation in generations:
+        if current is not None and generation.resolve() == current.resolve():
+            continue
+        if (generation / GENERATION_COMPLETE_MARKER).exists():
+            if kept < keep:
+                kept += 1
+                continue
+        elif is_generation_locked(generation):
+            continue
+        elif not kept_resumable and is_resumable(generation):
+            kept_resumable = True
+            continue
+        try:
+            shutil.rmtree(generation)
+            logging.info(f'Pruned output generation {generation}')
+        except OSError as e:
+            logging.warning(f'Could not prune output generation {generation}: {str(e)}')
+
+def _switch_current_link(output_path: Path, generation_folder: Path) -> None:
+    current_link = output_path / CURRENT_GENERATION_LINK
+    temporary_link = output_path / f'.{CURRENT_GENERATION_LINK}-{os.getpid()}'
+
+    if temporary_link.is_symlink():
+        temporary_link.unlink()
+    os.symlink(os.path.relpath(generation_folder, output_path), temporary_link, target_is_directory=True)
+    os.replace(temporary_link, current_link)
+
+def _link_generation_entries(output_path: Path) -> None:
+    for entry in GENERATION_ENTRIES:
+        entry_path = output_path / entry
+        target = os.path.join(CURRENT_GENERATION_LINK, entry)
+
+        if entry_path.is_symlink():
+            if os.readlink(entry_path) == target:
+                continue
+            entry_path.unlink()
+        elif entry_path.exists():
+            # Output written before generations were introduced, move it aside so it gets pruned
+            _retire_entry(output_path, entry_path)
+
+        os.symlink(target, entry_path, target_is_directory=entry != OVERVIEW_FILE_NAME)
+
+def _move_generation_into_place(output_path: Path, generation_folder: Path) -> None:
+    for entry in GENERATION_ENTRIES:
+        entry_path = output_path / entry
+        if entry_path.is_symlink():
+            entry_path.unlink()
+        elif entry_path.exists():
+            _retire_entry(output_path, entry_path)
+
+        new_entry = generation_folder / entry
+        if new_entry.exists():
+            os.replace(new_entry, entry_path)
+
+def _retire_entry(output_path: Path, entry_path: Path) -> None:
+    retired_folder = output_path / GENERATIONS_SUBFOLDER / f'retired-{datetime.now().strftime("%Y%m%dT%H%M%S%f")}'
+    retired_folder.mkdir(parents=True, exist_ok=True)
+    os.replace(entry_path, retired_folder / entry_path.name)
@@ -0,0 +1,319 @@
+import gzip, hashlib, io, itertools, logging, os, shutil, tarfile, tempfile, time, zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, TextIO
+
+def open_for_writing(filepath: Path, mode: str):
+    """
+    Opens a file for writing or appending. Files that are hardlinked to a previous output generation
+    are detached first, so writing never changes the previous generation. Files are always written as
+    UTF-8 with \n line endings, so the output is byte-identical on every platform.
+    """
+    filepath = Path(filepath)
+    if filepath.exists() and filepath.stat().st_nlink > 1:
+        if mode == 'w':
+            filepath.unlink()
+        else:
+            detached_path = filepath.with_name(f'.{filepath.name}.detached')
+            shutil.copyfile(filepath, detached_path)
+            os.replace(detached_path, filepath)
+    return filepath.open(mode, encoding='utf-8', newline='\n')
+
+class Output_sink_error(Exception):
+    """Raised when a sink cannot change a file it already wrote, e.g. a member of an archive."""
+
+class Output_sink:
+
+    # Whether the files end up below `root` on disk, where SUSHI and the pre-flight check can read them
+    writes_to_filesystem = False
+
+    def __init__(self, root):
+        """
+        Destination of the generated FSH files, sushi-config.yaml files and overview of a run. The file writer
+        passes paths below `root`, the output generation, so every sink holds the same DSCN and LPDS project layout.
+
+        Args:
+            root: The output generation folder the paths are relative to.
+        """
+        self.root = Path(root)
+
+    def get_name(self, path) -> str:
+        """Returns the name of a file in the sink, its path relative to `root` in POSIX form."""
+        try:
+            return Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            return Path(path).as_posix()
+
+    def open_for_writing(self, path, mode: str = 'w') -> TextIO:
+        """Opens a file for writing ('w') or appending ('a') as UTF-8 text with \n line endings."""
+        raise NotImplementedError
+
+    def exists(self, path) -> bool:
+        raise NotImplementedError
+
+    def remove(self, path) -> None:
+        raise NotImplementedError
+
+    def read_first_line(self, path) -> str:
+        """Returns the first line of a file without its line ending, or None if the file does not exist."""
+        raise NotImplementedError
+
+    def copy_from(self, source_path, path) -> None:
+        """Adds a file of a previous output on disk, e.g. an unchanged external choice list, at `path`."""
+        raise NotImplementedError
+
+    def make_folder(self, folder) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class Filesystem_sink(Output_sink):
+
+    writes_to_filesystem = True
+
+    def __init__(self, root):
+        """Writes the files to the output generation folder on disk, one file per form, terminology set and project config."""
+        super().__init__(root)
+
+    def open_for_writing(self, path, mode: str = 'w') -> TextIO:
+        return open_for_writing(path, mode)
+
+    def exists(self, path) -> bool:
+        return Path(path).exists()
+
+    def remove(self, path) -> None:
+        Path(path).unlink()
+
+    def read_first_line(self, path) -> str:
+        if not Path(path).is_file():
+            return None
+        with open(path, encoding='utf-8') as f:
+            return f.readline().rstrip('\n')
+
+    def copy_from(self, source_path, path) -> None:
+        path = Path(path)
+        if path.exists():
+            path.unlink()
+        # Unchanged files share their storage with the previous output
+        try:
+            os.link(source_path, path)
+        except OSError:
+            shutil.copyfile(source_path, path)
+
+    def make_folder(self, folder) -> None:
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+class _Memory_file(io.StringIO):
+
+    def __init__(self, sink, name: str, initial_value: str):
+        super().__init__(initial_value, newline='\n')
+        self.seek(0, io.SEEK_END)
+        self._sink = sink
+        self._name = name
+
+    def close(self) -> None:
+        if not self.closed:
+            self._sink.store(self._name, self.getvalue())
+        super().close()
+
+class _Spool_file(io.TextIOWrapper):
+
+    def __init__(self, sink, name: str, spool_path: Path):
+        super().__init__(open(spool_path, 'wb'), encoding='utf-8', newline='\n')
+        self._sink = sink
+        self._name = name
+        self._spool_path = spool_path
+
+    def close(self) -> None:
+        if not self.closed:
+            super().close()
+            self._sink.add_spooled_file(self._name, self._spool_path)
+
+class Memory_sink(Output_sink):
+
+    def __init__(self, root):
+        """
+        Keeps the files in memory, by their path relative to `root` in POSIX form, e.g. `DSCN/sushi-config.yaml`.
+        For tests and for embedding the converter, nothing is written to disk. A file is stored when it is closed.
+        """
+        super().__init__(root)
+        self.files: Dict[str, str] = {}
+
+    def read_text(self, path) -> str:
+        return self.files[self.get_name(path)]
+
+    def store(self, name: str, content: str) -> None:
+        """Stores a file when it is closed."""
+        self.files[name] = content
+
+    def open_for_writing(self, path, mode: str = 'w') -> TextIO:
+        name = self.get_name(path)
+        return _Memory_file(self, name, self.files.get(name, '') if mode == 'a' else '')
+
+    def exists(self, path) -> bool:
+        return self.get_name(path) in self.files
+
+    def remove(self, path) -> None:
+        del self.files[self.get_name(path)]
+
+    def read_first_line(self, path) -> str:
+        content = self.files.get(self.get_name(path))
+        return content.split('\n', 1)[0] if content is not None else None
+
+    def copy_from(self, source_path, path) -> None:
+        with open(source_path, encoding='utf-8', newline='') as source_file:
+            self.files[self.get_name(path)] = source_file.read()
+
+class Archive_sink(Output_sink):
+
+    def __init__(self, root, archive_path, archive_format: str, mtime: float = None):
+        """
+        Writes the whole output tree into a single zip or gzipped tar file, instead of thousands of small files.
+
+        The archive is opened when the sink is created. Every file is written to a temporary file on disk and added to
+        the archive as a member as soon as it is closed, so memory use does not grow with the size of the files, e.g. large
+        external choice lists. Members cannot be changed once they are written: files opened for appending stay in the
+        temporary folder until the sink is closed, and a file written again must have the same content, e.g. the
+        sushi-config.yaml written for every form of a health board. The members get a fixed modification time and are
+        added in the order they are written, so identical inputs give identical archives. The archive is written to a
+        temporary file next to it until the sink is closed.
+
+        Args:
+            root: The output generation folder, the archive members are relative to it.
+            archive_path: The zip or tar.gz file.
+            archive_format (str): 'zip' or 'tar'.
+            mtime (float, optional): Modification time of the members. Defaults to the time the sink is created.
+        """
+        super().__init__(root)
+        if archive_format not in ('zip', 'tar'):
+            raise ValueError(f'Unknown archive format {archive_format}, use zip or tar.')
+        self.archive_path = Path(archive_path)
+        self.archive_format = archive_format
+        self.mtime = int(time.time() if mtime is None else mtime)
+        self.closed = False
+        # Digest and first line of every member written, to check files written again and to answer read_first_line
+        self.members: Dict[str, tuple] = {}
+        self._spooled_files: Dict[str, Path] = {}
+        self._spool_numbers = itertools.count()
+        self._spool_folder = Path(tempfile.mkdtemp(prefix='output-sink-'))
+
+        self.archive_path.parent.mkdir(parents=True, exist_ok=True)
+        self._partial_path = self.archive_path.with_name(f'.{self.archive_path.name}.partial')
+        if self.archive_format == 'zip':
+            self._archive = zipfile.ZipFile(self._partial_path, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self._archive_file = open(self._partial_path, 'wb')
+            self._gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=self._archive_file, mtime=self.mtime)
+            self._archive = tarfile.open(fileobj=self._gzip_file, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def open_for_writing(self, path, mode: str = 'w') -> TextIO:
+        name = self.get_name(path)
+        if name in self._spooled_files or mode == 'a':
+            if name in self.members:
+                raise Output_sink_error(f'Cannot append to {name}, it was already written to {self.archive_path}.')
+            if name not in self._spooled_files:
+                self._spooled_files[name] = self._get_spool_path()
+            return open_for_writing(self._spooled_files[name], mode)
+        return _Spool_file(self, name, self._get_spool_path())
+
+    def add_spooled_file(self, name: str, spool_path: Path) -> None:
+        """Adds a file written with mode 'w' when it is closed, and removes its temporary file."""
+        try:
+            self._add_member(name, spool_path)
+        finally:
+            spool_path.unlink()
+
+    def exists(self, path) -> bool:
+        name = self.get_name(path)
+        return name in self.members or name in self._spooled_files
+
+    def remove(self, path) -> None:
+        name = self.get_name(path)
+        if name in self.members:
+            raise Output_sink_error(f'Cannot remove {name}, it was already written to {self.archive_path}.')
+        self._spooled_files.pop(name).unlink()
+
+    def read_first_line(self, path) -> str:
+        name = self.get_name(path)
+        if name in self._spooled_files:
+            return Filesystem_sink(self._spool_folder).read_first_line(self._spooled_files[name])
+        return self.members[name][1] if name in self.members else None
+
+    def copy_from(self, source_path, path) -> None:
+        name = self.get_name(path)
+        if name in self._spooled_files:
+            self.remove(path)
+        self._add_member(name, source_path)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # The spooled files are complete now
+        for name, spool_path in sorted(self._spooled_files.items()):
+            self._add_member(name, spool_path)
+        self._spooled_files = {}
+
+        self._archive.close()
+        if self.archive_format == 'tar':
+            self._gzip_file.close()
+            self._archive_file.close()
+        os.replace(self._partial_path, self.archive_path)
+        shutil.rmtree(self._spool_folder, ignore_errors=True)
+        logging.info(f'Wrote {len(self.members)} files to {self.archive_path}')
+
+    def _get_spool_path(self) -> Path:
+        return self._spool_folder / f'{next(self._spool_numbers)}.txt'
+
+    def _add_member(self, name: str, source_path) -> None:
+        # The member is streamed from a file on disk in chunks
+        digest, first_line = get_file_digest_and_first_line(source_path)
+        if name in self.members:
+            if self.members[name][0] != digest:
+                raise Output_sink_error(f'Cannot rewrite {name} with different content, it was already written to {self.archive_path}.')
+            return
+        self.members[name] = (digest, first_line.decode('utf-8', errors='replace').rstrip('\r'))
+
+        with open(source_path, 'rb') as source:
+            if self.archive_format == 'zip':
+                # Zip timestamps start in 1980
+                zip_info = zipfile.ZipInfo(name, datetime.fromtimestamp(max(self.mtime, 315532800), tz=timezone.utc).timetuple()[:6])
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                zip_info.external_attr = 0o644 << 16
+                zip_info.file_size = os.path.getsize(source_path)
+                with self._archive.open(zip_info, 'w') as member:
+                    shutil.copyfileobj(source, member, 1024 * 1024)
+            else:
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = os.path.getsize(source_path)
+                tar_info.mtime = self.mtime
+                tar_info.mode = 0o644
+                self._archive.addfile(tar_info, source)
+
+def get_file_digest_and_first_line(file_path) -> tuple:
+    """Returns the sha256 digest and the first line, as bytes without its line ending, of a file on disk."""
+    digest = hashlib.sha256()
+    first_line = None
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            if first_line is None:
+                first_line = chunk.split(b'\n', 1)[0]
+            digest.update(chunk)
+    return digest.hexdigest(), first_line or b''
+
+def create_output_sink(sink_type: str, root, archive_path=None, mtime: float = None) -> Output_sink:
+    """
+    Creates the output sink selected with --output-sink.
+
+    Args:
+        sink_type (str): 'filesystem', 'zip', 'tar' or 'memory'.
+        root: The output generation folder.
+        archive_path (optional): The archive file of the 'zip' and 'tar' sinks.
+        mtime (float, optional): Modification time of the archive members, for deterministic builds.
+    """
+    if sink_type == 'filesystem':
+        return Filesystem_sink(root)
+    if sink_type == 'memory':
+        return Memory_sink(root)
+    return Archive_sink(root, archive_path, sink_type, mtime)
@@ -1,4 +1,6 @@
 import re
+from functools import lru_cache
+from src.constants import FHIR_ID_MAX_LENGTH
 
 # Define a function to transform strings
 def convert_to_camel_case(s: str) -> str:
@@ -112,12 +114,14 @@ def escape_quotes(s):
     else:
         return s
 
+@lru_cache(maxsize=None)
 def make_fhir_compliant(s: str) -> str:
     """
     This function takes a string as input and returns a new string that is compliant with FHIR id rules.
     FHIR ids only allow ASCII letters (A-Z, a-z), numbers (0-9), hyphens (-), and dots (.), with a length limit of 64 characters.
     In this function, any characters not allowed in a FHIR ID are removed. The function also replaces em-dashes and spaces with no character. 
     Finally, the string is trimmed to a maximum length of 64 characters, if necessary.
+    Results are memoized, as the same ids are generated for every question and list of a form.
     
     Args:
     s (str): The input string to be formatted.
@@ -128,7 +132,7 @@ def make_fhir_compliant(s: str) -> str:
     s = re.sub(r'[^A-Za-z0-9.-]', '', s)  # remove disallowed characters
     s = s.replace('–', '')  # replace em-dashes
     s = s.replace(' ', '')  # replace spaces
-    return s[:64]  # ensure the string is not longer than 64 characters
+    return s[:FHIR_ID_MAX_LENGTH]  # ensure the string is not longer than 64 characters
 
 def validate_string_FHIR_id(input_string: str) -> bool:
     # Regex pattern for ASCII letters, numbers, hyphen, and dots
@@ -0,0 +1,257 @@
+import json, logging, os, queue, shutil, subprocess, threading, time
+from pathlib import Path
+from typing import Callable, List
+from src.constants import SUSHI_REPORT_MAX_MESSAGES, SUSHI_WORKER_TIMEOUT
+from src.sushi_telemetry import Process_tree_sampler, Sushi_run_report, parse_sushi_output, run_measured
+
+SUSHI_WORKER_SCRIPT = Path(__file__).parent / 'sushi_worker.js'
+
+class Sushi_worker_error(Exception):
+    """Raised when the SUSHI worker process cannot be started or stops responding."""
+
+class Sushi_worker:
+
+    def __init__(self, timeout: float = SUSHI_WORKER_TIMEOUT, command: list = None):
+        """
+        A long-lived Node process that compiles SUSHI projects through SUSHI's programmatic API.
+        Node, SUSHI and its modules are loaded once, and project folders are sent one after another
+        over stdin/stdout as JSON lines (see sushi_worker.js). The FHIR core and dependency definitions
+        are loaded by the first project and reused for the next ones.
+
+        The replies are read by a background thread. If the worker does not answer within `timeout`
+        seconds, e.g. because SUSHI hangs on a project, it is killed so the caller can fall back to
+        the command line tool.
+
+        Args:
+            timeout (float): Seconds to wait for the worker to start or to compile a project.
+            command (list, optional): The command that starts the worker, `node sushi_worker.js` by default.
+        """
+        self.timeout = timeout
+        self.command = command or ['node', str(SUSHI_WORKER_SCRIPT)]
+        self.process = None
+        self._messages = None
+
+    def start(self) -> None:
+        env = os.environ.copy()
+        node_path = get_global_node_modules_folder()
+        if node_path:
+            env['NODE_PATH'] = os.pathsep.join(filter(None, [env.get('NODE_PATH'), node_path]))
+
+        try:
+            self.process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding='utf-8',
+                env=env
+            )
+        except OSError as e:
+            raise Sushi_worker_error(f'Could not start the SUSHI worker: {str(e)}')
+
+        # Every line of the worker goes to the queue, followed by None when stdout closes
+        self._messages = queue.Queue()
+        threading.Thread(target=self._read_lines, args=(self.process.stdout, self._messages), name='sushi-worker-reader', daemon=True).start()
+
+        ready = self._read_message()
+        if not ready.get('ready'):
+            self.stop()
+            raise Sushi_worker_error(f'SUSHI worker is not ready: {ready.get("error")}')
+        logging.info('SUSHI worker started')
+
+    def run(self, folder: Path) -> dict:
+        """
+        Compiles a single SUSHI project folder.
+
+        Returns:
+            dict: The worker's result with `ok`, `resources`, `errors` and `warnings`.
+
+        Raises:
+            Sushi_worker_error: If the worker died, answered garbage or crashed on the project.
+        """
+        if self.process is None or self.process.poll() is not None:
+            raise Sushi_worker_error('SUSHI worker is not running.')
+
+        try:
+            self.process.stdin.write(json.dumps({'folder': str(Path(folder).resolve())}) + '\n')
+            self.process.stdin.flush()
+        except OSError as e:
+            raise Sushi_worker_error(f'Could not send {folder} to the SUSHI worker: {str(e)}')
+
+        result = self._read_message()
+        if result.get('crashed'):
+            raise Sushi_worker_error(f'SUSHI worker crashed on {folder}: {"; ".join(result.get("errors", []))}')
+        return result
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+    @staticmethod
+    def _read_lines(stdout, messages: queue.Queue) -> None:
+        try:
+            with stdout:
+                for line in stdout:
+                    messages.put(line)
+        except (OSError, ValueError):
+            pass
+        messages.put(None)
+
+    def _read_message(self) -> dict:
+        try:
+            line = self._messages.get(timeout=self.timeout)
+        except queue.Empty:
+            self.process.kill()
+            self.process.wait()
+            raise Sushi_worker_error(f'SUSHI worker did not answer within {self.timeout} s and was stopped.')
+        if not line:
+            # The worker closed stdout, wait until it has exited so the caller stops using it
+            try:
+                returncode = self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                returncode = self.process.wait()
+            raise Sushi_worker_error(f'SUSHI worker exited with code {returncode}.')
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            raise Sushi_worker_error(f'SUSHI worker sent an invalid message: {line.strip()}')
+
+def get_global_node_modules_folder() -> str:
+    """Returns the global node_modules folder, where `npm install -g fsh-sushi` puts SUSHI."""
+    try:
+        result = subprocess.run('npm root -g', shell=True, capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_sushi_cli(folder: Path, run_report: Sushi_run_report = None) -> bool:
+    """
+    Runs the SUSHI command line tool in the given project folder. Returns True if it succeeded.
+
+    The output of SUSHI is captured and written to the log file, and the wall time, the peak RSS of the
+    SUSHI process and the resource, error and warning counts parsed from its output go to the run report.
+    """
+    try:
+        result = run_measured('sushi', folder)
+    except OSError as e:
+        logging.error(f'Error running Sushi in {folder}: {str(e)}')
+        return False
+
+    output = result['stdout'] + result['stderr']
+    logging.info(f'SUSHI output for {folder}:\n{output}')
+    diagnostics = parse_sushi_output(output)
+    for error in diagnostics['error_messages']:
+        logging.error(f'SUSHI error in {folder}: {error}')
+
+    succeeded = result['returncode'] == 0
+    if succeeded:
+        logging.info(f'SUSHI run successfully in {folder}')
+    else:
+        logging.error(f'Error running Sushi in {folder}: exit code {result["returncode"]}')
+        print(f'Command failed with error: {result["returncode"]} in {folder}')
+
+    if run_report is not None:
+        run_report.record(folder, 'cli', succeeded, result['wall_time'], result['peak_rss'], diagnostics)
+    return succeeded
+
+def run_sushi_worker_project(worker: Sushi_worker, folder: Path, run_report: Sushi_run_report = None) -> bool:
+    """Compiles a project folder with the SUSHI worker. Returns True if it compiled without errors."""
+    if worker.process is None:
+        raise Sushi_worker_error('SUSHI worker is not running.')
+    started = time.perf_counter()
+    # The peak RSS of the worker over its whole life says nothing about a single project
+    with Process_tree_sampler(worker.process.pid, include_high_water_mark=False) as sampler:
+        result = worker.run(folder)
+    wall_time = time.perf_counter() - started
+
+    if not result.get('reusedDefinitions', True):
+        logging.info(f'This SUSHI version has no API to share FHIR definitions, they were reloaded for {folder}')
+    for warning in result.get('warnings', []):
+        logging.warning(f'SUSHI warning in {folder}: {warning}')
+    for error in result.get('errors', []):
+        logging.error(f'SUSHI error in {folder}: {error}')
+
+    if run_report is not None:
+        resources = result.get('resourceTypes', {})
+        run_report.record(folder, 'worker', bool(result.get('ok')), wall_time, sampler.peak_rss, {
+            'resources': resources,
+            'resource_count': result.get('resources', sum(resources.values())),
+            'errors': len(result.get('errors', [])),
+            'warnings': len(result.get('warnings', [])),
+            'error_messages': result.get('errors', [])[:SUSHI_REPORT_MAX_MESSAGES],
+            'warning_messages': result.get('warnings', [])[:SUSHI_REPORT_MAX_MESSAGES],
+        })
+
+    if result.get('ok'):
+        logging.info(f'SUSHI run successfully in {folder} ({result.get("resources", 0)} resources)')
+        return True
+
+    print(f'SUSHI reported {len(result.get("errors", []))} errors in {folder}')
+    return False
+
+def run_sushi_project(folder: Path, worker: Sushi_worker = None, run_report: Sushi_run_report = None):
+    """
+    Runs SUSHI for a single project folder, with the worker if given, otherwise or if the worker fails with the command line tool.
+    The run is recorded in the run report, if given.
+
+    Returns:
+        tuple: Whether SUSHI succeeded, and the worker to use for the next project (None if it stopped).
+    """
+    # Remove the output of earlier runs, it may be hardlinked into a previous output generation
+    shutil.rmtree(Path(folder) / 'fsh-generated', ignore_errors=True)
+
+    if worker is not None:
+        try:
+            return run_sushi_worker_project(worker, folder, run_report), worker
+        except Sushi_worker_error as e:
+            logging.warning(f'{str(e)} Falling back to the SUSHI command line tool for {folder}.')
+            if worker.process is None or worker.process.poll() is not None:
+                worker.stop()
+                worker = None
+
+    return run_sushi_cli(folder, run_report), worker
+
+def start_sushi_worker() -> Sushi_worker:
+    """Starts a SUSHI worker, returning None if it cannot be started so the command line tool is used instead."""
+    worker = Sushi_worker()
+    try:
+        worker.start()
+    except Sushi_worker_error as e:
+        logging.warning(f'{str(e)} Falling back to the SUSHI command line tool.')
+        return None
+    return worker
+
+def run_sushi(folders: List[Path], use_worker: bool = False, on_project_done: Callable[[Path, bool], None] = None,
+              run_report: Sushi_run_report = None) -> List[Path]:
+    """
+    Runs SUSHI for every project folder.
+
+    With `use_worker`, all projects are compiled by a single SUSHI worker process. If the worker cannot
+    be started, the project it crashed on and all remaining projects fall back to the SUSHI command line tool.
+    `on_project_done` is called with the folder and the outcome after each project, e.g. to checkpoint it.
+    Each run is recorded in `run_report`, if given.
+
+    Returns:
+        List[Path]: The project folders for which SUSHI failed.
+    """
+    failed_folders = []
+    worker = start_sushi_worker() if use_worker and folders else None
+
+    for folder in folders:
+        succeeded, worker = run_sushi_project(folder, worker, run_report)
+        if on_project_done is not None:
+            on_project_done(folder, succeeded)
+        if not succeeded:
+            failed_folders.append(folder)
+
+    if worker is not None:
+        worker.stop()
+
+    return failed_folders
@@ -0,0 +1,252 @@
+import json, logging, os, re, subprocess, threading, time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+from src.constants import SUSHI_REPORT_MAX_MESSAGES, MEMORY_SAMPLING_INTERVAL
+
+RESULTS_ROW_PATTERN = re.compile(r'│(.*)│')
+ERRORS_PATTERN = re.compile(r'(\d+) Errors?\b')
+WARNINGS_PATTERN = re.compile(r'(\d+) Warnings?\b')
+DIAGNOSTIC_PATTERN = re.compile(r'^\s*(error|warn)\s+(.*)$')
+
+def run_measured(command: str, cwd) -> dict:
+    """
+    Runs a shell command with captured output, and measures its wall time and the peak RSS of the processes it starts.
+
+    The output is read by two threads, so neither pipe can fill up and block the child. Meanwhile the memory of the
+    child and its descendants, e.g. the Node process started by the `sushi` shell script, is sampled, see
+    Process_tree_sampler. The peak RSS is None if the memory of other processes cannot be read.
+
+    Returns:
+        dict: `returncode`, `stdout`, `stderr`, `wall_time` in seconds and `peak_rss` in bytes.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, encoding='utf-8', errors='replace')
+    output = {}
+    readers = [threading.Thread(target=lambda name, stream: output.__setitem__(name, stream.read()), args=(name, stream))
+               for name, stream in (('stdout', process.stdout), ('stderr', process.stderr))]
+    with Process_tree_sampler(process.pid) as sampler:
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+    process.wait()
+    process.stdout.close()
+    process.stderr.close()
+
+    return {'returncode': process.returncode, 'stdout': output.get('stdout', ''), 'stderr': output.get('stderr', ''),
+            'wall_time': time.perf_counter() - started, 'peak_rss': sampler.peak_rss}
+
+class Process_tree_sampler:
+
+    def __init__(self, pid: int, include_high_water_mark: bool = True):
+        """
+        Samples the memory of a process and all its descendants in a background thread while the context is open.
+        Only the child processes are measured, not this process.
+
+        The peak RSS is the largest summed RSS of the process tree in any sample. On Linux, it is at least the VmHWM,
+        the peak RSS a process reached since it started its program, of every process in the tree, so short peaks
+        between two samples are not missed. Without /proc, psutil is used if it is installed.
+
+        Args:
+            pid (int): The process, e.g. the shell running SUSHI.
+            include_high_water_mark (bool): Include the VmHWM. Leave it out for long-lived processes, e.g. the SUSHI
+                worker, whose VmHWM holds the peak of everything they did before the context was opened.
+        """
+        self.pid = pid
+        self.include_high_water_mark = include_high_water_mark
+        self.peak_rss = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> 'Process_tree_sampler':
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='process-tree-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.sample()
+
+    def sample(self) -> None:
+        rss, high_water_mark = get_process_tree_memory(self.pid)
+        if rss is None:
+            return
+        peak = max(rss, high_water_mark) if self.include_high_water_mark else rss
+        self.peak_rss = max(self.peak_rss or 0, peak)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(MEMORY_SAMPLING_INTERVAL):
+            self.sample()
+
+def get_process_tree_memory(pid: int) -> Tuple[int, int]:
+    """
+    Returns the summed RSS of a process and its descendants and the largest VmHWM among them, in bytes.
+    Both are None if the memory of other processes cannot be read, the VmHWM is 0 if it is unknown.
+    """
+    if os.path.isdir('/proc/self'):
+        rss, high_water_mark = 0, 0
+        for process_id in _get_process_tree_ids(pid):
+            status = _read_process_status(process_id)
+            rss += status.get('VmRSS', 0)
+            high_water_mark = max(high_water_mark, status.get('VmHWM', 0))
+        return rss, high_water_mark
+
+    try:
+        import psutil
+    except ImportError:
+        return None, None
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0, 0
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss, 0
+
+def _get_process_tree_ids(pid: int) -> List[int]:
+    # The parent of every process is read from /proc/<pid>/stat, /proc/<pid>/task/<tid>/children is not available on every kernel
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', encoding='utf-8', errors='replace') as stat_file:
+                # The command name in brackets can hold spaces, the parent id is the second field after it
+                parent_id = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_id, []).append(int(entry))
+
+    process_ids = [pid]
+    for process_id in process_ids:
+        process_ids.extend(children.get(process_id, []))
+    return process_ids
+
+def _read_process_status(pid: int) -> Dict[str, int]:
+    # The memory fields of /proc/<pid>/status, e.g. `VmRSS:    81234 kB`, in bytes. Exited processes have none.
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8', errors='replace') as status_file:
+            for line in status_file:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    fields[name] = int(value.split()[0]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return fields
+
+def parse_sushi_output(output: str) -> dict:
+    """
+    Parses the console output of the SUSHI command line tool.
+
+    The resource counts are read from the SUSHI RESULTS table, where every row of column names is followed by a row
+    of counts. The error and warning counts are read from its last line, the messages from the `error` and `warn` log lines.
+
+    Returns:
+        dict: `resources` (count per resource kind), `resource_count`, `errors`, `warnings`, `error_messages` and `warning_messages`.
+    """
+    resources = {}
+    column_names = None
+    errors, warnings = None, None
+    error_messages, warning_messages = [], []
+
+    for line in output.splitlines():
+        match = DIAGNOSTIC_PATTERN.match(line)
+        if match:
+            (error_messages if match.group(1) == 'error' else warning_messages).append(match.group(2).strip())
+            continue
+
+        match = RESULTS_ROW_PATTERN.search(line)
+        if match:
+            cells = [cell.strip() for cell in match.group(1).split('│')]
+            if all(cell.isdigit() for cell in cells) and column_names and len(column_names) == len(cells):
+                resources.update({name: int(cell) for name, cell in zip(column_names, cells)})
+            elif all(cell.isalpha() for cell in cells):
+                column_names = cells
+            continue
+
+        match = ERRORS_PATTERN.search(line)
+        if match and '║' in line:
+            errors = int(match.group(1))
+            warnings_match = WARNINGS_PATTERN.search(line)
+            warnings = int(warnings_match.group(1)) if warnings_match else warnings
+
+    return {
+        'resources': resources,
+        'resource_count': sum(resources.values()),
+        'errors': errors if errors is not None else len(error_messages),
+        'warnings': warnings if warnings is not None else len(warning_messages),
+        'error_messages': error_messages[:SUSHI_REPORT_MAX_MESSAGES],
+        'warning_messages': warning_messages[:SUSHI_REPORT_MAX_MESSAGES],
+    }
+
+class Sushi_run_report:
+
+    def __init__(self, report_path: str, generation_folder=None):
+        """
+        Machine readable report of the SUSHI runs, one JSON line per project, appended to the report file as soon as
+        the project is compiled. Every line holds the run, the project, the wall time, the peak RSS of the SUSHI
+        process, the resource counts and the errors and warnings, so compile costs can be tracked across runs.
+
+        Args:
+            report_path (str): The JSON lines file the runs are appended to.
+            generation_folder (optional): The output generation, project names are relative to it.
+        """
+        self.report_path = report_path
+        self.generation_folder = Path(generation_folder) if generation_folder is not None else None
+        self.run = datetime.now().isoformat(timespec='seconds')
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def record(self, folder, mode: str, succeeded: bool, wall_time: float, peak_rss: int, diagnostics: dict) -> dict:
+        """
+        Records the SUSHI run of a project, prints a one line summary and appends it to the report file.
+
+        Args:
+            folder: The project folder.
+            mode (str): 'cli' or 'worker'. The peak RSS of the worker is the peak sampled while it compiled the project.
+            succeeded (bool): Whether SUSHI succeeded.
+            wall_time (float): Wall time in seconds.
+            peak_rss (int): Peak RSS of the SUSHI process in bytes, None if unknown.
+            diagnostics (dict): The counts and messages, see parse_sushi_output.
+        """
+        entry = {
+            'run': self.run,
+            'generation': self.generation_folder.name if self.generation_folder is not None else None,
+            'project': self._get_project_name(folder),
+            'mode': mode,
+            'succeeded': succeeded,
+            'wall_time': round(wall_time, 3),
+            'peak_rss': peak_rss,
+            **diagnostics,
+        }
+        print(f"SUSHI {'compiled' if succeeded else 'failed for'} {entry['project']} in {wall_time:.1f} s: "
+              f"{entry['resource_count']} resources, {entry['errors']} errors, {entry['warnings']} warnings"
+              + (f', peak RSS {peak_rss / 1024 / 1024:.0f} MB' if peak_rss else ''))
+
+        with self._lock:
+            self.entries.append(entry)
+            try:
+                with open(self.report_path, 'a', encoding='utf-8') as report_file:
+                    report_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            except OSError as e:
+                logging.warning(f'Could not write the SUSHI run report {self.report_path}: {str(e)}')
+        return entry
+
+    def _get_project_name(self, folder) -> str:
+        folder = Path(folder)
+        if self.generation_folder is not None:
+            try:
+                return folder.relative_to(self.generation_folder).as_posix()
+            except ValueError:
+                pass
+        return folder.as_posix()
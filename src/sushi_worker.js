@@ -0,0 +1,175 @@
+// Long-lived SUSHI worker used by src/sushi_runner.py.
+//
+// Protocol (one JSON object per line):
+//   stdout on start:  {"ready": true} or {"ready": false, "error": "..."}
+//   stdin request:    {"folder": "<absolute project folder>"}
+//   stdout response:  {"folder": "...", "ok": bool, "resources": n, "resourceTypes": {...},
+//                      "errors": [...], "warnings": [...], "reusedDefinitions": bool}
+//
+// Node and the SUSHI modules are loaded once for all projects. The FHIR definitions of the core
+// and dependency packages, the largest part of a SUSHI run, are also loaded once per FHIR version
+// and reused for every project: the projects are imported with importText and exported with
+// exportFHIR against the shared definitions, the same steps fshToFhir runs. SUSHI versions that
+// do not export these functions fall back to fshToFhir, which reloads the definitions per project.
+
+const fs = require('fs');
+const path = require('path');
+const readline = require('readline');
+
+let sushi;
+try {
+  sushi = require('fsh-sushi');
+} catch (e) {
+  process.stdout.write(JSON.stringify({ ready: false, error: String(e.message || e).split('\n')[0] }) + '\n');
+  process.exit(1);
+}
+
+const canReuseDefinitions = Boolean(
+  sushi.fhirdefs && sushi.fhirdefs.FHIRDefinitions &&
+  sushi.utils && sushi.utils.loadExternalDependencies && sushi.utils.errorsAndWarnings &&
+  sushi.sushiImport && sushi.sushiImport.importText && sushi.sushiImport.FSHTank && sushi.sushiImport.RawFSH &&
+  sushi.sushiExport && sushi.sushiExport.exportFHIR
+);
+
+// Loaded FHIR definitions by FHIR version, all projects of a run share the same dependencies
+const definitionsByFhirVersion = new Map();
+
+function readSushiConfig(folder) {
+  // The sushi-config.yaml files written by file_writer.py only contain flat "key: value" pairs
+  const config = {};
+  const text = fs.readFileSync(path.join(folder, 'sushi-config.yaml'), 'utf8');
+  for (const line of text.split(/\r?\n/)) {
+    const match = line.match(/^\s*([A-Za-z]+)\s*:\s*(.*?)\s*$/);
+    if (match) {
+      config[match[1]] = match[2];
+    }
+  }
+  return config;
+}
+
+function findFshFiles(folder) {
+  if (!fs.existsSync(folder)) {
+    return [];
+  }
+  let files = [];
+  for (const entry of fs.readdirSync(folder, { withFileTypes: true }).sort((a, b) => a.name.localeCompare(b.name))) {
+    const entryPath = path.join(folder, entry.name);
+    if (entry.isDirectory()) {
+      files = files.concat(findFshFiles(entryPath));
+    } else if (entry.name.endsWith('.fsh')) {
+      files.push(entryPath);
+    }
+  }
+  return files;
+}
+
+function getTankConfig(config) {
+  return {
+    canonical: config.canonical,
+    FSHOnly: true,
+    fhirVersion: [config.fhirVersion],
+    dependencies: [],
+    version: config.version,
+    id: 'example',
+    name: 'Example',
+    status: 'active'
+  };
+}
+
+async function getDefinitions(tankConfig) {
+  const fhirVersion = tankConfig.fhirVersion[0];
+  if (!definitionsByFhirVersion.has(fhirVersion)) {
+    const definitions = new sushi.fhirdefs.FHIRDefinitions();
+    if (typeof definitions.initialize === 'function') {
+      await definitions.initialize();
+    }
+    await Promise.all([].concat(sushi.utils.loadExternalDependencies(definitions, tankConfig)));
+    definitionsByFhirVersion.set(fhirVersion, definitions);
+  }
+  return definitionsByFhirVersion.get(fhirVersion);
+}
+
+async function runSushi(fsh, config) {
+  if (!canReuseDefinitions) {
+    return sushi.fshToFhir(fsh, {
+      canonical: config.canonical,
+      version: config.version,
+      fhirVersion: config.fhirVersion,
+      logLevel: 'silent'
+    });
+  }
+
+  if (typeof sushi.utils.setLogLevel === 'function') {
+    sushi.utils.setLogLevel('silent');
+  }
+  const tankConfig = getTankConfig(config);
+  const definitions = await getDefinitions(tankConfig);
+  // Only the errors and warnings of this project are reported
+  sushi.utils.errorsAndWarnings.reset();
+
+  const documents = sushi.sushiImport.importText(fsh.map((text, index) => new sushi.sushiImport.RawFSH(text, `project-${index}.fsh`)));
+  const tank = new sushi.sushiImport.FSHTank(documents, tankConfig);
+  const outPackage = sushi.sushiExport.exportFHIR(tank, definitions);
+
+  const fhir = [];
+  for (const artifactType of ['profiles', 'extensions', 'logicals', 'resources', 'valueSets', 'codeSystems']) {
+    for (const artifact of outPackage[artifactType] || []) {
+      fhir.push(artifact.toJSON(false));
+    }
+  }
+  for (const instance of outPackage.instances || []) {
+    if (!instance._instanceMeta || instance._instanceMeta.usage !== 'Inline') {
+      fhir.push(instance.toJSON());
+    }
+  }
+  return { fhir, errors: sushi.utils.errorsAndWarnings.errors, warnings: sushi.utils.errorsAndWarnings.warnings };
+}
+
+async function compileProject(folder) {
+  const config = readSushiConfig(folder);
+  const fsh = findFshFiles(path.join(folder, 'input', 'fsh')).map(file => fs.readFileSync(file, 'utf8'));
+
+  const result = await runSushi(fsh, config);
+
+  // Start from an empty folder like the SUSHI CLI, files may be hardlinks into a previous output generation
+  const resourcesFolder = path.join(folder, 'fsh-generated', 'resources');
+  fs.rmSync(path.join(folder, 'fsh-generated'), { recursive: true, force: true });
+  fs.mkdirSync(resourcesFolder, { recursive: true });
+  const resourceTypes = {};
+  for (const resource of result.fhir) {
+    resourceTypes[resource.resourceType] = (resourceTypes[resource.resourceType] || 0) + 1;
+    const fileName = `${resource.resourceType}-${resource.id}.json`;
+    fs.writeFileSync(path.join(resourcesFolder, fileName), JSON.stringify(resource, null, 2) + '\n', 'utf8');
+  }
+
+  return {
+    folder,
+    ok: result.errors.length === 0,
+    resources: result.fhir.length,
+    resourceTypes,
+    errors: result.errors.map(e => e.message),
+    warnings: result.warnings.map(w => w.message),
+    reusedDefinitions: canReuseDefinitions
+  };
+}
+
+async function main() {
+  process.stdout.write(JSON.stringify({ ready: true }) + '\n');
+
+  const lines = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+  for await (const line of lines) {
+    if (line.trim() === '') {
+      continue;
+    }
+    let response;
+    try {
+      const request = JSON.parse(line);
+      response = await compileProject(request.folder);
+    } catch (e) {
+      response = { folder: null, ok: false, resources: 0, errors: [String(e.message || e)], warnings: [], crashed: true };
+    }
+    process.stdout.write(JSON.stringify(response) + '\n');
+  }
+}
+
+main();
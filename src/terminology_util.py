@@ -1,6 +1,7 @@
+from functools import lru_cache
 import src.string_util as su
 
-def generate_vs_or_cs_id(short_name: str, list_name: str, id_type: str, lpds_healthboard_abbreviation: str = None) -> str:
+def generate_vs_or_cs_id(short_name: str, list_name: str, id_type: str, lpds_healthboard_abbreviation: str = None, id_registry=None, form: str = None) -> str:
     """
     Generate a FHIR compliant ID for CodeSystem or ValueSet.
 
@@ -9,11 +10,37 @@ def generate_vs_or_cs_id(short_name: str, list_name: str, id_type: str, lpds_hea
         list_name (str): The name of the list in the questionnaire.
         id_type (str): The type of ID to generate ('CS' for CodeSystem, 'VS' for ValueSet).
         lpds_healthboard_abbreviation (str, optional): The LPDS healthboard abbreviation. Defaults to None.
+        id_registry (Fhir_id_registry, optional): The id registry of the project, to detect ids that collide
+            with the id of another list. Defaults to None.
+        form (str, optional): The form the list belongs to, used when reporting collisions. Defaults to None.
 
     Returns:
         str: The FHIR compliant ID.
     """
+    vs_or_cs_id = _build_vs_or_cs_id(short_name, list_name, id_type, lpds_healthboard_abbreviation)
+    if id_registry is not None:
+        resource_type = 'CodeSystem' if id_type == 'CS' else 'ValueSet'
+        vs_or_cs_id = id_registry.register(resource_type, (form, short_name, str(list_name), lpds_healthboard_abbreviation), vs_or_cs_id, form)
+    return vs_or_cs_id
+
+@lru_cache(maxsize=None)
+def _build_vs_or_cs_id(short_name: str, list_name: str, id_type: str, lpds_healthboard_abbreviation: str) -> str:
     proper_list_name = su.convert_to_camel_case(list_name)
     prefix = lpds_healthboard_abbreviation + '-' if lpds_healthboard_abbreviation else ''
-    vs_or_cs_id = su.make_fhir_compliant(prefix + short_name + '-' + proper_list_name + id_type)
-    return vs_or_cs_id
\ No newline at end of file
+    return su.make_fhir_compliant(prefix + short_name + '-' + proper_list_name + id_type)
+
+def get_designation_lines(translations: list) -> list:
+    """
+    Generate the FSH rules of the designations of a CodeSystem concept, indented below its code rule.
+
+    Args:
+        translations (list): (language code, label) tuples, with the quotes in the labels already escaped.
+
+    Returns:
+        list: The FSH lines.
+    """
+    lines = []
+    for language, label in translations:
+        lines.append(f'  * ^designation[+].language = #{language}')
+        lines.append(f'  * ^designation[=].value = "{label}"')
+    return lines
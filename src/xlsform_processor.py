@@ -1,29 +1,44 @@
-from typing import List
-import glob, logging, traceback
+from typing import Iterator, List, Tuple
+import glob, logging, os, traceback
 from tqdm import tqdm
+import src.form_readers as form_readers
 import src.string_util as su
+from src.failure_report import Failure_report
+from src.input_prefetcher import Input_prefetcher, get_input_size
+from src.memory_monitor import Memory_monitor, measure_memory
+from src.constants import INPUT_PREFETCH_DEPTH, INPUT_PREFETCH_MAX_BYTES
 from src.models.XLS_Form import XLS_Form
 
-def read_and_process_xlsform_files(XLS_Forms: List[XLS_Form]):
-    processed_xlsforms_md_entries = []
+def read_and_process_xlsform_files(XLS_Forms: List[XLS_Form], failure_report: Failure_report = None, previous_md_entries: List[dict] = None):
+    processed_xlsforms = []
+    processed_xlsforms_md_entries = list(previous_md_entries or [])
     
     for xlsForm in XLS_Forms:
         logging.info(f'Processing {xlsForm.file_name}...')
         try:
-            md_entry = {'short_name': xlsForm.short_name, 'short_id': xlsForm.short_id, 'version': xlsForm.version, 'title': xlsForm.title}
-            if xlsForm.lpds_healthboard_abbreviation is not None:
-                md_entry['lpds_healthboard_abbreviation'] = xlsForm.lpds_healthboard_abbreviation
+            md_entry = create_md_entry(xlsForm)
             processed_xlsforms_md_entries.append(md_entry)
+            processed_xlsforms.append(xlsForm)
+            if failure_report is not None:
+                failure_report.add_processed_form(xlsForm.input_path, md_entry)
 
         except Exception as e:
             logging.error(f'Error processing {xlsForm.file_name}: {str(e)}')
             logging.error(traceback.format_exc())     
+            if failure_report is not None:
+                failure_report.add_failure('load', xlsForm.input_path, e)
         logging.info(f'Processed {xlsForm.file_name}...')            
     
     processed_xlsforms_md_overview = create_processed_xlsforms_md_overview(processed_xlsforms_md_entries)
     print(processed_xlsforms_md_overview)
 
-    return XLS_Forms, processed_xlsforms_md_overview
+    return processed_xlsforms, processed_xlsforms_md_overview
+
+def create_md_entry(xlsForm: XLS_Form) -> dict:
+    md_entry = {'short_name': xlsForm.short_name, 'short_id': xlsForm.short_id, 'version': xlsForm.version, 'title': xlsForm.title}
+    if xlsForm.lpds_healthboard_abbreviation is not None:
+        md_entry['lpds_healthboard_abbreviation'] = xlsForm.lpds_healthboard_abbreviation
+    return md_entry
 
 def create_processed_xlsforms_md_overview(processed_xlsforms_md_entries: list) -> str:
     processed_lpds = sorted(
@@ -48,18 +63,77 @@ def create_processed_xlsforms_md_overview(processed_xlsforms_md_entries: list) -
     
     return md_lines
 
-def read_xlsforms(input_folder: str, lpds_healthboard_abbreviation_dict: dict) -> None:
+def list_xlsform_files(input_folder: str) -> List[str]:
+    # Get list of all form definitions in the input folder that have a reader (.xlsx, .json and .csvform folders),
+    # sorted so the output does not depend on the file system order
+    form_files = [form_file for extension in form_readers.FORM_READERS for form_file in glob.glob(input_folder + "*" + extension)]
+    return sorted(form_file for form_file in form_files if os.path.isdir(form_file) == form_file.endswith('.csvform'))
+
+def list_external_choice_files(input_folder: str) -> List[str]:
+    """Lists the CSV files with the choices of select_one_from_file and select_one_external questions in the input folder."""
+    return sorted(glob.glob(input_folder + "*.csv"))
+
+def read_xlsform(xls_file: str, lpds_healthboard_abbreviation_dict: dict, memory_monitor: Memory_monitor = None, content=None) -> XLS_Form:
+    file_name = xls_file.split('\\')[-1]
+    with measure_memory(memory_monitor, 'load', file_name):
+        # The reader is selected by the extension, machine generated CSV and JSON forms skip the slow workbook parsing
+        xlsForm = XLS_Form(xls_file, file_name, lpds_healthboard_abbreviation_dict, form_readers.read_form(xls_file, content))
+    if memory_monitor is not None:
+        memory_monitor.record_form(xlsForm, get_input_size(xls_file))
+    return xlsForm
+
+def try_read_xlsform(xls_file: str, lpds_healthboard_abbreviation_dict: dict, memory_monitor: Memory_monitor = None, failure_report: Failure_report = None,
+                     content=None) -> XLS_Form:
+    """
+    Loads an XLSForm, returning None instead of raising if the form cannot be loaded, so the other forms can still be processed.
+    `content` is the form read into memory by the prefetcher, without it the form is read from its path.
+    """
+    try:
+        return read_xlsform(xls_file, lpds_healthboard_abbreviation_dict, memory_monitor, content)
+    except Exception as e:
+        logging.error(f'Error loading {xls_file}: {str(e)}')
+        logging.error(traceback.format_exc())
+        if failure_report is not None:
+            failure_report.add_failure('load', xls_file, e)
+        return None
+
+def iterate_xlsforms(xls_files: List[str], lpds_healthboard_abbreviation_dict: dict, memory_monitor: Memory_monitor = None, failure_report: Failure_report = None,
+                     prefetch_depth: int = INPUT_PREFETCH_DEPTH, prefetch_max_bytes: int = INPUT_PREFETCH_MAX_BYTES) -> Iterator[XLS_Form]:
+    """
+    Loads the XLSForms one at a time, so only one form has to be held in memory besides the bounded read-ahead buffers.
+    Forms that fail to load are skipped.
+    """
+    for xls_file, content in tqdm(Input_prefetcher(xls_files, prefetch_depth, prefetch_max_bytes, memory_monitor=memory_monitor)):
+        xlsForm = try_read_xlsform(xls_file, lpds_healthboard_abbreviation_dict, memory_monitor, failure_report, content)
+        if xlsForm is not None:
+            yield xlsForm
+
+def read_xlsforms(input_folder: str, lpds_healthboard_abbreviation_dict: dict, memory_monitor: Memory_monitor = None, failure_report: Failure_report = None, xls_files: List[str] = None,
+                  prefetch_depth: int = INPUT_PREFETCH_DEPTH, prefetch_max_bytes: int = INPUT_PREFETCH_MAX_BYTES) -> Tuple[List[XLS_Form], List[str]]:
+    """
+    Loads the XLSForms. With a memory budget, loading stops as soon as the next form would not fit in the budget anymore,
+    estimated from the memory the forms loaded so far took per byte of their files.
+
+    Returns:
+        tuple: The loaded forms, and the files that were not loaded because of the memory budget.
+    """
     logging.info('Checking input XLSForms by converting them to XForm using pyxfrom libary...')
-    # Get list of all .xlsx files in the input folder
-    xls_files = glob.glob(input_folder + "*.xlsx")
+    if xls_files is None:
+        xls_files = list_xlsform_files(input_folder)
 
     XLS_Forms = []
+    remaining_files = []
     
-    # Loop through all .xlsx files
-    for xls_file in tqdm(xls_files):
-        xlsForm = XLS_Form(xls_file, xls_file.split('\\')[-1], lpds_healthboard_abbreviation_dict)
-        XLS_Forms.append(xlsForm)
+    # Loop through all .xlsx files, the next files are read in the background while the current one is parsed
+    with measure_memory(memory_monitor, 'load'):
+        for index, (xls_file, content) in enumerate(tqdm(Input_prefetcher(xls_files, prefetch_depth, prefetch_max_bytes, memory_monitor=memory_monitor))):
+            xlsForm = try_read_xlsform(xls_file, lpds_healthboard_abbreviation_dict, memory_monitor, failure_report, content)
+            if xlsForm is not None:
+                XLS_Forms.append(xlsForm)
+            if memory_monitor is not None and index + 1 < len(xls_files) and memory_monitor.would_exceed_budget(xls_files[index + 1:index + 2]):
+                remaining_files = xls_files[index + 1:]
+                break
 
     logging.info('XLSForms to XForm conversion and validation done!')
 
-    return XLS_Forms
\ No newline at end of file
+    return XLS_Forms, remaining_files
\ No newline at end of file
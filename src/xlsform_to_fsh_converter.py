@@ -1,40 +1,160 @@
-import logging
-from typing import List
+import logging, traceback
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List
 import pandas as pd
 from tqdm import tqdm
 import src.string_util as su
 from src.models.Fsh_questionnaire import Fsh_questionnaire
 from src.models.Fsh_terminology import Fsh_terminology
-from src.models.Fsh_question_reference import Fsh_question_reference, Fsh_question_reference_codesystem
+from src.models.Fsh_question_reference import Fsh_question_reference, Fsh_question_reference_codesystem, get_question_reference_cs_url, read_question_codes
+from src.failure_report import Failure_report
+from src.fhir_id_registry import Fhir_id_registries
 from src.models.XLS_Form import XLS_Form
+from src.memory_monitor import Memory_monitor, measure_memory, get_fsh_lines_list_size
+from src.constants import LPDS_SUBFOLDER, LPDS_QUESTION_REFERENCE_FILE_NAME
     
-def convert_to_fsh(processed_xlsforms: List[XLS_Form]):
+def convert_to_fsh(processed_xlsforms: List[XLS_Form], memory_monitor: Memory_monitor = None, failure_report: Failure_report = None, previous_question_codes_DSCN: list = None,
+                   id_registries: Fhir_id_registries = None, include_question_reference: bool = True, version_date: datetime = None,
+                   lpds_question_reference: bool = False, previous_question_codes_LPDS: dict = None, compact_valueset_threshold: int = None,
+                   flush_fsh_lines: Callable[[list], None] = None):
+    """
+    Converts the XLSForms to FSH lines. Forms that fail to convert are logged, recorded in the
+    failure report and skipped.
+
+    Args:
+        previous_question_codes_DSCN (list, optional): Question codes of DSCN forms that are not converted
+            in this run but must stay in the QuestionReference CodeSystem, e.g. when retrying failed forms.
+        include_question_reference (bool): Whether to add the QuestionReference CodeSystem, False when the
+            DSCN project is not part of a selective build.
+        version_date (datetime, optional): Fixed ^version date of the QuestionReference CodeSystem, for deterministic builds.
+        lpds_question_reference (bool): Whether to add a QuestionReference CodeSystem for every LPDS health board
+            with forms in this run, and item codes to their questionnaires.
+        previous_question_codes_LPDS (dict, optional): Question codes by health board of LPDS forms that are not converted
+            in this run. The CodeSystems of these health boards are always added.
+        compact_valueset_threshold (int, optional): The number of choices from which a ValueSet includes its whole CodeSystem
+            instead of enumerating the codes, see Fsh_terminology.
+        flush_fsh_lines (Callable[[list], None], optional): Called with the FSH lines converted so far whenever memory use exceeds
+            the budget of the `memory_monitor` after a form, e.g. to write them. They are released afterwards, so the returned
+            lists only hold the FSH lines converted after the last flush.
+    """
     fsh_lines_list_DSCN = []
     fsh_lines_list_LPDS = []
-    question_codes_DSCN = []
+    question_codes_DSCN = list(previous_question_codes_DSCN or [])
+    question_codes_LPDS = {board: list(codes) for board, codes in (previous_question_codes_LPDS or {}).items()}
+
+    with measure_memory(memory_monitor, 'convert'):
+        for xlsForm in tqdm(processed_xlsforms):
+            try:
+                fsh_lines, question_codes = convert_xlsform(xlsForm, memory_monitor, id_registries, lpds_question_reference, compact_valueset_threshold)
+            except Exception as e:
+                logging.error(f'Error converting {xlsForm.file_name}: {str(e)}')
+                logging.error(traceback.format_exc())
+                if failure_report is not None:
+                    failure_report.add_failure('convert', xlsForm.input_path, e)
+                continue
+
+            if xlsForm.lpds_healthboard_abbreviation is None:
+                question_codes_DSCN.extend(question_codes)
+                fsh_lines_list_DSCN.append(fsh_lines)
+            else:
+                fsh_lines_list_LPDS.append(fsh_lines)
+                if lpds_question_reference:
+                    question_codes_LPDS.setdefault(xlsForm.lpds_healthboard_abbreviation, []).extend(question_codes)
+
+            if flush_fsh_lines is not None and memory_monitor is not None and memory_monitor.is_over_budget():
+                logging.warning(f'Memory use exceeds the budget after converting {xlsForm.file_name}, writing the FSH lines converted so far.')
+                flush_fsh_lines(fsh_lines_list_DSCN + fsh_lines_list_LPDS)
+                fsh_lines_list_DSCN, fsh_lines_list_LPDS = [], []
+
+        # Add the consolidated CodeSystem to the DSCN list
+        if include_question_reference:
+            fsh_lines_list_DSCN.append(create_question_reference_codesystem_fsh_lines(question_codes_DSCN, version_date))
+        # And one per health board to the LPDS list
+        if lpds_question_reference:
+            fsh_lines_list_LPDS.extend(create_lpds_question_reference_codesystems_fsh_lines(question_codes_LPDS, version_date))
+
+    if memory_monitor is not None:
+        memory_monitor.record_aggregate('fsh_lines_list_DSCN', get_fsh_lines_list_size(fsh_lines_list_DSCN))
+        memory_monitor.record_aggregate('fsh_lines_list_LPDS', get_fsh_lines_list_size(fsh_lines_list_LPDS))
+    
+    return fsh_lines_list_DSCN, fsh_lines_list_LPDS
+
+def convert_xlsform(xlsForm: XLS_Form, memory_monitor: Memory_monitor = None, id_registries: Fhir_id_registries = None, lpds_question_reference: bool = False,
+                    compact_valueset_threshold: int = None):
+    """
+    Converts a single XLSForm to FSH lines. If its ids collide with ids already used in its project and
+    are not disambiguated, Fhir_id_collision_error is raised, so the form is not written.
+
+    Returns:
+        tuple: The FSH lines entry for file_writer.write_fsh_files, and the question codes of the form for the
+            QuestionReference CodeSystem of its project (empty for LPDS forms without `lpds_question_reference`).
+    """
+    logging.info(f'Converting {xlsForm.file_name}...')
+    question_codes = []
+    id_registry = id_registries.for_project(xlsForm.lpds_healthboard_abbreviation) if id_registries is not None else None
 
-    for xlsForm in tqdm(processed_xlsforms):
-        logging.info(f'Converting {xlsForm.file_name}...')
-        questionnaire_fsh_lines = Fsh_questionnaire(xlsForm)            
-        questionnaire_terminology_fsh_lines = Fsh_terminology(xlsForm)
+    with measure_memory(memory_monitor, 'convert', xlsForm.file_name):
+        try:
+            questionnaire_fsh_lines = Fsh_questionnaire(xlsForm, id_registry, lpds_question_reference)            
+            questionnaire_terminology_fsh_lines = Fsh_terminology(xlsForm, id_registry, compact_valueset_threshold)
+        except Exception:
+            # A form that is not written must not keep its ids from other forms
+            if id_registry is not None:
+                id_registry.remove_form(xlsForm.input_path)
+            raise
+        if id_registries is not None:
+            id_registries.check_form(xlsForm.input_path, xlsForm.lpds_healthboard_abbreviation)
 
         if xlsForm.lpds_healthboard_abbreviation is None:
-            # Only collect question references for DSCN questionnaires
             question_reference_fsh = Fsh_question_reference(xlsForm)
-            question_codes_DSCN.extend(question_reference_fsh.get_question_codes())
-            fsh_lines_list_DSCN.append((xlsForm.file_name, questionnaire_fsh_lines.lines, questionnaire_terminology_fsh_lines.lines, xlsForm.short_name, xlsForm.version, xlsForm.lpds_healthboard_abbreviation, []))
-        else:
-            fsh_lines_list_LPDS.append((xlsForm.file_name, questionnaire_fsh_lines.lines, questionnaire_terminology_fsh_lines.lines, xlsForm.short_name, xlsForm.version, xlsForm.lpds_healthboard_abbreviation, []))
+            question_codes = question_reference_fsh.get_question_codes()
+        elif lpds_question_reference:
+            # Collected while the items were converted, without a second pass over the survey
+            question_codes = questionnaire_fsh_lines.question_codes
 
-        logging.info(f'Converted {xlsForm.file_name}...')
-    
-    # Create consolidated QuestionReference CodeSystem for DSCN only
-    # LPDS questionnaires do not use item.code elements, so no CodeSystem is needed
-    question_reference_codesystem_dscn = Fsh_question_reference_codesystem(question_codes_DSCN, is_lpds=False)
+    fsh_lines = (xlsForm.file_name, questionnaire_fsh_lines.lines, questionnaire_terminology_fsh_lines.lines, xlsForm.short_name, xlsForm.version, xlsForm.lpds_healthboard_abbreviation, [],
+                 questionnaire_terminology_fsh_lines.external_choice_lists)
+    if memory_monitor is not None:
+        memory_monitor.record_fsh_lines(xlsForm.file_name, fsh_lines)
+
+    logging.info(f'Converted {xlsForm.file_name}...')
+    return fsh_lines, question_codes
+
+def create_question_reference_codesystem_fsh_lines(question_codes_DSCN: list, version_date: datetime = None) -> tuple:
+    # Create consolidated QuestionReference CodeSystem for DSCN
+    # LPDS questionnaires only use item.code elements with their own CodeSystem per health board, see below
+    question_reference_codesystem_dscn = Fsh_question_reference_codesystem(question_codes_DSCN, is_lpds=False, version_date=version_date)
     
-    # Add the consolidated CodeSystem to the DSCN list only
     # Note: Version is ignored for QuestionReferenceCS files as they use date-based versioning internally
-    fsh_lines_list_DSCN.append(([], [], [], 'QuestionReferenceCS', None, [], question_reference_codesystem_dscn.lines))
-    
-    return fsh_lines_list_DSCN, fsh_lines_list_LPDS
+    return ([], [], [], 'QuestionReferenceCS', None, [], question_reference_codesystem_dscn.lines, [])
+
+def create_lpds_question_reference_codesystem_fsh_lines(lpds_healthboard_abbreviation: str, question_codes: list, version_date: datetime = None) -> tuple:
+    """Creates the QuestionReference CodeSystem of an LPDS health board, with its ^url below the canonical URL of the health board."""
+    question_reference_codesystem_lpds = Fsh_question_reference_codesystem(question_codes, is_lpds=True, version_date=version_date,
+                                                                           url=get_question_reference_cs_url(lpds_healthboard_abbreviation))
+    return ([], [], [], 'LPDSQuestionReferenceCS', None, lpds_healthboard_abbreviation, question_reference_codesystem_lpds.lines, [])
+
+def create_lpds_question_reference_codesystems_fsh_lines(question_codes_LPDS: dict, version_date: datetime = None) -> list:
+    """
+    Creates the QuestionReference CodeSystems of the LPDS health boards.
+
+    Args:
+        question_codes_LPDS (dict): The question codes by health board abbreviation.
+
+    Returns:
+        list: The FSH lines entries, ordered by health board.
+    """
+    return [create_lpds_question_reference_codesystem_fsh_lines(board, question_codes_LPDS[board], version_date) for board in sorted(question_codes_LPDS)]
 
+def read_lpds_question_codes(output_folder, boards: list) -> dict:
+    """
+    Reads the question codes of the QuestionReference CodeSystems of LPDS health boards, e.g. from a generation
+    seeded from the previous output. Health boards without a QuestionReference CodeSystem are left out.
+    """
+    question_codes_LPDS = {}
+    for board in sorted(set(boards)):
+        question_reference_file = Path(output_folder) / LPDS_SUBFOLDER / board / 'input' / 'fsh' / 'terminology' / LPDS_QUESTION_REFERENCE_FILE_NAME
+        if question_reference_file.exists():
+            question_codes_LPDS[board] = read_question_codes(question_reference_file)
+    return question_codes_LPDS
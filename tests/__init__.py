@@ -0,0 +1,4 @@
+import logging
+
+# The expected warnings and errors of the tested code are not printed
+logging.disable(logging.ERROR)
@@ -0,0 +1,91 @@
+import json, os, stat, subprocess, sys
+from pathlib import Path
+import pandas as pd
+import src.file_writer as fw
+import src.xlsform_to_fsh_converter as fsh
+from src.fhir_id_registry import Fhir_id_registries
+from src.models.XLS_Form import XLS_Form
+
+TOOL_FOLDER = Path(__file__).resolve().parent.parent
+
+LPDS_HEALTHBOARD_ABBREVIATION_DICT = {'ABU': 'https://fhir.abuhb.nhs.wales', 'CTM': 'https://fhir.ctmuhb.nhs.wales'}
+
+# A group with a select_one and a text question, like most PROMs forms
+SURVEY = [
+    {'type': 'begin_group', 'name': 'g1', 'label': 'Group 1', 'format': ''},
+    {'type': 'select_one yesno', 'name': 'q1', 'label': 'Do you "like" it?'},
+    {'type': 'text', 'name': 'q2', 'label': 'Name'},
+    {'type': 'end_group', 'name': '', 'label': ''},
+]
+CHOICES = [
+    {'list_name': 'yesno', 'name': 'yes', 'label': 'Yes'},
+    {'list_name': 'yesno', 'name': 'no', 'label': 'No'},
+]
+
+def create_form(short_name: str, version: int = 1, board: str = None, survey: list = None, choices: list = None, settings: dict = None) -> dict:
+    """Returns the settings, survey and choices rows of a form definition, as read from a JSON form."""
+    form_settings = {'form_title': f'Title {short_name}', 'form_id': short_name.lower(), 'version': version, 'tool_short_form': short_name}
+    if board is not None:
+        form_settings['lpds_healthboard_abbreviation'] = board
+    form_settings.update(settings or {})
+    return {'settings': [form_settings], 'survey': survey if survey is not None else SURVEY, 'choices': choices if choices is not None else CHOICES}
+
+def create_xlsform(input_path, **form) -> XLS_Form:
+    """Loads a form definition from rows, see create_form, as if it was read from `input_path`."""
+    # Cells missing from a row are empty, like in a workbook
+    sheets = {sheet_name: pd.DataFrame(rows).fillna('') for sheet_name, rows in create_form(**form).items()}
+    return XLS_Form(str(input_path), str(input_path), LPDS_HEALTHBOARD_ABBREVIATION_DICT, sheets)
+
+def write_json_form(input_path, **form) -> str:
+    """Writes a form definition, see create_form, as a JSON form that main.py reads from the input folder."""
+    Path(input_path).write_text(json.dumps(create_form(**form)), encoding='utf-8')
+    return str(input_path)
+
+def build_projects(output_folder, xlsforms: list, id_registries: Fhir_id_registries = None, **options) -> tuple:
+    """Converts the forms and writes their SUSHI projects, returning the DSCN and LPDS FSH lines."""
+    fsh_lines_list_DSCN, fsh_lines_list_LPDS = fsh.convert_to_fsh(xlsforms, id_registries=id_registries, **options)
+    fw.write_fsh_files(fsh_lines_list_DSCN + fsh_lines_list_LPDS, output_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT)
+    return fsh_lines_list_DSCN, fsh_lines_list_LPDS
+
+def read_fsh_files(project_folder) -> dict:
+    """Returns the FSH files of a SUSHI project by their path in the input/fsh folder."""
+    fsh_folder = Path(project_folder) / 'input' / 'fsh'
+    return {f.relative_to(fsh_folder).as_posix(): f.read_text(encoding='utf-8') for f in sorted(fsh_folder.rglob('*.fsh'))}
+
+# Stands in for the SUSHI command line tool: writes a resource per FSH definition of the project it runs in,
+# and fails for projects whose path contains FAKE_SUSHI_FAIL
+FAKE_SUSHI_CLI = f'''#!{sys.executable}
+import json, os, re, sys
+from pathlib import Path
+project = Path.cwd()
+if os.environ.get('FAKE_SUSHI_FAIL') and os.environ['FAKE_SUSHI_FAIL'] in project.as_posix():
+    print('error Forced failure')
+    sys.exit(1)
+resources = project / 'fsh-generated' / 'resources'
+resources.mkdir(parents=True, exist_ok=True)
+for fsh_file in sorted((project / 'input' / 'fsh').rglob('*.fsh')):
+    for match in re.finditer(r'^(CodeSystem|ValueSet|Instance): *(\\S+)', fsh_file.read_text(encoding='utf-8'), re.MULTILINE):
+        resource_type = 'Questionnaire' if match.group(1) == 'Instance' else match.group(1)
+        resource = {{'resourceType': resource_type, 'id': match.group(2), 'url': f'https://example.org/{{resource_type}}/{{match.group(2)}}'}}
+        (resources / f'{{resource_type}}-{{match.group(2)}}.json').write_text(json.dumps(resource), encoding='utf-8')
+print('0 Errors 0 Warnings')
+'''
+
+def create_fake_sushi(bin_folder) -> Path:
+    """Writes an executable `sushi` into the folder, see FAKE_SUSHI_CLI."""
+    Path(bin_folder).mkdir(parents=True, exist_ok=True)
+    sushi_cli = Path(bin_folder) / 'sushi'
+    sushi_cli.write_text(FAKE_SUSHI_CLI, encoding='utf-8')
+    sushi_cli.chmod(sushi_cli.stat().st_mode | stat.S_IEXEC)
+    return sushi_cli
+
+def run_main(working_folder, *args, env: dict = None) -> subprocess.CompletedProcess:
+    """
+    Runs main.py in the working folder, which holds the input and output folders, with the fake SUSHI first on the PATH.
+    The output of the run is in the returned process, and it is printed when a test fails.
+    """
+    bin_folder = Path(working_folder) / '.bin'
+    create_fake_sushi(bin_folder)
+    run_env = {**os.environ, 'PATH': os.pathsep.join([str(bin_folder), os.environ.get('PATH', '')]), **(env or {})}
+    return subprocess.run([sys.executable, str(TOOL_FOLDER / 'main.py'), *args], cwd=working_folder, env=run_env,
+                          capture_output=True, text=True, encoding='utf-8')
@@ -0,0 +1,76 @@
+import os, tempfile, unittest
+from pathlib import Path
+from unittest import mock
+from src.build_scheduler import Build_scheduler
+from src.failure_report import Failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from tests.forms import LPDS_HEALTHBOARD_ABBREVIATION_DICT, build_projects, create_fake_sushi, create_xlsform, read_fsh_files, run_main, write_json_form
+
+class Build_scheduler_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        create_fake_sushi(self.folder / 'bin')
+        path_patch = mock.patch.dict(os.environ, {'PATH': os.pathsep.join([str(self.folder / 'bin'), os.environ.get('PATH', '')])})
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def create_xlsforms(self) -> list:
+        return [create_xlsform(self.folder / 'abu.json', short_name='FormB', board='ABU'), create_xlsform(self.folder / 'a.json', short_name='FormA'),
+                create_xlsform(self.folder / 'ctm.json', short_name='FormC', board='CTM')]
+
+    def test_projects_are_compiled_as_they_are_written(self):
+        output_folder = self.folder / 'pipelined'
+        failure_report = Failure_report(output_folder)
+        scheduler = Build_scheduler(output_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, failure_report, Fhir_id_registries(), lpds_question_reference=True)
+
+        failed_folders = scheduler.run(self.create_xlsforms())
+
+        self.assertEqual(failed_folders, [])
+        self.assertFalse(failure_report.has_failures())
+        # DSCN, the longest chain, is written first
+        self.assertEqual([project.relative_to(output_folder).as_posix() for project in scheduler.completed_folders], ['DSCN', 'LPDS/ABU', 'LPDS/CTM'])
+        self.assertEqual(scheduler.compiled_folders, scheduler.completed_folders)
+        for project in scheduler.compiled_folders:
+            self.assertTrue(any((project / 'fsh-generated' / 'resources').glob('Questionnaire-*.json')))
+
+        build_projects(self.folder / 'batch', self.create_xlsforms(), Fhir_id_registries(), lpds_question_reference=True)
+        for project in ('DSCN', 'LPDS/ABU', 'LPDS/CTM'):
+            self.assertEqual(read_fsh_files(output_folder / project), read_fsh_files(self.folder / 'batch' / project))
+
+    def test_failing_project_does_not_stop_the_others(self):
+        output_folder = self.folder / 'pipelined'
+        failure_report = Failure_report(output_folder)
+        scheduler = Build_scheduler(output_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, failure_report, Fhir_id_registries(), max_sushi_processes=2)
+        # A form whose ids collide with another form of its project fails, the project is still compiled without it
+        xlsforms = self.create_xlsforms() + [create_xlsform(self.folder / 'copy.json', short_name='FormA')]
+
+        with mock.patch.dict(os.environ, {'FAKE_SUSHI_FAIL': 'LPDS/CTM'}):
+            failed_folders = scheduler.run(xlsforms)
+
+        self.assertEqual(failed_folders, [output_folder / 'LPDS' / 'CTM'])
+        self.assertEqual(len(scheduler.compiled_folders), 3)
+        self.assertEqual([(failure['stage'], Path(failure['form']).name) for failure in failure_report.failures], [('convert', 'copy.json')])
+        self.assertTrue((output_folder / 'DSCN' / 'fsh-generated').is_dir())
+
+    def test_pipelined_option(self):
+        input_folder = self.folder / 'input'
+        input_folder.mkdir()
+        write_json_form(input_folder / 'a.json', short_name='FormA')
+        write_json_form(input_folder / 'b.json', short_name='FormB', board='ABU')
+
+        trees = {}
+        for options in ((), ('--pipelined',)):
+            run = run_main(self.folder, '--deterministic', '--version-date', '20260101', *options)
+            self.assertEqual(run.returncode, 0, run.stderr)
+            current = self.folder / 'output' / 'current'
+            trees[options] = {project: read_fsh_files(current / project) for project in ('DSCN', 'LPDS/ABU')}
+        self.assertIn('Steps 2 to 4 - Convert, write and compile each project as soon as its forms are written', run.stdout)
+        self.assertEqual(trees[()], trees[('--pipelined',)])
+
+if __name__ == '__main__':
+    unittest.main()
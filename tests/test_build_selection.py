@@ -0,0 +1,93 @@
+import tempfile, unittest
+from pathlib import Path
+from src.build_selection import Build_selection
+from src.constants import LPDS_HEALTHBOARD_ABBREVIATION_DICT
+from tests.forms import run_main, write_json_form
+
+class Build_selection_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_board_aliases(self):
+        selection = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, boards=['7A6'])
+
+        self.assertTrue(selection.includes_project('ABU'))
+        self.assertTrue(selection.includes_project('7A6'))
+        self.assertFalse(selection.includes_project('CTM'))
+        self.assertFalse(selection.includes_project(None))
+        self.assertTrue(selection.includes_project_folder(self.folder, self.folder / 'LPDS' / 'ABU'))
+        self.assertFalse(selection.includes_project_folder(self.folder, self.folder / 'DSCN'))
+
+        with self.assertRaises(ValueError) as context:
+            Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, boards=['ABU', 'XYZ'])
+        self.assertIn('Unknown health board abbreviations: XYZ.', str(context.exception))
+
+    def test_dscn_only_and_forms(self):
+        dscn_only = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, dscn_only=True)
+        self.assertTrue(dscn_only.includes_project(None))
+        self.assertFalse(dscn_only.includes_project('ABU'))
+        dscn_and_board = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, boards=['CTM'], dscn_only=True)
+        self.assertTrue(dscn_and_board.includes_project(None) and dscn_and_board.includes_project('7A5'))
+
+        # Short names are compared like tool_short_form is formatted
+        forms = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, forms=['Form_A'])
+        self.assertTrue(forms.includes_form('Form A'))
+        self.assertTrue(forms.includes_form('Form-A', 'ABU'))
+        self.assertFalse(forms.includes_form('Form-AB'))
+        self.assertTrue(forms.includes_md_entry({'short_name': 'Form-A', 'lpds_healthboard_abbreviation': 'CTM'}))
+
+    def test_selected_files(self):
+        write_json_form(self.folder / 'a.json', short_name='FormA')
+        write_json_form(self.folder / 'b.json', short_name='FormA', board='ABU')
+        write_json_form(self.folder / 'c.json', short_name='FormB', board='ABU')
+        (self.folder / 'broken.json').write_text('{', encoding='utf-8')
+        xls_files = [str(self.folder / name) for name in ('a.json', 'b.json', 'broken.json', 'c.json')]
+
+        selection = Build_selection(LPDS_HEALTHBOARD_ABBREVIATION_DICT, boards=['7A6'], forms=['FormA'])
+        # Forms whose settings cannot be read are loaded, so their errors are reported
+        self.assertEqual(selection.filter_xlsform_files(xls_files), [xls_files[1], xls_files[2]])
+
+        # The external choices of a form are in a terminology file of their own, see external_choices.py
+        for project_folder, file_name in (('DSCN', 'questionnaires/FormA-v1.fsh'), ('LPDS/ABU', 'questionnaires/FormA-v1.fsh'),
+                                          ('LPDS/ABU', 'questionnaires/FormAB-v1.fsh'), ('LPDS/ABU', 'terminology/FormA-v1.Meds.fsh')):
+            fsh_file = self.folder / 'generation' / project_folder / 'input' / 'fsh' / file_name
+            fsh_file.parent.mkdir(parents=True, exist_ok=True)
+            fsh_file.touch()
+        self.assertEqual([fsh_file.relative_to(self.folder / 'generation').as_posix() for fsh_file in selection.get_selected_fsh_files(self.folder / 'generation')],
+                         ['LPDS/ABU/input/fsh/questionnaires/FormA-v1.fsh', 'LPDS/ABU/input/fsh/terminology/FormA-v1.Meds.fsh'])
+
+    def test_board_option(self):
+        input_folder = self.folder / 'input'
+        input_folder.mkdir()
+        write_json_form(input_folder / 'a.json', short_name='FormA')
+        write_json_form(input_folder / 'b.json', short_name='FormB', board='ABU')
+        write_json_form(input_folder / 'c.json', short_name='FormC', board='CTM')
+        full_build = run_main(self.folder)
+        self.assertEqual(full_build.returncode, 0, full_build.stderr)
+
+        # Only the ABU form is rebuilt, the changes to the other forms are not picked up
+        for input_file, short_name, board in (('a.json', 'FormA', None), ('b.json', 'FormB', 'ABU'), ('c.json', 'FormC', 'CTM')):
+            write_json_form(input_folder / input_file, short_name=short_name, board=board, settings={'form_title': 'Changed'})
+        selective_build = run_main(self.folder, '--board', '7A6')
+        self.assertEqual(selective_build.returncode, 0, selective_build.stderr)
+        self.assertIn('Selected 1 forms: input/b.json', selective_build.stdout)
+
+        current = self.folder / 'output' / 'current'
+        questionnaires = {path: (current / path).read_text(encoding='utf-8') for path in (
+            'DSCN/input/fsh/questionnaires/FormA-v1.fsh', 'LPDS/ABU/input/fsh/questionnaires/FormB-v1.fsh', 'LPDS/CTM/input/fsh/questionnaires/FormC-v1.fsh')}
+        self.assertNotIn('Changed', questionnaires['DSCN/input/fsh/questionnaires/FormA-v1.fsh'])
+        self.assertIn('* title = "Changed"', questionnaires['LPDS/ABU/input/fsh/questionnaires/FormB-v1.fsh'])
+        self.assertNotIn('Changed', questionnaires['LPDS/CTM/input/fsh/questionnaires/FormC-v1.fsh'])
+        overview = (current / 'Overview of processed XLSForms.md').read_text(encoding='utf-8')
+        self.assertTrue(all(short_name in overview for short_name in ('FormA', 'FormB', 'FormC')))
+
+        unknown_board = run_main(self.folder, '--board', 'XYZ')
+        self.assertEqual(unknown_board.returncode, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import tempfile, unittest
+from pathlib import Path
+from src.build_steps import Build_steps, release_xlsforms
+from src.failure_report import Failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from src.memory_monitor import Memory_monitor
+from tests.forms import LPDS_HEALTHBOARD_ABBREVIATION_DICT, build_projects, create_xlsform, read_fsh_files
+
+class Build_steps_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def create_xlsforms(self) -> list:
+        return [create_xlsform(self.folder / 'a.json', short_name='FormA'), create_xlsform(self.folder / 'b.json', short_name='FormB'),
+                create_xlsform(self.folder / 'c.json', short_name='FormC', board='ABU')]
+
+    def test_one_at_a_time_writes_the_same_projects(self):
+        batch_folder = self.folder / 'batch'
+        build_projects(batch_folder, self.create_xlsforms(), Fhir_id_registries(), lpds_question_reference=True)
+
+        output_folder = self.folder / 'one_at_a_time'
+        failure_report = Failure_report(output_folder)
+        build_steps = Build_steps(output_folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, failure_report, Fhir_id_registries(), lpds_question_reference=True)
+        xlsforms = self.create_xlsforms()
+        project_forms = {}
+        md_overview = build_steps.convert_and_write_one_at_a_time(release_xlsforms(xlsforms), project_forms)
+
+        # The forms are released once they have been written
+        self.assertEqual(xlsforms, [])
+        for project in ('DSCN', 'LPDS/ABU'):
+            self.assertEqual(read_fsh_files(output_folder / project).keys(), read_fsh_files(batch_folder / project).keys())
+        self.assertEqual(read_fsh_files(output_folder / 'DSCN')['questionnaires/FormA-v1.fsh'], read_fsh_files(batch_folder / 'DSCN')['questionnaires/FormA-v1.fsh'])
+        self.assertEqual(sorted(len(forms) for forms in project_forms.values()), [1, 2])
+        for short_name in ('FormA', 'FormB', 'FormC'):
+            self.assertIn(short_name, md_overview)
+        self.assertFalse(failure_report.has_failures())
+
+    def test_previous_question_codes_are_kept(self):
+        build_steps = Build_steps(self.folder, LPDS_HEALTHBOARD_ABBREVIATION_DICT, Failure_report(self.folder), Fhir_id_registries())
+        build_steps.convert_and_write_one_at_a_time([create_xlsform(self.folder / 'a.json', short_name='FormA')], {},
+                                                    previous_question_codes_DSCN=[('old_question', 'Old question')])
+
+        codesystem = read_fsh_files(self.folder / 'DSCN')['terminology/QuestionReferenceCS.fsh']
+        self.assertIn('* #old_question "Old question"', codesystem)
+        self.assertIn('* #q1 ', codesystem)
+
+    def test_memory_budget(self):
+        input_file = self.folder / 'form.xlsx'
+        input_file.write_bytes(b'x' * 1024 * 1024)
+
+        self.assertFalse(Memory_monitor().would_exceed_budget([str(input_file)]))
+        self.assertTrue(Memory_monitor(budget_bytes=1024).would_exceed_budget([str(input_file)]))
+        # Files that do not exist add nothing to the estimate
+        memory_monitor = Memory_monitor(budget_bytes=10 * 1024 ** 3)
+        self.assertFalse(memory_monitor.would_exceed_budget([str(self.folder / 'missing.xlsx')]))
+        self.assertTrue(memory_monitor.would_exceed_budget([], extra_bytes=memory_monitor.budget_bytes))
+
+if __name__ == '__main__':
+    unittest.main()
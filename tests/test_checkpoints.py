@@ -0,0 +1,129 @@
+import tempfile, unittest
+from pathlib import Path
+from src.checkpoints import Checkpoint_error, Checkpoints, find_resumable_checkpoints, get_input_fingerprint, is_resumable
+from src.constants import GENERATION_COMPLETE_MARKER, GENERATIONS_SUBFOLDER
+from tests.forms import run_main, write_json_form
+
+class Checkpoints_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        self.generation_folder = self.folder / 'output' / GENERATIONS_SUBFOLDER / '20260101T000000000000'
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_save_and_load_stages(self):
+        checkpoints = Checkpoints.create(self.generation_folder, 'fingerprint')
+        with self.assertRaises(Checkpoint_error):
+            checkpoints.get_resume_stage()
+
+        checkpoints.save_stage('load', {'xlsform_paths': ['a.json']})
+        checkpoints.save_stage('convert', {'fsh_lines_list_DSCN': []})
+        opened = Checkpoints.open(self.generation_folder)
+        self.assertEqual(opened.get_completed_stages(), ['load', 'convert'])
+        self.assertEqual(opened.load_stage('load'), {'xlsform_paths': ['a.json']})
+        self.assertEqual(opened.get_resume_stage(), 'write')
+        self.assertEqual(opened.get_resume_stage('convert'), 'convert')
+        with self.assertRaises(Checkpoint_error):
+            opened.get_resume_stage('sushi')
+
+        # Saving a stage again makes the checkpoints of the later stages stale
+        checkpoints.save_stage('load', {'xlsform_paths': ['b.json']})
+        self.assertEqual(checkpoints.get_completed_stages(), ['load'])
+        with self.assertRaises(Checkpoint_error) as context:
+            checkpoints.load_stage('convert')
+        self.assertIn('is missing', str(context.exception))
+
+    def test_damaged_checkpoints(self):
+        checkpoints = Checkpoints.create(self.generation_folder, 'fingerprint')
+        checkpoints.save_stage('load', {'xlsform_paths': ['a.json']})
+        with open(checkpoints.folder / 'load.pickle', 'ab') as checkpoint_file:
+            checkpoint_file.write(b'\0')
+        with self.assertRaises(Checkpoint_error) as context:
+            checkpoints.load_stage('load')
+        self.assertIn('is damaged', str(context.exception))
+
+        (checkpoints.folder / 'manifest.json').write_text('{"fingerprint": "fingerprint"}', encoding='utf-8')
+        self.assertIsNone(Checkpoints.open(self.generation_folder))
+        self.assertIsNone(Checkpoints.open(self.folder / 'missing'))
+
+    def test_sushi_projects(self):
+        checkpoints = Checkpoints.create(self.generation_folder, 'fingerprint')
+        checkpoints.save_stage('write', {})
+        project_folder = self.generation_folder / 'DSCN'
+        (project_folder / 'input' / 'fsh').mkdir(parents=True)
+        (project_folder / 'sushi-config.yaml').write_text('canonical: https://fhir.nhs.wales\n', encoding='utf-8')
+        fsh_file = project_folder / 'input' / 'fsh' / 'FormA.fsh'
+        fsh_file.write_text('ValueSet: FormA-YesnoVS\n', encoding='utf-8')
+
+        checkpoints.record_sushi_result(project_folder, False)
+        self.assertFalse(checkpoints.is_sushi_project_done(project_folder))
+        checkpoints.record_sushi_result(project_folder, True)
+        # The project is only done while its SUSHI output exists
+        self.assertFalse(checkpoints.is_sushi_project_done(project_folder))
+        (project_folder / 'fsh-generated').mkdir()
+        self.assertTrue(Checkpoints.open(self.generation_folder).is_sushi_project_done(project_folder))
+
+        fsh_file.write_text('ValueSet: FormA-OtherVS\n', encoding='utf-8')
+        self.assertFalse(checkpoints.is_sushi_project_done(project_folder))
+
+    def test_input_fingerprint(self):
+        json_form = write_json_form(self.folder / 'a.json', short_name='FormA')
+        csvform = self.folder / 'b.csvform'
+        csvform.mkdir()
+        (csvform / 'survey.csv').write_text('type,name,label\ntext,q1,Name\n', encoding='utf-8')
+        fingerprint = get_input_fingerprint([json_form, str(csvform)], {'deterministic': True})
+
+        self.assertEqual(get_input_fingerprint([str(csvform), json_form], {'deterministic': True}), fingerprint)
+        self.assertNotEqual(get_input_fingerprint([json_form, str(csvform)], {'deterministic': False}), fingerprint)
+        # The CSV files of a .csvform folder are inputs too
+        (csvform / 'survey.csv').write_text('type,name,label\ntext,q1,Full name\n', encoding='utf-8')
+        self.assertNotEqual(get_input_fingerprint([json_form, str(csvform)], {'deterministic': True}), fingerprint)
+
+    def test_find_resumable_checkpoints(self):
+        output_folder = self.folder / 'output'
+        with self.assertRaises(Checkpoint_error):
+            find_resumable_checkpoints(output_folder, 'fingerprint')
+
+        Checkpoints.create(self.generation_folder, 'fingerprint').save_stage('load', {})
+        # A later run that completed does not hide the interrupted run
+        completed_generation = self.generation_folder.with_name('20260102T000000000000')
+        Checkpoints.create(completed_generation, 'fingerprint').save_stage('load', {})
+        (completed_generation / GENERATION_COMPLETE_MARKER).touch()
+        self.assertTrue(is_resumable(self.generation_folder))
+        self.assertFalse(is_resumable(completed_generation))
+
+        self.assertEqual(find_resumable_checkpoints(output_folder, 'fingerprint').generation_folder, self.generation_folder)
+        with self.assertRaises(Checkpoint_error) as context:
+            find_resumable_checkpoints(output_folder, 'changed')
+        self.assertIn('changed since the checkpoints', str(context.exception))
+
+    def test_resume_option(self):
+        input_folder = self.folder / 'input'
+        input_folder.mkdir()
+        write_json_form(input_folder / 'a.json', short_name='FormA')
+        write_json_form(input_folder / 'b.json', short_name='FormB', board='ABU')
+
+        failed_run = run_main(self.folder, env={'FAKE_SUSHI_FAIL': 'LPDS/ABU'})
+        self.assertEqual(failed_run.returncode, 0, failed_run.stderr)
+        self.assertIn('Rerun with --resume', failed_run.stdout)
+        self.assertFalse((self.folder / 'output' / 'current').exists())
+
+        # Only SUSHI runs again, and only for the project that failed
+        resumed_run = run_main(self.folder, '--resume')
+        self.assertEqual(resumed_run.returncode, 0, resumed_run.stderr)
+        self.assertIn('from the sushi stage', resumed_run.stdout)
+        self.assertIn('Skipping SUSHI for 1 projects compiled before the run was interrupted', resumed_run.stdout)
+        self.assertNotIn('SUSHI compiled DSCN', resumed_run.stdout)
+        self.assertTrue((self.folder / 'output' / 'current' / 'LPDS' / 'ABU' / 'fsh-generated').is_dir())
+
+        # Nothing is left to resume, the run starts afresh
+        fresh_run = run_main(self.folder, '--resume')
+        self.assertEqual(fresh_run.returncode, 0, fresh_run.stderr)
+        self.assertIn('Starting a fresh run', fresh_run.stderr)
+        self.assertIn('SUSHI compiled DSCN', fresh_run.stdout)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import tempfile, unittest
+from pathlib import Path
+from src.fsh_preflight import check_project
+from tests.forms import CHOICES, build_projects, create_xlsform, read_fsh_files, run_main, write_json_form
+
+# A list of three choices next to the yes/no list of two
+SURVEY = [
+    {'type': 'select_one yesno', 'name': 'q1', 'label': 'Do you like it?', 'format': ''},
+    {'type': 'select_one colours', 'name': 'q2', 'label': 'Colour'},
+]
+COLOURS = CHOICES + [
+    {'list_name': 'colours', 'name': 'red', 'label': 'Red'},
+    {'list_name': 'colours', 'name': 'green', 'label': 'Green'},
+    {'list_name': 'colours', 'name': 'blue', 'label': 'Blue'},
+]
+
+def get_valueset_rules(terminology: str, valueset_id: str) -> list:
+    """Returns the rules after the metadata of a ValueSet, up to the next definition."""
+    lines = terminology.split(f'ValueSet: {valueset_id}\n', 1)[1].split('\n\n')[1]
+    return lines.splitlines()
+
+class Compact_valuesets_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def build_terminology(self, output_name: str, board: str = None, **options) -> tuple:
+        """Builds the form and returns its terminology FSH and its project folder."""
+        output_folder = self.folder / output_name
+        build_projects(output_folder, [create_xlsform(self.folder / 'a.json', short_name='FormA', board=board, survey=SURVEY, choices=COLOURS)], **options)
+        project_folder = output_folder / ('LPDS/ABU' if board else 'DSCN')
+        return read_fsh_files(project_folder)['terminology/FormA-v1.fsh'], project_folder
+
+    def test_lists_from_the_threshold_are_compact(self):
+        enumerated, _ = self.build_terminology('enumerated')
+        self.assertEqual(get_valueset_rules(enumerated, 'FormA-ColoursVS'), ['* FormA-ColoursCS#red "Red"', '* FormA-ColoursCS#green "Green"', '* FormA-ColoursCS#blue "Blue"'])
+
+        # Lists with exactly the threshold of choices are compact, smaller lists are not
+        compact, project_folder = self.build_terminology('compact', compact_valueset_threshold=3)
+        self.assertEqual(get_valueset_rules(compact, 'FormA-ColoursVS'), ['* include codes from system FormA-ColoursCS'])
+        self.assertEqual(get_valueset_rules(compact, 'FormA-YesnoVS'), get_valueset_rules(enumerated, 'FormA-YesnoVS'))
+        # The CodeSystems are the same
+        self.assertEqual(compact.split('ValueSet: FormA-YesnoVS')[0], enumerated.split('ValueSet: FormA-YesnoVS')[0])
+        self.assertEqual(check_project(project_folder), [])
+
+        lpds, project_folder = self.build_terminology('lpds', 'ABU', compact_valueset_threshold=1)
+        self.assertEqual(get_valueset_rules(lpds, 'ABU-FormA-YesnoVS'), ['* include codes from system ABU-FormA-YesnoCS'])
+        self.assertEqual(check_project(project_folder), [])
+
+    def test_compact_valuesets_option(self):
+        input_folder = self.folder / 'input'
+        input_folder.mkdir()
+        write_json_form(input_folder / 'a.json', short_name='FormA', survey=SURVEY, choices=COLOURS)
+
+        run = run_main(self.folder, '--compact-valuesets', '2')
+        self.assertEqual(run.returncode, 0, run.stderr)
+        terminology = (self.folder / 'output' / 'current' / 'DSCN' / 'input' / 'fsh' / 'terminology' / 'FormA-v1.fsh').read_text(encoding='utf-8')
+        self.assertEqual(terminology.count('* include codes from system '), 2)
+
+        invalid = run_main(self.folder, '--compact-valuesets', '0')
+        self.assertEqual(invalid.returncode, 2)
+        self.assertIn('--compact-valuesets must be at least 1.', invalid.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import tempfile, unittest
+from pathlib import Path
+from src.external_choices import External_choice_list, parse_external_choice_type
+from src.failure_report import Failure_report
+from tests.forms import SURVEY, build_projects, create_xlsform, read_fsh_files
+
+MEDS_CSV = 'name,label,label::Welsh (cy)\nasp,Aspirin,Asbrin\npar,"Para ""cetamol""",\n'
+ITEMSETS_CSV = 'list_name,name,label\npostcodes,cf10,Cardiff\nother,x,X\npostcodes,sa1,Swansea\n'
+
+def create_survey(*external_rows) -> list:
+    return SURVEY[:3] + list(external_rows) + SURVEY[3:]
+
+class External_choices_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        (self.folder / 'meds.csv').write_text(MEDS_CSV, encoding='utf-8')
+        (self.folder / 'itemsets.csv').write_text(ITEMSETS_CSV, encoding='utf-8')
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def create_xlsform(self):
+        return create_xlsform(self.folder / 'a.json', short_name='FormA', survey=create_survey(
+            {'type': 'select_one_from_file meds.csv', 'name': 'q3', 'label': 'Medication'},
+            {'type': 'select_one_external postcodes', 'name': 'q4', 'label': 'Postcode'}))
+
+    def test_choices_from_csv_files(self):
+        self.assertEqual(parse_external_choice_type('select_multiple_from_file meds.csv'), ('meds', 'meds.csv', None))
+        self.assertEqual(parse_external_choice_type('select_one_external postcodes'), ('postcodes', 'itemsets.csv', 'postcodes'))
+        self.assertIsNone(parse_external_choice_type('select_one yesno'))
+
+        build_projects(self.folder / 'output', [self.create_xlsform()])
+
+        fsh_files = read_fsh_files(self.folder / 'output' / 'DSCN')
+        self.assertIn('* answerValueSet = Canonical(FormA-MedsVS)', fsh_files['questionnaires/FormA-v1.fsh'])
+        meds = fsh_files['terminology/FormA-v1.Meds.fsh']
+        self.assertTrue(meds.startswith('// External choices: meds.csv, sha256 '))
+        self.assertIn('* #asp "Aspirin"\n  * ^designation[+].language = #cy\n  * ^designation[=].value = "Asbrin"\n* #par "Para \\"cetamol\\""\n\n', meds)
+        self.assertIn('* include codes from system FormA-MedsCS', meds)
+        # itemsets.csv holds the rows of all external lists
+        postcodes = fsh_files['terminology/FormA-v1.Postcodes.fsh']
+        self.assertIn('* #cf10 "Cardiff"\n* #sa1 "Swansea"\n\n', postcodes)
+        self.assertNotIn('#x', postcodes)
+
+    def test_unchanged_lists_are_reused(self):
+        fsh_lines_list_DSCN, _ = build_projects(self.folder / 'previous', [self.create_xlsform()])
+        previous_folder = self.folder / 'previous' / 'DSCN' / 'input' / 'fsh' / 'terminology'
+        meds, postcodes = fsh_lines_list_DSCN[0][7]
+        (self.folder / 'next').mkdir()
+
+        self.assertTrue(meds.write_to_folder(previous_folder))
+        self.assertTrue(meds.write_to_folder(self.folder / 'next', previous_folder))
+        self.assertEqual((self.folder / 'next' / meds.file_name).read_text(encoding='utf-8'), (previous_folder / meds.file_name).read_text(encoding='utf-8'))
+
+        # A changed CSV file is streamed again
+        (self.folder / 'itemsets.csv').write_text(ITEMSETS_CSV + 'postcodes,ll11,Wrexham\n', encoding='utf-8')
+        fsh_lines_list_DSCN, _ = build_projects(self.folder / 'changed', [self.create_xlsform()])
+        changed_postcodes = fsh_lines_list_DSCN[0][7][1]
+        self.assertNotEqual(changed_postcodes.header, postcodes.header)
+        self.assertFalse(changed_postcodes.write_to_folder(self.folder / 'next', previous_folder))
+        self.assertIn('* #ll11 "Wrexham"', (self.folder / 'next' / changed_postcodes.file_name).read_text(encoding='utf-8'))
+
+    def test_invalid_external_choices(self):
+        with self.assertRaises(ValueError) as context:
+            create_xlsform(self.folder / 'a.json', short_name='FormA', survey=create_survey({'type': 'select_one_from_file missing.csv', 'name': 'q3', 'label': 'Q'}))
+        self.assertIn("The choices of 'select_one_from_file missing.csv' are not found", str(context.exception))
+
+        with self.assertRaises(ValueError) as context:
+            parse_external_choice_type('select_one_from_file meds.xml')
+        self.assertIn('must be in a CSV file', str(context.exception))
+
+        (self.folder / 'codes.csv').write_text('code,label\nasp,Aspirin\n', encoding='utf-8')
+        with self.assertRaises(ValueError) as context:
+            External_choice_list(self.folder / 'codes.csv', None, 'FormA-v1.Codes.fsh', [], [], lambda language: None)
+        self.assertIn('has no name column', str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            External_choice_list(self.folder / 'meds.csv', 'meds', 'FormA-v1.Meds.fsh', [], [], lambda language: None)
+        self.assertIn('has no list_name column', str(context.exception))
+
+        # The form fails to convert, the others are converted
+        failure_report = Failure_report(self.folder)
+        xlsforms = [create_xlsform(self.folder / 'b.json', short_name='FormB', survey=create_survey({'type': 'select_one_from_file codes.csv', 'name': 'q3', 'label': 'Q'})),
+                    create_xlsform(self.folder / 'c.json', short_name='FormC')]
+        build_projects(self.folder / 'output', xlsforms, failure_report=failure_report)
+        self.assertEqual([(failure['stage'], Path(failure['form']).name) for failure in failure_report.failures], [('convert', 'b.json')])
+        self.assertEqual(sorted(read_fsh_files(self.folder / 'output' / 'DSCN')), ['questionnaires/FormC-v1.fsh', 'terminology/FormC-v1.fsh', 'terminology/QuestionReferenceCS.fsh'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json, tempfile, unittest
+from pathlib import Path
+import src.xlsform_processor as xls
+import src.xlsform_to_fsh_converter as fsh
+from src.failure_report import Failure_report, load_failure_report
+from src.fhir_id_registry import Fhir_id_registries
+from tests.forms import LPDS_HEALTHBOARD_ABBREVIATION_DICT, create_xlsform, run_main, write_json_form
+
+class Failure_report_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_failures_per_form_and_project(self):
+        failure_report = Failure_report(self.folder)
+        for form in ('a.json', 'b.json', 'c.json'):
+            failure_report.add_processed_form(form, {'short_name': form})
+        try:
+            raise ValueError('Broken form')
+        except ValueError as e:
+            failure_report.add_failure('convert', 'a.json', e)
+        failure_report.add_failure('sushi', None, 'SUSHI failed for LPDS/ABU.', project='LPDS/ABU', forms=['b.json'])
+        # A failed form does not come back as processed
+        failure_report.add_processed_form('a.json', {'short_name': 'a.json'})
+
+        self.assertEqual(failure_report.get_failed_forms(), {'a.json', 'b.json'})
+        self.assertEqual(list(failure_report.processed_forms), ['c.json'])
+        self.assertIn('ValueError: Broken form', failure_report.failures[0]['traceback'])
+        self.assertIsNone(failure_report.failures[1]['traceback'])
+
+        report_path = self.folder / 'failure_report.json'
+        failure_report.write(report_path)
+        report = load_failure_report(report_path)
+        self.assertEqual(report['failed_forms'], ['a.json', 'b.json'])
+        self.assertEqual(report['generation'], str(self.folder))
+
+        restored = Failure_report(self.folder)
+        restored.restore_state(json.loads(json.dumps(failure_report.get_state())))
+        self.assertEqual(restored.get_failed_forms(), failure_report.get_failed_forms())
+        self.assertIsNone(load_failure_report(self.folder / 'missing.json'))
+
+    def test_broken_forms_do_not_stop_the_batch(self):
+        write_json_form(self.folder / 'good.json', short_name='Good')
+        write_json_form(self.folder / 'broken.json', short_name='Broken', settings={'version': ''})
+        failure_report = Failure_report(self.folder)
+
+        xlsforms = list(xls.iterate_xlsforms([str(self.folder / 'broken.json'), str(self.folder / 'good.json')], LPDS_HEALTHBOARD_ABBREVIATION_DICT,
+                                             failure_report=failure_report, prefetch_depth=0))
+        # Two forms with the same ids collide, the second one fails to convert
+        xlsforms.append(create_xlsform(self.folder / 'copy.json', short_name='Good'))
+        fsh_lines_list_DSCN, _ = fsh.convert_to_fsh(xlsforms, failure_report=failure_report, id_registries=Fhir_id_registries())
+
+        self.assertEqual([entry[3] for entry in fsh_lines_list_DSCN], ['Good', 'QuestionReferenceCS'])
+        self.assertEqual([(failure['stage'], Path(failure['form']).name) for failure in failure_report.failures],
+                         [('load', 'broken.json'), ('convert', 'copy.json')])
+
+    def test_retry_failed(self):
+        input_folder = self.folder / 'input'
+        input_folder.mkdir()
+        write_json_form(input_folder / 'a.json', short_name='FormA')
+        write_json_form(input_folder / 'b.json', short_name='FormB', board='ABU', settings={'version': ''})
+
+        first_run = run_main(self.folder)
+        self.assertEqual(first_run.returncode, 0, first_run.stderr)
+        report = load_failure_report(self.folder / 'output' / 'failure_report.json')
+        self.assertEqual(report['failed_forms'], ['input/b.json'])
+        # The failed run is not activated
+        self.assertFalse((self.folder / 'output' / 'current').exists())
+
+        write_json_form(input_folder / 'b.json', short_name='FormB', board='ABU')
+        (input_folder / 'a.json').write_text('not read again', encoding='utf-8')
+        retry = run_main(self.folder, '--retry-failed')
+        self.assertEqual(retry.returncode, 0, retry.stderr)
+        self.assertIn('Retrying 1 failed forms: input/b.json', retry.stdout)
+
+        current = self.folder / 'output' / 'current'
+        self.assertTrue((current / 'DSCN' / 'input' / 'fsh' / 'questionnaires' / 'FormA-v1.fsh').exists())
+        self.assertTrue((current / 'LPDS' / 'ABU' / 'input' / 'fsh' / 'questionnaires' / 'FormB-v1.fsh').exists())
+        overview = (current / 'Overview of processed XLSForms.md').read_text(encoding='utf-8')
+        self.assertIn('FormA', overview)
+        self.assertIn('FormB', overview)
+        self.assertEqual(load_failure_report(self.folder / 'output' / 'failure_report.json')['failed_forms'], [])
+
+        nothing_to_retry = run_main(self.folder, '--retry-failed')
+        self.assertEqual(nothing_to_retry.returncode, 0, nothing_to_retry.stderr)
+        self.assertIn('nothing to retry', nothing_to_retry.stdout)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import re, tempfile, unittest
+from pathlib import Path
+from src.constants import FHIR_ID_MAX_LENGTH
+from src.fhir_id_registry import Fhir_id_collision_error, Fhir_id_registries
+from tests.forms import build_projects, create_xlsform
+
+# Short names that only differ after the id is truncated to 64 characters
+LONG_SHORT_NAMES = ['PatientReportedOutcomeMeasureForTheAssessmentOfKneeFunctionVersionA',
+                    'PatientReportedOutcomeMeasureForTheAssessmentOfKneeFunctionVersionB']
+
+class Fhir_id_registry_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_collisions_fail_the_second_form(self):
+        id_registries = Fhir_id_registries()
+        registry = id_registries.for_project()
+        self.assertEqual(registry.register('ValueSet', ('a.json', 'FormA', 'yesno'), 'FormA-YesnoVS', 'a.json'), 'FormA-YesnoVS')
+        # The same source gets the same id and is no collision
+        self.assertEqual(registry.register('ValueSet', ('a.json', 'FormA', 'yesno'), 'Other', 'a.json'), 'FormA-YesnoVS')
+        # Ids only have to be unique per resource type and project
+        registry.register('CodeSystem', ('a.json', 'FormA', 'yesno'), 'FormA-YesnoVS', 'a.json')
+        id_registries.for_project('ABU').register('ValueSet', ('b.json', 'FormA', 'yesno'), 'FormA-YesnoVS', 'b.json')
+        id_registries.check_form('a.json')
+        id_registries.check_form('b.json', 'ABU')
+
+        registry.register('ValueSet', ('c.json', 'FormA', 'yesno'), 'FormA-YesnoVS', 'c.json')
+        with self.assertRaises(Fhir_id_collision_error) as context:
+            id_registries.check_form('c.json')
+        self.assertIn("ValueSet id 'FormA-YesnoVS' is generated for both", str(context.exception))
+
+        # The ids of the failed form are removed, the first form keeps its id
+        self.assertEqual(registry.register('ValueSet', ('d.json', 'FormD', 'yesno'), 'FormD-YesnoVS', 'd.json'), 'FormD-YesnoVS')
+        id_registries.check_form('d.json')
+        self.assertEqual(len(id_registries.get_collisions()), 1)
+
+    def test_disambiguated_ids_are_deterministic(self):
+        registered_ids = []
+        for _ in range(2):
+            registry = Fhir_id_registries(disambiguate=True).for_project()
+            first = registry.register('Questionnaire', ('a.json', 'A'), 'x' * FHIR_ID_MAX_LENGTH, 'a.json')
+            second = registry.register('Questionnaire', ('b.json', 'B'), 'x' * FHIR_ID_MAX_LENGTH, 'b.json')
+            registered_ids.append((first, second))
+
+        first, second = registered_ids[0]
+        self.assertEqual(first, 'x' * FHIR_ID_MAX_LENGTH)
+        self.assertNotEqual(second, first)
+        self.assertEqual(len(second), FHIR_ID_MAX_LENGTH)
+        self.assertRegex(second, r'^x+-[0-9a-f]{8}$')
+        self.assertEqual(registered_ids[0], registered_ids[1])
+
+    def test_truncated_ids_of_converted_forms(self):
+        xlsforms = [create_xlsform(self.folder / f'{short_name}.json', short_name=short_name) for short_name in LONG_SHORT_NAMES]
+        fsh_lines_list_DSCN, _ = build_projects(self.folder / 'failing', xlsforms, Fhir_id_registries())
+        self.assertEqual([entry[3] for entry in fsh_lines_list_DSCN], [LONG_SHORT_NAMES[0], 'QuestionReferenceCS'])
+
+        id_registries = Fhir_id_registries(disambiguate=True)
+        fsh_lines_list_DSCN, _ = build_projects(self.folder / 'disambiguated', xlsforms, id_registries)
+        valueset_ids = [re.match(r'ValueSet: (\S+)', line).group(1) for entry in fsh_lines_list_DSCN[:2] for line in entry[2] if line.startswith('ValueSet: ')]
+        self.assertEqual(len(valueset_ids), 2)
+        self.assertNotEqual(valueset_ids[0], valueset_ids[1])
+        self.assertTrue(all(len(valueset_id) <= FHIR_ID_MAX_LENGTH for valueset_id in valueset_ids))
+
+        # The ids are kept for runs that only convert some of the forms
+        registry_path = self.folder / 'fhir_ids.json'
+        id_registries.save(registry_path)
+        loaded = Fhir_id_registries()
+        self.assertTrue(loaded.load(registry_path, exclude_forms=[xlsforms[1].input_path]))
+        self.assertEqual({entry[3] for entry in loaded.get_state()['DSCN']}, {xlsforms[0].input_path})
+        self.assertFalse(Fhir_id_registries().load(self.folder / 'missing.json'))
+
+if __name__ == '__main__':
+    unittest.main()
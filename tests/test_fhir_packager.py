@@ -0,0 +1,88 @@
+import json, tarfile, tempfile, unittest
+from datetime import datetime, timezone
+from pathlib import Path
+import src.fhir_packager as packager
+from tests.forms import LPDS_HEALTHBOARD_ABBREVIATION_DICT, run_main, write_json_form
+
+RESOURCES = [
+    {'resourceType': 'Questionnaire', 'id': 'ABU-FormA', 'url': 'https://fhir.abuhb.nhs.wales/Questionnaire/ABU-FormA', 'version': '1'},
+    {'resourceType': 'ValueSet', 'id': 'FormA-YesnoVS', 'url': 'https://fhir.abuhb.nhs.wales/ValueSet/FormA-YesnoVS'},
+    {'resourceType': 'ValueSet', 'id': 'FormA-OtherVS', 'name': 'Ünïcode'},
+]
+
+def read_package(package_path) -> dict:
+    with tarfile.open(package_path, 'r:gz') as package:
+        return {member.name: json.loads(package.extractfile(member).read()) for member in package.getmembers()}
+
+class Fhir_packager_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        self.project_folder = self.folder / 'LPDS' / 'ABU'
+        resources_folder = self.project_folder / 'fsh-generated' / 'resources'
+        resources_folder.mkdir(parents=True)
+        for resource in RESOURCES:
+            (resources_folder / f"{resource['resourceType']}-{resource['id']}.json").write_text(json.dumps(resource), encoding='utf-8')
+        (self.project_folder / 'sushi-config.yaml').write_text(f"canonical: {LPDS_HEALTHBOARD_ABBREVIATION_DICT['ABU']}\nversion: 1.2.0\nfhirVersion: 4.0.1\n",
+                                                               encoding='utf-8')
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_package_project(self):
+        package_folder = packager.package_project(self.project_folder, mtime=0)
+
+        self.assertEqual(packager.get_package_name(self.project_folder), 'nhs.wales.psom.lpds.abu')
+        self.assertEqual(packager.get_package_name(self.folder / 'DSCN'), 'nhs.wales.psom.dscn')
+        ndjson = {f.name: [json.loads(line) for line in f.read_text(encoding='utf-8').splitlines()] for f in (package_folder / 'ndjson').iterdir()}
+        self.assertEqual(sorted(ndjson), ['Questionnaire.ndjson', 'ValueSet.ndjson'])
+        self.assertEqual([resource['id'] for resource in ndjson['ValueSet.ndjson']], ['FormA-OtherVS', 'FormA-YesnoVS'])
+        self.assertEqual(ndjson['ValueSet.ndjson'][0]['name'], 'Ünïcode')
+
+        package = read_package(package_folder / 'package.tgz')
+        self.assertEqual(package['package/package.json']['name'], 'nhs.wales.psom.lpds.abu')
+        self.assertEqual(package['package/package.json']['version'], '1.2.0')
+        self.assertEqual(package['package/package.json']['canonical'], LPDS_HEALTHBOARD_ABBREVIATION_DICT['ABU'])
+        index = package['package/.index.json']['files']
+        self.assertEqual([entry['filename'] for entry in index], ['Questionnaire-ABU-FormA.json', 'ValueSet-FormA-OtherVS.json', 'ValueSet-FormA-YesnoVS.json'])
+        # Missing elements are left out of the index
+        self.assertNotIn('url', index[1])
+        self.assertEqual(index[0]['version'], '1')
+        self.assertEqual(package['package/Questionnaire-ABU-FormA.json'], RESOURCES[0])
+
+        # Packaging again gives the same package, and does not keep resources that are gone
+        first_package = (package_folder / 'package.tgz').read_bytes()
+        self.assertEqual((packager.package_project(self.project_folder, mtime=0) / 'package.tgz').read_bytes(), first_package)
+        (self.project_folder / 'fsh-generated' / 'resources' / 'Questionnaire-ABU-FormA.json').unlink()
+        packager.package_project(self.project_folder, mtime=0)
+        self.assertEqual(sorted(f.name for f in (package_folder / 'ndjson').iterdir()), ['ValueSet.ndjson'])
+
+    def test_project_without_resources(self):
+        empty_project = self.folder / 'DSCN'
+        empty_project.mkdir()
+        (empty_project / 'sushi-config.yaml').write_text('canonical: https://fhir.nhs.wales\n', encoding='utf-8')
+
+        package_folder = packager.package_project(empty_project, mtime=0)
+
+        self.assertEqual(list((package_folder / 'ndjson').iterdir()), [])
+        package = read_package(package_folder / 'package.tgz')
+        self.assertEqual(package['package/.index.json']['files'], [])
+        self.assertEqual(package['package/package.json']['version'], '0.1.0')
+
+    def test_package_option(self):
+        input_folder = self.folder / 'run' / 'input'
+        input_folder.mkdir(parents=True)
+        write_json_form(input_folder / 'a.json', short_name='FormA')
+
+        run = run_main(self.folder / 'run', '--package', '--deterministic', '--version-date', '20260101')
+        self.assertEqual(run.returncode, 0, run.stderr)
+
+        package_folder = self.folder / 'run' / 'output' / 'current' / 'DSCN' / 'package'
+        self.assertIn('Questionnaire.ndjson', [f.name for f in (package_folder / 'ndjson').iterdir()])
+        with tarfile.open(package_folder / 'package.tgz', 'r:gz') as package:
+            # The package timestamps are the version date of the deterministic build
+            self.assertEqual({member.mtime for member in package.getmembers()}, {int(datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp())})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import json, tempfile, unittest
+from pathlib import Path
+import pandas as pd
+import src.form_readers as form_readers
+import src.xlsform_processor as xls
+from src.input_prefetcher import read_input
+from src.models.XLS_Form import XLS_Form
+from tests.forms import CHOICES, LPDS_HEALTHBOARD_ABBREVIATION_DICT, SURVEY, build_projects, create_form, read_fsh_files, write_json_form
+
+class Form_readers_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def write_forms(self) -> list:
+        """Writes the same form as a workbook, a JSON form and a .csvform folder."""
+        form = create_form('FormA')
+        xlsx_path = self.folder / 'a.xlsx'
+        with pd.ExcelWriter(xlsx_path) as writer:
+            for sheet_name, rows in form.items():
+                pd.DataFrame(rows).to_excel(writer, sheet_name=sheet_name, index=False)
+        json_path = write_json_form(self.folder / 'b.json', short_name='FormA')
+        csvform_path = self.folder / 'c.csvform'
+        csvform_path.mkdir()
+        for sheet_name, rows in form.items():
+            pd.DataFrame(rows).to_csv(csvform_path / f'{sheet_name}.csv', index=False)
+        return [str(xlsx_path), json_path, str(csvform_path)]
+
+    def test_readers_give_the_same_form(self):
+        input_paths = self.write_forms()
+
+        fsh_files = []
+        for input_path in input_paths:
+            sheets = form_readers.read_form(input_path)
+            self.assertEqual(list(sheets['survey']['name']), [row['name'] for row in SURVEY])
+            self.assertEqual(list(sheets['choices']['label']), [row['label'] for row in CHOICES])
+            # Forms read into memory beforehand give the same sheets
+            self.assertEqual({name: sheet.to_dict('records') for name, sheet in form_readers.read_form(input_path, read_input(input_path)).items()},
+                             {name: sheet.to_dict('records') for name, sheet in sheets.items()})
+            self.assertEqual(form_readers.read_form_settings(input_path)['tool_short_form'][0], 'FormA')
+
+            xlsform = XLS_Form(input_path, Path(input_path).name, LPDS_HEALTHBOARD_ABBREVIATION_DICT, sheets)
+            build_projects(self.folder / Path(input_path).stem, [xlsform])
+            fsh_files.append(read_fsh_files(self.folder / Path(input_path).stem / 'DSCN'))
+        self.assertEqual(fsh_files[0], fsh_files[1])
+        self.assertEqual(fsh_files[0], fsh_files[2])
+
+        # Only .csvform folders are forms, other form definitions are files
+        (self.folder / 'e.csvform').write_text('', encoding='utf-8')
+        (self.folder / 'f.json').mkdir()
+        (self.folder / 'notes.txt').write_text('', encoding='utf-8')
+        self.assertEqual(xls.list_xlsform_files(f'{self.folder}/'), sorted(input_paths))
+
+    def test_json_rows(self):
+        json_path = self.folder / 'a.json'
+        json_path.write_text(json.dumps({
+            'settings': {'form_title': 'Title', 'version': 1},
+            'survey': [{'type': 'text', 'name': 'q1'}, {'type': 'integer', 'name': 'q2', 'label': None}],
+            'choices': [],
+        }), encoding='utf-8')
+
+        sheets = form_readers.read_form(str(json_path))
+
+        # A single settings object is one row, and missing cells and nulls are empty like in a workbook
+        self.assertEqual(sheets['settings'].to_dict('records'), [{'form_title': 'Title', 'version': 1}])
+        self.assertEqual(sheets['survey'].to_dict('records'), [{'type': 'text', 'name': 'q1', 'label': ''}, {'type': 'integer', 'name': 'q2', 'label': ''}])
+        self.assertTrue(sheets['choices'].empty)
+
+    def test_invalid_forms(self):
+        for file_name, content, message in (
+            ('list.json', '[]', 'does not contain a JSON object'),
+            ('rows.json', '{"settings": [], "survey": "q1", "choices": []}', 'survey must be a list of rows'),
+            ('no_choices.json', '{"settings": [], "survey": []}', 'has no choices sheet'),
+        ):
+            (self.folder / file_name).write_text(content, encoding='utf-8')
+            with self.assertRaises(ValueError) as context:
+                form_readers.read_form(str(self.folder / file_name))
+            self.assertIn(message, str(context.exception))
+
+        (self.folder / 'broken.json').write_text('{', encoding='utf-8')
+        with self.assertRaises(json.JSONDecodeError):
+            form_readers.read_form(str(self.folder / 'broken.json'))
+
+        csvform_path = self.folder / 'a.csvform'
+        csvform_path.mkdir()
+        (csvform_path / 'survey.csv').write_text('type,name,label\n', encoding='utf-8')
+        with self.assertRaises(ValueError) as context:
+            form_readers.read_form(str(csvform_path))
+        self.assertIn('has no settings, choices sheet', str(context.exception))
+
+        with self.assertRaises(ValueError) as context:
+            form_readers.get_form_reader('form.ods')
+        self.assertIn('Supported form definitions are: .xlsx, .json, .csvform', str(context.exception))
+
+if __name__ == '__main__':
+    unittest.main()
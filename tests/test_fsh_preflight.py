@@ -0,0 +1,126 @@
+import tempfile, unittest
+from pathlib import Path
+from src.failure_report import Failure_report
+from src.fsh_preflight import check_project, run_preflight
+from tests.forms import SURVEY, build_projects, create_xlsform
+
+class Fsh_preflight_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        self.project_folder = self.folder / 'DSCN'
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def write_fsh(self, file_name: str, lines: list) -> None:
+        fsh_folder = self.project_folder / 'input' / 'fsh'
+        fsh_folder.mkdir(parents=True, exist_ok=True)
+        (fsh_folder / file_name).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    def test_generated_project_passes(self):
+        survey = SURVEY + [
+            # Left out of the QuestionReferenceCS, but still used as item code
+            {'type': 'text', 'name': 'age_group', 'label': 'Age group'},
+            {'type': 'text', 'name': 'q3', 'label': 'First line\nsecond "line"'},
+        ]
+        build_projects(self.folder, [create_xlsform(self.folder / 'form.json', short_name='FormA', survey=survey)])
+
+        questionnaire = next((self.project_folder / 'input' / 'fsh' / 'questionnaires').glob('*.fsh')).read_text(encoding='utf-8')
+        self.assertIn('QuestionReferenceCS#age_group', questionnaire)
+        self.assertIn('First line\nsecond', questionnaire)
+        self.assertEqual(check_project(self.project_folder), [])
+
+    def test_undefined_codes_and_references(self):
+        self.write_fsh('terminology.fsh', [
+            'CodeSystem: QuestionReferenceCS',
+            '* #q1 "Question 1"',
+            '* #q1 "Question 1 again"',
+            '',
+            'ValueSet: AnswersVS',
+            '* QuestionReferenceCS#q2 "Question 2"',
+            '* include codes from system MissingCS',
+        ])
+        self.write_fsh('questionnaire.fsh', [
+            'Instance: form',
+            'InstanceOf: Questionnaire',
+            '* item[+]',
+            '  * code = QuestionReferenceCS#q1',
+            '* item[+]',
+            '  * code = QuestionReferenceCS#q3',
+            '  * answerValueSet = Canonical(MissingVS)',
+            '* item[+]',
+            '  * code = QuestionReferenceCS#q3_group',
+        ])
+
+        messages = [issue['message'] for issue in check_project(self.project_folder)]
+        self.assertEqual(messages, [
+            'Duplicate code q1 in CodeSystem QuestionReferenceCS.',
+            'Code q3 is not defined in CodeSystem QuestionReferenceCS.',
+            'answerValueSet references ValueSet MissingVS, which is not defined in the project.',
+            'Code q2 is not defined in CodeSystem QuestionReferenceCS.',
+            'ValueSet includes CodeSystem MissingCS, which is not defined in the project.',
+        ])
+
+    def test_quotes(self):
+        self.write_fsh('questionnaire.fsh', [
+            'Instance: form',
+            'InstanceOf: Questionnaire',
+            '* item[+].text = "A \\"quoted\\" label"',
+            '* item[+].text = "A label',
+            'over two lines"',
+            '* item[+].text = "Unescaped "quote""',
+            '* item[+].text = "Never closed',
+        ])
+
+        issues = check_project(self.project_folder)
+        self.assertEqual([(issue['line'], issue['message']) for issue in issues], [
+            (6, 'Unescaped or unterminated quote in: * item[+].text = "Unescaped "quote""'),
+            (7, 'Unterminated quote in: * item[+].text = "Never closed'),
+        ])
+
+    def test_duplicate_ids_and_canonical_references(self):
+        self.project_folder.mkdir()
+        (self.project_folder / 'sushi-config.yaml').write_text('canonical: https://fhir.nhs.wales\n', encoding='utf-8')
+        self.write_fsh('a.fsh', [
+            'CodeSystem: AnswersCS',
+            '* ^url = "https://example.org/answers"',
+            '* #yes "Yes"',
+            '',
+            'ValueSet: AnswersVS',
+            '* https://example.org/answers#yes "Yes"',
+            '* https://fhir.nhs.wales/CodeSystem/AnswersCS#no "No"',
+            '* http://snomed.info/sct#123 "Outside the project"',
+        ])
+        self.write_fsh('b.fsh', [
+            'ValueSet: AnswersVS',
+            '* include codes from system https://fhir.nhs.wales/CodeSystem/AnswersCS',
+            '',
+            'Instance: form',
+            'InstanceOf: Questionnaire',
+            '* item[+]',
+            '  * answerValueSet = Canonical(https://fhir.nhs.wales/ValueSet/AnswersVS)',
+        ])
+
+        self.assertEqual([(Path(issue['file']).name, issue['line'], issue['message']) for issue in check_project(self.project_folder)], [
+            ('b.fsh', 1, f'Duplicate ValueSet id AnswersVS, first defined in {self.project_folder / "input" / "fsh" / "a.fsh"}:5.'),
+            ('a.fsh', 7, 'Code no is not defined in CodeSystem https://fhir.nhs.wales/CodeSystem/AnswersCS.'),
+        ])
+
+    def test_projects_with_problems_are_not_compiled(self):
+        build_projects(self.folder, [create_xlsform(self.folder / 'a.json', short_name='FormA'), create_xlsform(self.folder / 'b.json', short_name='FormB', board='ABU')])
+        broken_project = self.folder / 'LPDS' / 'ABU'
+        questionnaire = next((broken_project / 'input' / 'fsh' / 'questionnaires').glob('*.fsh'))
+        questionnaire.write_text(questionnaire.read_text(encoding='utf-8').replace('YesnoVS', 'MissingVS'), encoding='utf-8')
+        failure_report = Failure_report(self.folder)
+
+        passed_folders = run_preflight([self.project_folder, broken_project], failure_report, {broken_project: ['b.json']})
+
+        self.assertEqual(passed_folders, [self.project_folder])
+        self.assertEqual(failure_report.get_failed_forms(), {'b.json'})
+        self.assertEqual(failure_report.failures[0]['stage'], 'preflight')
+        self.assertIn('which is not defined in the project', failure_report.failures[0]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import json, tempfile, unittest
+from pathlib import Path
+import src.generation_diff as generation_diff
+from tests.forms import CHOICES, SURVEY, build_projects, create_xlsform, run_main
+
+class Generation_diff_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def build_trees(self) -> None:
+        build_projects(self.folder / 'old', [create_xlsform(self.folder / 'a.json', short_name='FormA'),
+                                             create_xlsform(self.folder / 'b.json', short_name='FormB', board='ABU')])
+        survey = [dict(row) for row in SURVEY]
+        survey[1]['label'] = 'Do you like it?'
+        choices = CHOICES + [{'list_name': 'yesno', 'name': 'maybe', 'label': 'Maybe'}]
+        # A new version of the form, with a changed label and an added choice
+        build_projects(self.folder / 'new', [create_xlsform(self.folder / 'a.json', short_name='FormA', version=2, survey=survey, choices=choices)])
+
+    def test_diff_fsh_trees(self):
+        self.build_trees()
+
+        changes = generation_diff.diff_trees(self.folder / 'old', self.folder / 'new')
+
+        self.assertEqual(sorted(changes), ['DSCN', 'LPDS/ABU'])
+        self.assertEqual([(change['change'], change['element'], change['key'], change['id']) for change in changes['DSCN']], [
+            ('added', 'code', 'maybe', 'FormA-YesnoCS'),
+            ('changed', 'code', 'q1', 'QuestionReferenceCS'),
+            ('changed', 'question', 'q1', 'DataStandardsWales-PSOM-FormA'),
+            ('added', 'member', 'FormA-YesnoCS#maybe', 'FormA-YesnoVS'),
+        ])
+        self.assertEqual(changes['DSCN'][2]['new']['text'], '"Do you like it?"')
+        self.assertEqual({(change['change'], change['element']) for change in changes['LPDS/ABU']}, {('removed', None)})
+
+        report = generation_diff.format_diff(changes)
+        self.assertIn('LPDS/ABU: 3 changes', report)
+        self.assertIn('      text: "Do you \\"like\\" it?" -> "Do you like it?"', report)
+
+        # The versions only differ when they are compared
+        with_versions = generation_diff.diff_trees(self.folder / 'old', self.folder / 'new', ignored_properties=set())
+        self.assertIn(('property', 'version'), {(change['element'], change['key']) for change in with_versions['DSCN']})
+        self.assertEqual(generation_diff.diff_trees(self.folder / 'old', self.folder / 'old'), {})
+        self.assertEqual(generation_diff.format_diff({}), 'No differences.')
+
+    def test_compact_valueset_equals_enumerated_valueset(self):
+        build_projects(self.folder / 'old', [create_xlsform(self.folder / 'a.json', short_name='FormA')])
+        build_projects(self.folder / 'new', [create_xlsform(self.folder / 'a.json', short_name='FormA')], compact_valueset_threshold=2)
+
+        valueset = (self.folder / 'new' / 'DSCN' / 'input' / 'fsh' / 'terminology' / 'FormA-v1.fsh').read_text(encoding='utf-8')
+        self.assertIn('* include codes from system FormA-YesnoCS', valueset)
+        self.assertEqual(generation_diff.diff_trees(self.folder / 'old', self.folder / 'new'), {})
+
+    def test_diff_json_resources(self):
+        for tree, display in (('old', 'Yes'), ('new', 'Yes please')):
+            resources_folder = self.folder / tree / 'DSCN' / 'fsh-generated' / 'resources'
+            resources_folder.mkdir(parents=True)
+            resources = [
+                {'resourceType': 'CodeSystem', 'id': 'YesnoCS', 'url': 'https://fhir.nhs.wales/CodeSystem/YesnoCS', 'date': tree,
+                 'concept': [{'code': 'yes', 'display': display}, {'code': 'no', 'display': 'No'}]},
+                {'resourceType': 'ValueSet', 'id': 'YesnoVS', 'compose': {'include': [{'system': 'https://fhir.nhs.wales/CodeSystem/YesnoCS'}]}},
+            ]
+            for resource in resources:
+                (resources_folder / f"{resource['resourceType']}-{resource['id']}.json").write_text(json.dumps(resource), encoding='utf-8')
+
+        changes = generation_diff.diff_trees(self.folder / 'old', self.folder / 'new', 'json')
+
+        # The included CodeSystem is expanded, so the ValueSet changes with it
+        self.assertEqual([(change['change'], change['element'], change['key'], change['id']) for change in changes['DSCN']], [
+            ('changed', 'code', 'yes', 'YesnoCS'),
+            ('changed', 'member', 'https://fhir.nhs.wales/CodeSystem/YesnoCS#yes', 'YesnoVS'),
+        ])
+
+    def test_diff_command(self):
+        self.build_trees()
+
+        changed = run_main(self.folder, 'diff', 'old', 'new', '--report', 'report.json')
+        self.assertEqual(changed.returncode, 1, changed.stderr)
+        self.assertIn('DSCN: 4 changes', changed.stdout)
+        self.assertEqual(sorted(json.loads((self.folder / 'report.json').read_text(encoding='utf-8'))), ['DSCN', 'LPDS/ABU'])
+
+        unchanged = run_main(self.folder, 'diff', 'old', 'old')
+        self.assertEqual(unchanged.returncode, 0, unchanged.stderr)
+        self.assertIn('No differences.', unchanged.stdout)
+
+        # Without arguments, the current output is compared with the generation before it, and there is none
+        missing = run_main(self.folder, 'diff')
+        self.assertEqual(missing.returncode, 2, missing.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import tempfile, unittest
+from pathlib import Path
+import src.xlsform_to_fsh_converter as fsh
+from tests.forms import LPDS_HEALTHBOARD_ABBREVIATION_DICT, build_projects, create_xlsform, read_fsh_files
+
+class Lpds_question_reference_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_codesystem_per_health_board(self):
+        xlsforms = [create_xlsform(self.folder / 'ctm.json', short_name='FormC', board='CTM'),
+                    create_xlsform(self.folder / 'abu.json', short_name='FormA', board='ABU')]
+        _, fsh_lines_list_LPDS = build_projects(self.folder, xlsforms, lpds_question_reference=True)
+
+        # The CodeSystems follow the questionnaires, ordered by health board
+        self.assertEqual([(entry[3], entry[5]) for entry in fsh_lines_list_LPDS[-2:]],
+                         [('LPDSQuestionReferenceCS', 'ABU'), ('LPDSQuestionReferenceCS', 'CTM')])
+        for board, canonical in LPDS_HEALTHBOARD_ABBREVIATION_DICT.items():
+            fsh_files = read_fsh_files(self.folder / 'LPDS' / board)
+            codesystem = fsh_files['terminology/LPDSQuestionReferenceCS.fsh']
+            self.assertIn(f'{canonical}/CodeSystem/LPDSQuestionReferenceCS', codesystem)
+            self.assertIn('* #q1 ', codesystem)
+            questionnaire = next(text for path, text in fsh_files.items() if path.startswith('questionnaires/'))
+            self.assertIn(f'{canonical}/CodeSystem/LPDSQuestionReferenceCS#q1', questionnaire)
+
+        self.assertEqual(sorted(fsh.read_lpds_question_codes(self.folder, ['CTM', 'ABU', 'ABU'])), ['ABU', 'CTM'])
+
+    def test_without_option(self):
+        _, fsh_lines_list_LPDS = build_projects(self.folder, [create_xlsform(self.folder / 'abu.json', short_name='FormA', board='ABU')])
+
+        self.assertEqual([entry[3] for entry in fsh_lines_list_LPDS], ['FormA'])
+        fsh_files = read_fsh_files(self.folder / 'LPDS' / 'ABU')
+        self.assertNotIn('terminology/LPDSQuestionReferenceCS.fsh', fsh_files)
+        self.assertFalse(any('LPDSQuestionReferenceCS' in text for text in fsh_files.values()))
+        # Health boards without a CodeSystem are left out
+        self.assertEqual(fsh.read_lpds_question_codes(self.folder, ['ABU', 'CTM']), {})
+
+    def test_previous_question_codes_are_kept(self):
+        previous_question_codes_LPDS = {'CTM': [('old_question', 'Old question')]}
+        _, fsh_lines_list_LPDS = build_projects(self.folder, [create_xlsform(self.folder / 'abu.json', short_name='FormA', board='ABU')],
+                                                lpds_question_reference=True, previous_question_codes_LPDS=previous_question_codes_LPDS)
+
+        self.assertEqual([entry[5] for entry in fsh_lines_list_LPDS if entry[3] == 'LPDSQuestionReferenceCS'], ['ABU', 'CTM'])
+        question_codes_LPDS = fsh.read_lpds_question_codes(self.folder, ['ABU', 'CTM'])
+        self.assertEqual([code[0] for code in question_codes_LPDS['CTM']], ['old_question'])
+        self.assertIn('q1', [code[0] for code in question_codes_LPDS['ABU']])
+
+if __name__ == '__main__':
+    unittest.main()
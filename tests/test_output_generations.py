@@ -0,0 +1,104 @@
+import json, os, socket, subprocess, sys, tempfile, time, unittest
+from pathlib import Path
+import src.output_generations as generations
+from src.checkpoints import Checkpoints
+from src.constants import CURRENT_GENERATION_LINK, GENERATIONS_SUBFOLDER, GENERATION_COMPLETE_MARKER, GENERATION_LOCK_FILE, GENERATION_LOCK_MAX_AGE
+
+class Output_generations_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.output_folder = Path(self.temporary_folder.name) / 'output'
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def create_generation(self, name: str, content: str = None, complete: bool = False) -> Path:
+        generation_folder = self.output_folder / GENERATIONS_SUBFOLDER / name
+        (generation_folder / 'DSCN').mkdir(parents=True)
+        (generation_folder / 'DSCN' / 'sushi-config.yaml').write_text(content or name, encoding='utf-8')
+        if complete:
+            (generation_folder / GENERATION_COMPLETE_MARKER).touch()
+        return generation_folder
+
+    def test_activation_swaps_the_current_generation(self):
+        first = generations.create_generation(self.output_folder)
+        self.assertTrue((first / GENERATION_LOCK_FILE).exists())
+        (first / 'DSCN').mkdir()
+        (first / 'DSCN' / 'sushi-config.yaml').write_text('first', encoding='utf-8')
+        generations.activate_generation(self.output_folder, first)
+        generations.release_generation(first)
+
+        self.assertEqual(generations.get_current_generation(self.output_folder), first.resolve())
+        self.assertEqual((self.output_folder / 'DSCN' / 'sushi-config.yaml').read_text(encoding='utf-8'), 'first')
+        self.assertFalse((first / GENERATION_LOCK_FILE).exists())
+
+        second = generations.create_generation(self.output_folder)
+        generations.seed_generation(second, first)
+        # Seeded files are shared with the previous generation, the marker and lock are not copied
+        self.assertTrue(os.path.samefile(second / 'DSCN' / 'sushi-config.yaml', first / 'DSCN' / 'sushi-config.yaml'))
+        self.assertFalse((second / GENERATION_COMPLETE_MARKER).exists())
+        self.assertTrue((second / GENERATION_LOCK_FILE).exists())
+
+        (second / 'DSCN' / 'sushi-config.yaml').unlink()
+        (second / 'DSCN' / 'sushi-config.yaml').write_text('second', encoding='utf-8')
+        generations.activate_generation(self.output_folder, second)
+
+        self.assertEqual(os.readlink(self.output_folder / 'DSCN'), os.path.join(CURRENT_GENERATION_LINK, 'DSCN'))
+        self.assertEqual((self.output_folder / 'DSCN' / 'sushi-config.yaml').read_text(encoding='utf-8'), 'second')
+        self.assertEqual((first / 'DSCN' / 'sushi-config.yaml').read_text(encoding='utf-8'), 'first')
+        self.assertEqual(generations.list_completed_generations(self.output_folder), [second, first])
+
+    def test_output_without_generations_is_retired(self):
+        (self.output_folder / 'DSCN').mkdir(parents=True)
+        (self.output_folder / 'DSCN' / 'sushi-config.yaml').write_text('old', encoding='utf-8')
+        self.assertEqual(generations.get_current_generation(self.output_folder), self.output_folder)
+
+        generation = self.create_generation('20260101T000000000000')
+        generations.activate_generation(self.output_folder, generation)
+
+        self.assertEqual((self.output_folder / 'DSCN' / 'sushi-config.yaml').read_text(encoding='utf-8'), '20260101T000000000000')
+        retired = [f.name for f in (self.output_folder / GENERATIONS_SUBFOLDER).iterdir() if f.name.startswith('retired-')]
+        self.assertEqual(len(retired), 1)
+
+    def test_reuse_unchanged_files(self):
+        previous = self.create_generation('20260101T000000000000', 'same', complete=True)
+        (previous / 'DSCN' / 'changed.fsh').write_text('old', encoding='utf-8')
+        generation = self.create_generation('20260102T000000000000', 'same')
+        (generation / 'DSCN' / 'changed.fsh').write_text('new', encoding='utf-8')
+
+        self.assertEqual(generations.reuse_unchanged_files(generation, previous), 1)
+        self.assertTrue(os.path.samefile(generation / 'DSCN' / 'sushi-config.yaml', previous / 'DSCN' / 'sushi-config.yaml'))
+        self.assertFalse(os.path.samefile(generation / 'DSCN' / 'changed.fsh', previous / 'DSCN' / 'changed.fsh'))
+        self.assertEqual(generations.reuse_unchanged_files(generation, None), 0)
+
+    def test_prune_generations(self):
+        oldest = self.create_generation('20260101T000000000000', complete=True)
+        older = self.create_generation('20260102T000000000000', complete=True)
+        current = self.create_generation('20260103T000000000000', complete=True)
+        generations.activate_generation(self.output_folder, current)
+        crashed = self.create_generation('20260104T000000000000')
+        locked = self.create_generation('20260105T000000000000')
+        generations.lock_generation(locked)
+        stale_lock = self.create_generation('20260106T000000000000')
+        # The lock of a run that has finished, its process no longer exists and the lock is older than the maximum age
+        finished_pid = int(subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True, check=True).stdout)
+        (stale_lock / GENERATION_LOCK_FILE).write_text(json.dumps({'host': socket.gethostname(), 'pid': finished_pid}), encoding='utf-8')
+        lock_time = time.time() - GENERATION_LOCK_MAX_AGE - 60
+        os.utime(stale_lock / GENERATION_LOCK_FILE, (lock_time, lock_time))
+        self.assertTrue(generations.is_generation_locked(locked))
+        self.assertFalse(generations.is_generation_locked(stale_lock))
+        resumable = self.create_generation('20260107T000000000000')
+        Checkpoints.create(resumable, 'fingerprint').save_stage('load', {})
+        older_resumable = self.create_generation('20251231T000000000000')
+        Checkpoints.create(older_resumable, 'fingerprint').save_stage('load', {})
+
+        generations.prune_generations_in_background(self.output_folder, keep=2).join()
+
+        remaining = sorted(f.name for f in (self.output_folder / GENERATIONS_SUBFOLDER).iterdir())
+        self.assertEqual(remaining, [older.name, current.name, locked.name, resumable.name])
+        self.assertFalse(oldest.exists() or crashed.exists() or stale_lock.exists() or older_resumable.exists())
+        self.assertEqual(generations.get_current_generation(self.output_folder), current.resolve())
+
+if __name__ == '__main__':
+    unittest.main()
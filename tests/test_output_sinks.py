@@ -0,0 +1,104 @@
+import tarfile, tempfile, unittest, zipfile
+from pathlib import Path
+import src.file_writer as fw
+from src.output_sinks import Archive_sink, Filesystem_sink, Memory_sink, Output_sink_error
+
+LPDS_HEALTHBOARD_ABBREVIATION_DICT = {'ABU': 'https://fhir.abuhb.nhs.wales'}
+
+# FSH lines entries as returned by convert_to_fsh, two forms of the same health board share its sushi-config.yaml
+FSH_LINES_LIST = [
+    ('DSCN_FORM', ['Instance: dscn-form', 'InstanceOf: Questionnaire'], ['CodeSystem: DscnFormCS'], 'DSCN_FORM', '1', None, [], []),
+    ('ABU_FORM', ['Instance: abu-form', 'InstanceOf: Questionnaire'], ['CodeSystem: AbuFormCS'], 'ABU_FORM', '2', 'ABU', [], []),
+    ('ABU_OTHER', ['Instance: abu-other', 'InstanceOf: Questionnaire'], [], 'ABU_OTHER', '1', 'ABU', [], []),
+    ([], [], [], 'QuestionReferenceCS', None, [], ['CodeSystem: QuestionReferenceCS'], []),
+]
+
+def write_tree(sink, root) -> None:
+    fw.write_fsh_files(FSH_LINES_LIST, root, LPDS_HEALTHBOARD_ABBREVIATION_DICT, sink=sink)
+    fw.write_to_md_file('| Form |\n| --- |\n', Path(root) / 'Overview of processed XLSForms.md', sink)
+    # Appended files are spooled by the archive sink and added last
+    for line in ('first\n', 'second\n'):
+        with sink.open_for_writing(Path(root) / 'appended.txt', 'a') as f:
+            f.write(line)
+    sink.close()
+
+def read_folder(folder) -> dict:
+    return {f.relative_to(folder).as_posix(): f.read_text(encoding='utf-8') for f in sorted(Path(folder).rglob('*')) if f.is_file()}
+
+def read_archive(archive_path, archive_format: str) -> dict:
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive_path) as archive:
+            return {name: archive.read(name).decode('utf-8') for name in archive.namelist()}
+    with tarfile.open(archive_path, 'r:gz') as archive:
+        return {member.name: archive.extractfile(member).read().decode('utf-8') for member in archive.getmembers()}
+
+class Output_sinks_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_sinks_write_the_same_tree(self):
+        filesystem_root = self.folder / 'generation'
+        write_tree(Filesystem_sink(filesystem_root), filesystem_root)
+        expected = read_folder(filesystem_root)
+
+        memory_sink = Memory_sink(self.folder / 'memory')
+        write_tree(memory_sink, self.folder / 'memory')
+        self.assertEqual(memory_sink.files, expected)
+
+        for archive_format in ('zip', 'tar'):
+            archive_path = self.folder / f'output.{archive_format}'
+            write_tree(Archive_sink(self.folder / archive_format, archive_path, archive_format, mtime=0), self.folder / archive_format)
+            self.assertEqual(read_archive(archive_path, archive_format), expected)
+
+        self.assertEqual(expected['appended.txt'], 'first\nsecond\n')
+        self.assertEqual(sorted(name for name in expected if name.endswith('sushi-config.yaml')), ['DSCN/sushi-config.yaml', 'LPDS/ABU/sushi-config.yaml'])
+        self.assertEqual(fw.read_sushi_config(filesystem_root / 'LPDS' / 'ABU')['canonical'], LPDS_HEALTHBOARD_ABBREVIATION_DICT['ABU'])
+
+    def test_archive_is_deterministic(self):
+        archives = set()
+        for name in ('first', 'second'):
+            archive_path = self.folder / f'{name}.zip'
+            write_tree(Archive_sink(self.folder / name, archive_path, 'zip', mtime=0), self.folder / name)
+            archives.add(archive_path.read_bytes())
+        self.assertEqual(len(archives), 1)
+
+    def test_archive_members_cannot_change(self):
+        root = self.folder / 'generation'
+        sink = Archive_sink(root, self.folder / 'output.zip', 'zip')
+        with sink.open_for_writing(root / 'file.fsh') as f:
+            f.write('content\n')
+        with sink.open_for_writing(root / 'file.fsh') as f:
+            f.write('content\n')
+        with self.assertRaises(Output_sink_error):
+            sink.open_for_writing(root / 'file.fsh', 'a')
+        with self.assertRaises(Output_sink_error):
+            with sink.open_for_writing(root / 'file.fsh') as f:
+                f.write('other content\n')
+        self.assertEqual(sink.read_first_line(root / 'file.fsh'), 'content')
+        sink.close()
+
+        with zipfile.ZipFile(self.folder / 'output.zip') as archive:
+            self.assertEqual(archive.namelist(), ['file.fsh'])
+
+    def test_archive_spools_files_to_disk(self):
+        root = self.folder / 'generation'
+        sink = Archive_sink(root, self.folder / 'output.tar.gz', 'tar')
+        line = 'x' * 1023 + '\n'
+        with sink.open_for_writing(root / 'LPDS' / 'ABU' / 'input' / 'fsh' / 'terminology' / 'large.fsh') as f:
+            # The file is written to a temporary file, not held in memory
+            self.assertTrue(Path(f.name).is_file())
+            for _ in range(4096):
+                f.write(line)
+        self.assertFalse(Path(f.name).exists())
+        sink.close()
+
+        self.assertEqual(read_archive(self.folder / 'output.tar.gz', 'tar'), {'LPDS/ABU/input/fsh/terminology/large.fsh': line * 4096})
+        self.assertFalse(Path(Path(f.name).parent).exists())
+
+if __name__ == '__main__':
+    unittest.main()
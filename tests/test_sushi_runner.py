@@ -0,0 +1,91 @@
+import json, os, sys, tempfile, unittest
+from pathlib import Path
+from unittest import mock
+import src.sushi_runner as sushi
+from src.sushi_runner import Sushi_worker, Sushi_worker_error
+from src.sushi_telemetry import Sushi_run_report
+from tests.forms import create_fake_sushi
+
+# Fake SUSHI worker following the protocol of sushi_worker.js, `mode` makes it misbehave
+FAKE_WORKER = '''
+import json, sys, time
+mode = sys.argv[1]
+if mode == 'hang-on-start':
+    time.sleep(60)
+print(json.dumps({'ready': True}), flush=True)
+for line in sys.stdin:
+    folder = json.loads(line)['folder']
+    if mode == 'hang':
+        time.sleep(60)
+    if mode == 'exit':
+        sys.exit(3)
+    print(json.dumps({'folder': folder, 'ok': True, 'resources': 1, 'resourceTypes': {'Questionnaire': 1}, 'errors': [], 'warnings': []}), flush=True)
+'''
+
+class Sushi_runner_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+        self.project_folder = self.folder / 'DSCN'
+        self.project_folder.mkdir()
+        self.worker_script = self.folder / 'worker.py'
+        self.worker_script.write_text(FAKE_WORKER, encoding='utf-8')
+
+        bin_folder = self.folder / 'bin'
+        create_fake_sushi(bin_folder)
+        path_patch = mock.patch.dict(os.environ, {'PATH': os.pathsep.join([str(bin_folder), os.environ.get('PATH', '')])})
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+
+        self.run_report = Sushi_run_report(self.folder / 'sushi_run_report.jsonl', self.folder)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def start_worker(self, mode: str, timeout: float = 5) -> Sushi_worker:
+        worker = Sushi_worker(timeout=timeout, command=[sys.executable, str(self.worker_script), mode])
+        worker.start()
+        self.addCleanup(worker.stop)
+        return worker
+
+    def test_worker_compiles_projects(self):
+        worker = self.start_worker('ok')
+        for _ in range(2):
+            succeeded, next_worker = sushi.run_sushi_project(self.project_folder, worker, self.run_report)
+            self.assertTrue(succeeded)
+            self.assertIs(next_worker, worker)
+        self.assertEqual([entry['mode'] for entry in self.run_report.entries], ['worker', 'worker'])
+        self.assertEqual(self.run_report.entries[0]['resources'], {'Questionnaire': 1})
+
+    def test_hanging_worker_is_stopped_and_falls_back_to_the_cli(self):
+        worker = self.start_worker('hang', timeout=0.5)
+        process = worker.process
+
+        succeeded, next_worker = sushi.run_sushi_project(self.project_folder, worker, self.run_report)
+
+        self.assertTrue(succeeded)
+        self.assertIsNone(next_worker)
+        self.assertIsNotNone(process.poll())
+        self.assertEqual([entry['mode'] for entry in self.run_report.entries], ['cli'])
+        report_lines = (self.folder / 'sushi_run_report.jsonl').read_text(encoding='utf-8').splitlines()
+        self.assertEqual(json.loads(report_lines[0])['project'], 'DSCN')
+
+    def test_worker_that_exits_falls_back_to_the_cli(self):
+        worker = self.start_worker('exit')
+
+        succeeded, next_worker = sushi.run_sushi_project(self.project_folder, worker, self.run_report)
+
+        self.assertTrue(succeeded)
+        self.assertIsNone(next_worker)
+        self.assertEqual([entry['mode'] for entry in self.run_report.entries], ['cli'])
+
+    def test_worker_that_does_not_start_is_stopped(self):
+        worker = Sushi_worker(timeout=0.5, command=[sys.executable, str(self.worker_script), 'hang-on-start'])
+        with self.assertRaises(Sushi_worker_error):
+            worker.start()
+        self.assertIsNotNone(worker.process.poll())
+        worker.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import tempfile, unittest
+from pathlib import Path
+from src.models.Fsh_question_reference import read_question_codes
+from tests.forms import build_projects, create_xlsform, read_fsh_files
+
+TRANSLATION_EXTENSION_LINES = [
+    '    * text.extension[+].url = "http://hl7.org/fhir/StructureDefinition/translation"',
+    '    * text.extension[=].extension[+].url = "lang"',
+    '    * text.extension[=].extension[=].valueCode = #cy',
+    '    * text.extension[=].extension[+].url = "content"',
+    '    * text.extension[=].extension[=].valueString = "Ydych chi\'n ei \\"hoffi\\"?"',
+]
+
+def create_survey(english_column: str = 'label::English (en)', welsh_column: str = 'label::Welsh (cy)') -> list:
+    return [
+        {'type': 'begin_group', 'name': 'g1', english_column: 'Group 1', welsh_column: 'Grŵp 1', 'format': ''},
+        {'type': 'select_one yesno', 'name': 'q1', english_column: 'Do you "like" it?', welsh_column: 'Ydych chi\'n ei "hoffi"?'},
+        # A missing translation is left out
+        {'type': 'text', 'name': 'q2', english_column: 'Name', welsh_column: ''},
+        {'type': 'end_group', 'name': ''},
+    ]
+
+def create_choices(english_column: str = 'label::English (en)', welsh_column: str = 'label::Welsh (cy)') -> list:
+    return [{'list_name': 'yesno', 'name': 'yes', english_column: 'Yes', welsh_column: 'Ie'},
+            {'list_name': 'yesno', 'name': 'no', english_column: 'No', welsh_column: 'Na'}]
+
+class Translations_test(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_label_translations(self):
+        xlsform = create_xlsform(self.folder / 'a.json', short_name='FormA', survey=create_survey(), choices=create_choices(),
+                                 settings={'default_language': 'English (en)'})
+        self.assertEqual((xlsform.default_language, xlsform.label_translation_columns), ('en', [('label::Welsh (cy)', 'cy')]))
+
+        build_projects(self.folder / 'output', [xlsform])
+
+        fsh_files = read_fsh_files(self.folder / 'output' / 'DSCN')
+        questionnaire = fsh_files['questionnaires/FormA-v1.fsh'].splitlines()
+        self.assertIn('* language = #en', questionnaire)
+        q1 = questionnaire.index('    * text = "Do you \\"like\\" it?"')
+        self.assertEqual(questionnaire[q1 + 1:q1 + 6], TRANSLATION_EXTENSION_LINES)
+        q2 = questionnaire.index('    * text = "Name"')
+        self.assertEqual(questionnaire[q2 + 1], '    * type = #string')
+        self.assertIn('* #yes "Yes"\n  * ^designation[+].language = #cy\n  * ^designation[=].value = "Ie"\n', fsh_files['terminology/FormA-v1.fsh'])
+
+        # The designations of the QuestionReferenceCS are read back, so runs that do not convert the form keep them
+        question_codes = read_question_codes(self.folder / 'output' / 'DSCN' / 'input' / 'fsh' / 'terminology' / 'QuestionReferenceCS.fsh')
+        self.assertEqual(question_codes, [('q1', 'Do you \\"like\\" it?', (('cy', 'Ydych chi\'n ei \\"hoffi\\"?'),)), ('q2', 'Name')])
+        build_projects(self.folder / 'retry', [], previous_question_codes_DSCN=question_codes)
+        self.assertEqual(read_fsh_files(self.folder / 'retry' / 'DSCN')['terminology/QuestionReferenceCS.fsh'], fsh_files['terminology/QuestionReferenceCS.fsh'])
+
+    def test_languages_without_label_column(self):
+        # Without a default_language, the first language column is the label, and languages are also known by name
+        xlsform = create_xlsform(self.folder / 'a.json', short_name='FormA', survey=create_survey('label::English', 'label::Cymraeg'),
+                                 choices=create_choices('label::English', 'label::Cymraeg'))
+        self.assertEqual((xlsform.default_language, xlsform.label_translation_columns), ('en', [('label::Cymraeg', 'cy')]))
+        self.assertEqual(list(xlsform.df_survey['label'])[:3], ['Group 1', 'Do you "like" it?', 'Name'])
+
+        # A language without a code is ignored
+        unknown_language = create_xlsform(self.folder / 'b.json', short_name='FormB', survey=create_survey(welsh_column='label::Klingon'),
+                                          choices=create_choices(welsh_column='label::Klingon'))
+        self.assertEqual(unknown_language.label_translation_columns, [])
+        build_projects(self.folder / 'output', [unknown_language])
+        fsh_files = read_fsh_files(self.folder / 'output' / 'DSCN')
+        self.assertNotIn('* language =', fsh_files['questionnaires/FormB-v1.fsh'])
+        self.assertNotIn('translation', fsh_files['questionnaires/FormB-v1.fsh'])
+        self.assertNotIn('designation', fsh_files['terminology/FormB-v1.fsh'])
+
+if __name__ == '__main__':
+    unittest.main()